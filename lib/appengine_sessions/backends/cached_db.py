@@ -1,32 +1,196 @@
+""" Sessions kept in memcache in front of the datastore.
+
+Every save goes to memcache, but not necessarily to the datastore. A save
+that doesn't change a session's data is only written there if the expiry date
+it has there is more than `settings.SESSION_EXPIRY_REFRESH_INTERVAL` seconds
+out of date.
+
+With `settings.SESSION_WRITE_BACK_INTERVAL` set to a number of seconds, a
+changed session is also only written to the datastore at most once in each
+interval, unless it's new: changes in between just go to memcache, and a task
+queued for the end of the interval writes the latest of them. That saves most
+datastore writes for sessions that change on every request, at the cost of
+losing the last interval's changes if memcache evicts the session first. With
+it 0 every change is written straight through.
+
+Reading a session that's in memcache never touches the datastore. Nor does
+reading one that isn't in the datastore either, or has expired there, for a
+while after the first time: that's cached too, so a bogus or stale cookie
+costs a memcache get rather than a datastore get on every request. Loading
+such a session gives an empty one without a key, which only gets a key and is
+created in the datastore if it's saved.
+"""
+import datetime
+import time
+from collections import namedtuple
+from hashlib import md5
+
+from google.appengine.api import taskqueue
+
 from django.conf import settings
 from django.core.cache import cache
+from django.core.exceptions import SuspiciousOperation
+from django.core.urlresolvers import reverse
+from django.utils.encoding import force_unicode
 
 from appengine_sessions.backends.db import SessionStore as DBStore
 
+# Every cached session can be invalidated at once with `sessions.invalidate()`
+sessions = cache.namespace('sessions')
+
+# What's cached for a session: its data and expiry date, and the hash of its
+# encoded data, its expiry date and the time as of when it was last written to
+# the datastore
+CachedSession = namedtuple('CachedSession',
+    'data expire_date saved_hash saved_expire_date saved_at')
+
+# What's cached for a key with no live session in the datastore, and for how
+# many seconds
+NO_SESSION = 'no-session'
+NO_SESSION_TIMEOUT = 60
+
+FLUSH_TASK_NAME_TEMPLATE = 'session-flush-%s-%d'
+
+# How many times `flush_session` tries again if the session changes under it
+FLUSH_RETRIES = 5
+
+
+def _hash(session_data):
+    return md5(session_data).hexdigest()
+
+
 class SessionStore(DBStore):
 
     def __init__(self, session_key=None):
         super(SessionStore, self).__init__(session_key)
+        self._cached = None
 
     def load(self):
-        data = cache.get(self.session_key, None)
-        if data is None:
-            data = super(SessionStore, self).load()
-            cache.set(self.session_key, data, settings.SESSION_COOKIE_AGE)
-        return data
-    
+        def load_from_db():
+            s = self._get_live_session()
+            if s is None:
+                sessions.set(self._session_key, NO_SESSION,
+                    NO_SESSION_TIMEOUT)
+                return None
+            try:
+                data = self.decode(force_unicode(s.session_data))
+            except SuspiciousOperation:
+                data = {}
+            return CachedSession(data, s.expire_date, _hash(s.session_data),
+                s.expire_date, time.time())
+
+        cached = sessions.get_or_set(
+            self._session_key, load_from_db, settings.SESSION_COOKIE_AGE)
+        if not isinstance(cached, CachedSession) or \
+                cached.expire_date <= datetime.datetime.now():
+            # Rather than creating a new session there and then, like the
+            # datastore backend, leave that to `save`
+            self._session_key = None
+            return {}
+
+        self._cached = cached
+        return cached.data
+
     def exists(self, session_key):
+        cached = sessions.get(session_key)
+        if cached is not None:
+            return cached != NO_SESSION
         return super(SessionStore, self).exists(session_key)
 
     def save(self, must_create=False):
-        super(SessionStore, self).save(must_create)
-        cache.set(self.session_key, self._session, settings.SESSION_COOKIE_AGE)
+        data = self._get_session(no_load=must_create)
+        if self._session_key is None and not must_create:
+            # It's new, see `load`
+            return self._save_new()
+
+        session_data = self.encode(data)
+        data_hash = _hash(session_data)
+        expire_date = self.get_expiry_date()
+        now = time.time()
+
+        last = self._cached
+        if must_create or last is None:
+            write = True
+        elif data_hash == last.saved_hash:
+            refresh = datetime.timedelta(seconds=getattr(
+                settings, 'SESSION_EXPIRY_REFRESH_INTERVAL', 0))
+            write = expire_date - last.saved_expire_date > refresh
+        else:
+            interval = getattr(settings, 'SESSION_WRITE_BACK_INTERVAL', 0)
+            write = not interval or now - last.saved_at >= interval
+
+        if write:
+            self._save_encoded(session_data, expire_date, must_create)
+            cached = CachedSession(data, expire_date, data_hash, expire_date,
+                now)
+        else:
+            cached = CachedSession(data, expire_date, last.saved_hash,
+                last.saved_expire_date, last.saved_at)
+            if data_hash != last.saved_hash:
+                self._queue_flush(now)
+
+        sessions.set(self.session_key, cached, settings.SESSION_COOKIE_AGE)
+        self._cached = cached
+
+    def _queue_flush(self, now):
+        "Queue a task to write this session back at the end of the interval"
+        interval = settings.SESSION_WRITE_BACK_INTERVAL
+        window = int(now // interval)
+        try:
+            taskqueue.add(
+                name=FLUSH_TASK_NAME_TEMPLATE % (self.session_key, window),
+                url=reverse('appengine_sessions:flush'),
+                params={'session_key': self.session_key},
+                countdown=(window + 1) * interval - now,
+            )
+        except (taskqueue.TaskAlreadyExistsError,
+                taskqueue.TombstonedTaskError):
+            # It's already queued for this interval
+            pass
 
     def delete(self, session_key=None):
+        if session_key is None:
+            session_key = self._session_key
+        if session_key is None:
+            return
+
         super(SessionStore, self).delete(session_key)
-        cache.delete(session_key or self.session_key)
+        sessions.delete(session_key)
+        if session_key == self._session_key:
+            self._cached = None
 
     def flush(self):
         self.clear()
         self.delete(self.session_key)
         self.create()
+
+
+def flush_session(session_key):
+    """Write the cached copy of the session with key `session_key` to the
+    datastore, if it's changed since it was last written there. Returns
+    whether it was written.
+    """
+    store = SessionStore(session_key)
+    written = False
+    try:
+        for _ in xrange(FLUSH_RETRIES):
+            cached = sessions.gets(session_key)
+            if not isinstance(cached, CachedSession):
+                # It's gone, or was just loaded from the datastore by `load`
+                return written
+
+            session_data = store.encode(cached.data)
+            data_hash = _hash(session_data)
+            if data_hash == cached.saved_hash:
+                return written
+
+            store._save_encoded(session_data, cached.expire_date)
+            written = True
+            saved = cached._replace(saved_hash=data_hash,
+                saved_expire_date=cached.expire_date, saved_at=time.time())
+            if sessions.cas(session_key, saved, settings.SESSION_COOKIE_AGE):
+                return written
+        return written
+    finally:
+        # Or the memcache client keeps the cas id of every session flushed
+        sessions.cas_reset()
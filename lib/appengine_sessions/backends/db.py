@@ -7,6 +7,9 @@ a look there for definitive docs.
 """
 
 import datetime
+import logging
+import time
+import uuid
 
 from google.appengine.ext import db
 
@@ -15,6 +18,25 @@ from django.contrib.sessions.backends.db import SessionStore as DBStore
 from django.core.exceptions import SuspiciousOperation
 from django.utils.encoding import force_unicode
 
+# How many times a datastore write is tried before giving up, and how long to
+# wait before the first retry (doubled for every one after it)
+MAX_ATTEMPTS = 3
+RETRY_DELAY = 0.1
+
+
+def _with_retry(func, attempts=MAX_ATTEMPTS, delay=RETRY_DELAY):
+    "Call `func`, backing off and retrying if the datastore times out"
+    for attempt in xrange(1, attempts + 1):
+        try:
+            return func()
+        except (db.Timeout, db.InternalError):
+            if attempt == attempts:
+                raise
+            logging.warning('Saving a session failed (attempt %d of %d), '
+                'retrying in %.1fs', attempt, attempts, delay, exc_info=True)
+            time.sleep(delay)
+            delay *= 2
+
 
 class SessionStore(DBStore):
     """Implements a session store using Appengine's datastore API instead
@@ -25,50 +47,79 @@ class SessionStore(DBStore):
         super(SessionStore, self).__init__(session_key)
 
     def load(self):
-        s = Session.get_by_key_name('session-%s' % self.session_key)
-
+        s = self._get_live_session()
         if s:
-            if s.expire_date > datetime.datetime.now():
-                try:
-                    return self.decode(force_unicode(s.session_data))
-                except SuspiciousOperation:
-                    return {}
+            try:
+                return self.decode(force_unicode(s.session_data))
+            except SuspiciousOperation:
+                return {}
         self.create()
         return {}
 
+    def _get_live_session(self):
+        """Get the Session entity for this session, or None if it doesn't
+        exist or has expired
+        """
+        s = Session.get_by_key_name('session-%s' % self.session_key)
+        if s and s.expire_date > datetime.datetime.now():
+            return s
+        return None
+
     def exists(self, session_key):
         s = Session.get_by_key_name('session-%s' % session_key)
         return s is not None
 
     def save(self, must_create=False):
-        """Create and save a Session object using db.run_in_transaction, with
-        key_name = 'session-%s' % session_key, raising CreateError if
-        unsuccessful.
+        """Save the session with key_name = 'session-%s' % session_key. A
+        session that has to be new is only created if there isn't one with its
+        key already, raising CreateError if there is.
         """
-        s = Session.get_by_key_name('session-%s' % self.session_key)
-        if must_create:
-            if s:
-                raise CreateError()
-
         session_data = self._get_session(no_load=must_create)
+        if self._session_key is None and not must_create:
+            return self._save_new()
+        self._save_encoded(
+            self.encode(session_data), self.get_expiry_date(), must_create)
+
+    def _save_new(self):
+        "Save a session that's never been saved under a new key that isn't taken"
+        while True:
+            self._session_key = self._get_new_session_key()
+            try:
+                return self.save(must_create=True)
+            except CreateError:
+                continue
+
+    def _get_new_session_key(self):
+        """A random key, without checking it isn't taken, since sessions with
+        new keys are only created by saving them with `must_create`
+        """
+        return uuid.uuid4().hex
+
+    def _save_encoded(self, session_data, expire_date, must_create=False):
+        """Save already encoded session data. A session that has to be new is
+        created with a transactional get-or-insert, anything else is just put.
+        """
+        key_name = 'session-%s' % self.session_key
+        s = Session(
+            key_name=key_name,
+            session_key=key_name,
+            session_data=session_data,
+            expire_date=expire_date
+        )
+        if not must_create:
+            _with_retry(s.put)
+            return
 
         def txn():
-            s = Session(
-                key_name='session-%s' % self.session_key,
-                session_key='session-%s' % self.session_key,
-                session_data=self.encode(session_data),
-                expire_date=self.get_expiry_date()
-            )
+            if Session.get_by_key_name(key_name) is not None:
+                raise CreateError()
             s.put()
 
-        # This is tricky and probably needs some sanity checking, because
-        # TransactionFailedError can be raised, but the transaction can still
-        # go on to be committed to the datastore. As far as I can see there's
-        # no way to manually roll it back at that point. No idea how to test
-        # this either.
+        # Failing to commit means another request was creating a session with
+        # the same key at the same time
         try:
-            db.run_in_transaction(txn)
-        except (db.TransactionFailedError, db.Rollback):
+            _with_retry(lambda: db.run_in_transaction(txn))
+        except db.TransactionFailedError:
             raise CreateError()
 
     def delete(self, session_key=None):
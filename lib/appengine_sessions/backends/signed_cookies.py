@@ -0,0 +1,143 @@
+""" Sessions kept in the session cookie itself, so that reading or saving one
+costs no RPCs at all.
+
+The cookie holds the pickled session data, compressed if that makes it
+smaller and `settings.SESSION_COOKIE_COMPRESS` is on, the time it was signed
+and an HMAC of both made with `settings.SECRET_KEY`. Cookies with a bad
+signature or older than `settings.SESSION_COOKIE_AGE` are ignored. Anyone with
+the secret key can forge sessions, which get unpickled, so it must stay secret.
+
+Sessions too big for a cookie of `settings.SESSION_COOKIE_MAX_SIZE` bytes are
+kept with the `cached_db` backend instead, and the cookie just holds its
+session key.
+"""
+import base64
+import cPickle as pickle
+import time
+import zlib
+
+from django.conf import settings
+from django.contrib.sessions.backends.base import SessionBase
+from django.utils.crypto import constant_time_compare, salted_hmac
+
+from appengine_sessions.backends.cached_db import SessionStore as CachedDBStore
+
+SALT = 'appengine_sessions.backends.signed_cookies'
+
+# What cookies holding the key of a `cached_db` session start with. Signed
+# cookies never contain a `!`.
+CACHED_DB_PREFIX = 'db!'
+
+# What compressed data starts with in a cookie
+COMPRESSED_PREFIX = '.'
+
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip('=')
+
+
+def _b64decode(data):
+    return base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+
+
+def _signature(value):
+    return salted_hmac(SALT, value).hexdigest()
+
+
+class SessionStore(SessionBase):
+
+    def __init__(self, session_key=None):
+        super(SessionStore, self).__init__(session_key)
+        # The `cached_db` session this one's kept in, if it's too big for a
+        # cookie
+        self._cached_db_store = None
+
+    def load(self):
+        session_key = self._session_key
+        if session_key.startswith(CACHED_DB_PREFIX):
+            cached_db_key = session_key[len(CACHED_DB_PREFIX):]
+            store = CachedDBStore(cached_db_key)
+            data = store.load()
+            if store._session_key == cached_db_key:
+                self._cached_db_store = store
+                return data
+        else:
+            data = self._unsign(session_key)
+            if data is not None:
+                return data
+
+        self.create()
+        return {}
+
+    def exists(self, session_key):
+        if session_key.startswith(CACHED_DB_PREFIX):
+            return CachedDBStore().exists(session_key[len(CACHED_DB_PREFIX):])
+        return self._unsign(session_key) is not None
+
+    def create(self):
+        "There's nothing to create until the session's saved into its cookie"
+        self._session_key = None
+        self._cached_db_store = None
+        self.modified = True
+
+    def save(self, must_create=False):
+        data = self._get_session(no_load=must_create)
+        cookie = self._sign(data)
+
+        if len(cookie) <= getattr(settings, 'SESSION_COOKIE_MAX_SIZE', 4000):
+            if self._cached_db_store is not None:
+                # It's small enough for a cookie again
+                self._cached_db_store.delete()
+                self._cached_db_store = None
+            self._session_key = cookie
+            return
+
+        store = self._cached_db_store
+        if store is None:
+            store = self._cached_db_store = CachedDBStore()
+        store._session_cache = data
+        store.save()
+        self._session_key = CACHED_DB_PREFIX + store.session_key
+
+    def delete(self, session_key=None):
+        if session_key is None:
+            session_key = self._session_key
+        if session_key is None:
+            return
+
+        if session_key.startswith(CACHED_DB_PREFIX):
+            CachedDBStore().delete(session_key[len(CACHED_DB_PREFIX):])
+        if session_key == self._session_key:
+            self._session_key = None
+            self._cached_db_store = None
+
+    def _sign(self, data):
+        payload = pickle.dumps(data, pickle.HIGHEST_PROTOCOL)
+        prefix = ''
+        if getattr(settings, 'SESSION_COOKIE_COMPRESS', True):
+            compressed = zlib.compress(payload)
+            if len(compressed) < len(payload):
+                payload = compressed
+                prefix = COMPRESSED_PREFIX
+
+        value = '%s%s:%d' % (prefix, _b64encode(payload), time.time())
+        return '%s:%s' % (value, _signature(value))
+
+    def _unsign(self, cookie):
+        "Get the session data in `cookie`, or None if it's invalid or expired"
+        try:
+            value, signature = cookie.rsplit(':', 1)
+            payload, signed_at = value.rsplit(':', 1)
+            signed_at = int(signed_at)
+        except ValueError:
+            return None
+        if not constant_time_compare(signature, _signature(value)):
+            return None
+        if time.time() - signed_at > settings.SESSION_COOKIE_AGE:
+            return None
+
+        compressed = payload.startswith(COMPRESSED_PREFIX)
+        payload = _b64decode(payload.lstrip(COMPRESSED_PREFIX))
+        if compressed:
+            payload = zlib.decompress(payload)
+        return pickle.loads(payload)
@@ -0,0 +1,215 @@
+"""
+Benchmark of the `db` and `cached_db` session backends behind
+`SessionMiddleware`, with in-process stand-ins for the datastore, memcache and
+the task queue. Each scenario's requests are handled on a pool of threads, as
+concurrent clients would be, and for each it reports how many RPCs of every
+kind a request made, the 50th and 99th percentile request times and how many
+requests a second were handled.
+
+Run it with the same environment as the tests, e.g.:
+
+    PYTHONPATH=.:/usr/local/google_appengine:./lib \\
+        DJANGO_SETTINGS_MODULE=settings python -m appengine_sessions.benchmark
+"""
+import datetime
+import sys
+import time
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+from optparse import OptionParser
+
+from django.conf import settings
+from django.http import HttpResponse
+
+from appenginecache import backend
+from appenginecache.fakes import FakeMemcache
+from appenginecache.namespaces import Namespace
+
+from appengine_sessions import middleware
+from appengine_sessions.backends import cached_db
+from appengine_sessions.backends import db as db_backend
+from appengine_sessions.fakes import FakeDatastore, FakeTaskQueue
+
+
+BACKENDS = (
+    ('db', db_backend),
+    ('cached_db', cached_db),
+)
+
+
+class FakeRequest(object):
+    def __init__(self, session_key=None):
+        self.COOKIES = {}
+        if session_key is not None:
+            self.COOKIES[settings.SESSION_COOKIE_NAME] = session_key
+
+
+class StandIns(object):
+    "The stand-ins a benchmark's run against, and what they've been asked"
+
+    def __init__(self, latency):
+        self.datastore = FakeDatastore(latency)
+        self.memcache = FakeMemcache(latency)
+        self.taskqueue = FakeTaskQueue(latency)
+
+    def reset(self):
+        for fake in (self.datastore, self.memcache, self.taskqueue):
+            fake.calls.clear()
+
+    def get_calls(self):
+        calls = {}
+        for prefix, fake in (('db', self.datastore), ('memcache', self.memcache),
+                ('taskqueue', self.taskqueue)):
+            for name, count in fake.calls.items():
+                calls['%s.%s' % (prefix, name)] = count
+        return calls
+
+
+@contextmanager
+def stand_ins(latency=0):
+    """Point the session backends at fresh stand-ins for the datastore,
+    memcache and task queue, for as long as the block runs
+    """
+    fakes = StandIns(latency)
+    originals = (db_backend.db, db_backend.Session, backend.memcache,
+        cached_db.sessions, cached_db.taskqueue)
+    try:
+        db_backend.db = fakes.datastore
+        db_backend.Session = fakes.datastore.model('Session')
+        backend.memcache = fakes.memcache
+        cached_db.sessions = Namespace(
+            backend.CacheClass(None, settings.CACHES['default']), 'sessions')
+        cached_db.taskqueue = fakes.taskqueue
+        yield fakes
+    finally:
+        (db_backend.db, db_backend.Session, backend.memcache,
+            cached_db.sessions, cached_db.taskqueue) = originals
+
+
+def make_sessions(engine, count, expired=False):
+    "Save `count` sessions and return their keys"
+    keys = []
+    for i in xrange(count):
+        session = engine.SessionStore()
+        session['user_id'] = i
+        if expired:
+            session.set_expiry(datetime.datetime.now() -
+                datetime.timedelta(days=1))
+        session.save()
+        keys.append(session.session_key)
+    return keys
+
+
+def new_session(engine, requests, clients):
+    "Requests without a cookie that store something in a new session"
+    def view(request):
+        request.session['user_id'] = 1
+    return [None] * requests, view
+
+
+def read_only(engine, requests, clients):
+    "Requests that read their session but leave it as it is"
+    keys = make_sessions(engine, clients)
+    def view(request):
+        request.session.get('user_id')
+    return [keys[i % clients] for i in xrange(requests)], view
+
+
+def modified(engine, requests, clients):
+    "Requests that change their session"
+    keys = make_sessions(engine, clients)
+    def view(request):
+        request.session['last_visit'] = time.time()
+    return [keys[i % clients] for i in xrange(requests)], view
+
+
+def expired_cookie(engine, requests, clients):
+    "Requests with a cookie for a session that's expired, that only read it"
+    keys = make_sessions(engine, clients, expired=True)
+    def view(request):
+        request.session.get('user_id')
+    return [keys[i % clients] for i in xrange(requests)], view
+
+
+SCENARIOS = (
+    ('new session', new_session),
+    ('read-only', read_only),
+    ('modified', modified),
+    ('expired cookie', expired_cookie),
+)
+
+
+def percentile(times, percent):
+    "The `percent`th percentile of the sorted list `times`"
+    return times[int(round((len(times) - 1) * percent / 100.0))]
+
+
+def run_scenario(engine, scenario, requests, threads, latency):
+    """Handle `requests` requests for `scenario` through `SessionMiddleware`
+    with the session backend `engine`, on `threads` threads. Returns a dict of
+    `seconds`, `per_sec`, `p50_ms`, `p99_ms` and `rpcs`, a dict of RPCs per
+    request by name.
+    """
+    with stand_ins(latency) as fakes:
+        session_middleware = middleware.SessionMiddleware()
+        session_middleware.engine = engine
+        cookies, view = scenario(engine, requests, threads)
+        fakes.reset()
+
+        def handle(session_key):
+            started = time.time()
+            request = FakeRequest(session_key)
+            session_middleware.process_request(request)
+            view(request)
+            session_middleware.process_response(request, HttpResponse())
+            return time.time() - started
+
+        pool = ThreadPool(threads)
+        started = time.time()
+        try:
+            times = sorted(pool.map(handle, cookies))
+        finally:
+            pool.close()
+        seconds = time.time() - started
+
+        return {
+            'seconds': seconds,
+            'per_sec': requests / max(seconds, 0.001),
+            'p50_ms': percentile(times, 50) * 1000,
+            'p99_ms': percentile(times, 99) * 1000,
+            'rpcs': dict((name, float(count) / requests)
+                for name, count in fakes.get_calls().items()),
+        }
+
+
+def run(requests=200, threads=10, latency=0.001, out=sys.stdout):
+    """Run every scenario against every backend, writing a line of results for
+    each, and return the results as `{(backend, scenario): results}`
+    """
+    results = {}
+    for backend_name, engine in BACKENDS:
+        for name, scenario in SCENARIOS:
+            result = run_scenario(engine, scenario, requests, threads, latency)
+            results[(backend_name, name)] = result
+            out.write('%-10s %-15s %8.1f req/sec  p50 %6.1fms  p99 %6.1fms  '
+                '%5.2f rpcs/req  %s\n' % (backend_name, name,
+                result['per_sec'], result['p50_ms'], result['p99_ms'],
+                sum(result['rpcs'].values()), ' '.join('%s=%.2f' % item
+                    for item in sorted(result['rpcs'].items()))))
+    return results
+
+
+def main(argv=None):
+    parser = OptionParser()
+    parser.add_option('-r', '--requests', type='int', default=200,
+        help="Requests per scenario")
+    parser.add_option('-t', '--threads', type='int', default=10,
+        help="Concurrent clients")
+    parser.add_option('-l', '--latency', type='float', default=0.001,
+        help="Seconds every fake RPC takes")
+    opts, _ = parser.parse_args(argv)
+    run(opts.requests, opts.threads, opts.latency)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+# Local stand-ins for the bits of the datastore and task queue APIs the session
+# backends use, for benchmarking them
+
+import copy
+import threading
+import time
+from collections import Counter
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import db
+
+
+class FakeKey(object):
+    "Stands in for `db.Key`, which the backends only build from paths"
+
+    @staticmethod
+    def from_path(kind, name):
+        return (kind, name)
+
+
+class FakeDatastore(object):
+    """A thread-safe, in-process stand-in for `google.appengine.ext.db`, with
+    just what the session backends use: models with key names, `delete`,
+    `Key.from_path` and `run_in_transaction`. Every RPC the real thing would
+    make is counted in `calls`, and can be made to take `latency` seconds.
+
+    Transactions are run one at a time rather than optimistically, so they
+    never fail.
+    """
+    Key = FakeKey
+    Timeout = db.Timeout
+    InternalError = db.InternalError
+    TransactionFailedError = db.TransactionFailedError
+    Rollback = db.Rollback
+
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.calls = Counter()
+        self._entities = {}
+        self._lock = threading.RLock()
+
+    def _call(self, name):
+        self.calls[name] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def model(self, kind):
+        "A stand-in for a `db.Model` subclass of kind `kind`"
+        datastore = self
+
+        class FakeModel(object):
+
+            def __init__(self, key_name=None, **values):
+                self._key = (kind, key_name)
+                self.__dict__.update(values)
+
+            @classmethod
+            def get_by_key_name(cls, key_name):
+                return datastore.get((kind, key_name))
+
+            def key(self):
+                return self._key
+
+            def put(self):
+                datastore.put(self)
+                return self._key
+
+            def delete(self):
+                datastore.delete(self._key)
+
+        FakeModel.__name__ = kind
+        return FakeModel
+
+    def get(self, key):
+        self._call('get')
+        with self._lock:
+            entity = self._entities.get(key)
+        return copy.copy(entity)
+
+    def put(self, entity):
+        self._call('put')
+        with self._lock:
+            self._entities[entity.key()] = copy.copy(entity)
+
+    def delete(self, key):
+        self._call('delete')
+        with self._lock:
+            self._entities.pop(key, None)
+
+    def run_in_transaction(self, func, *args, **kwargs):
+        self._call('begin_transaction')
+        with self._lock:
+            result = func(*args, **kwargs)
+        self._call('commit')
+        return result
+
+
+class FakeTaskQueue(object):
+    """Stands in for `google.appengine.api.taskqueue`, counting the tasks added
+    and refusing names that have already been used, but never running them
+    """
+    TaskAlreadyExistsError = taskqueue.TaskAlreadyExistsError
+    TombstonedTaskError = taskqueue.TombstonedTaskError
+
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.calls = Counter()
+        self._names = set()
+        self._lock = threading.Lock()
+
+    def add(self, name=None, **kwargs):
+        self.calls['add'] += 1
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            if name in self._names:
+                raise self.TaskAlreadyExistsError(name)
+            if name is not None:
+                self._names.add(name)
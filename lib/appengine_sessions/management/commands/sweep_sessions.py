@@ -0,0 +1,25 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from appengine_sessions.sweeper import BATCH_SIZE, sweep_expired_sessions
+
+
+class Command(BaseCommand):
+    help = "Delete every expired session from the datastore, resuming from " \
+        "the last checkpoint"
+
+    option_list = BaseCommand.option_list + (
+        make_option('-b', '--batch-size', dest='batch_size', type='int',
+            default=BATCH_SIZE),
+        make_option('-r', '--restart', dest='restart', action='store_true',
+            default=False, help="Ignore any checkpoint and start again"),
+    )
+
+    def handle(self, *args, **opts):
+        stats = sweep_expired_sessions(
+            batch_size=opts['batch_size'],
+            restart=opts['restart'],
+        )
+        return 'Deleted %(deleted)d expired sessions (%(total)d in total) at ' \
+            '%(sessions_per_sec).1f sessions/sec\n' % stats
@@ -6,10 +6,13 @@ from django.utils.http import cookie_date
 from django.utils.importlib import import_module
 
 class SessionMiddleware(object):
+    def __init__(self):
+        # Imported once when the middleware's loaded, not on every request
+        self.engine = import_module(settings.SESSION_ENGINE)
+
     def process_request(self, request):
-        engine = import_module(settings.SESSION_ENGINE)
         session_key = request.COOKIES.get(settings.SESSION_COOKIE_NAME, None)
-        request.session = engine.SessionStore(session_key)
+        request.session = self.engine.SessionStore(session_key)
 
     def process_response(self, request, response):
         """
@@ -10,5 +10,15 @@ class Session(db.Model):
         return SessionStore().decode(self.session_data)
 
 
+class SweepCheckpoint(db.Model):
+    """How far a sweep of expired sessions has got, so that an interrupted one
+    can carry on where it stopped. The cursor is only good for the query it came
+    from, so the cutoff that query used is kept with it.
+    """
+    cutoff = db.DateTimeProperty()
+    cursor = db.TextProperty()
+    deleted = db.IntegerProperty(default=0)
+
+
 # At the bottom to win against circular imports
 from appengine_sessions.backends.db import SessionStore
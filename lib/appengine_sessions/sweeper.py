@@ -0,0 +1,149 @@
+"""
+Deleting expired sessions from the datastore.
+
+Loading a session ignores one that's expired but leaves it where it is, so
+they're swept up in the background instead. Expired sessions are found with a
+keys-only query on `expire_date`, which has a built-in single property index,
+and deleted a batch at a time, so nothing but keys is ever fetched.
+
+The query's cursor is checkpointed in the datastore after every batch, so a
+sweep that dies or runs out of time carries on from where it stopped the next
+time one's started. The checkpoint is moved on in a transaction that checks
+nobody else has moved it first, so sweeps running at the same time on
+different instances don't fight: whichever falls behind stops. At worst they
+both delete the same batch once, which is harmless.
+"""
+import datetime
+import logging
+import time
+
+from google.appengine.ext import db
+
+from django.conf import settings
+
+from appengine_sessions.models import Session, SweepCheckpoint
+
+
+CHECKPOINT_NAME = 'sessions'
+
+# Sessions deleted per batch, the most `db.delete` takes in one call
+BATCH_SIZE = 500
+
+
+def get_cutoff(now=None):
+    """The expiry date sessions have to be older than to be swept. The
+    `cached_db` backend can leave the expiry date in the datastore out of date
+    by up to the refresh and write-back intervals, so it allows for both.
+    """
+    grace = getattr(settings, 'SESSION_EXPIRY_REFRESH_INTERVAL', 0) + \
+        getattr(settings, 'SESSION_WRITE_BACK_INTERVAL', 0)
+    return (now or datetime.datetime.now()) - \
+        datetime.timedelta(seconds=grace)
+
+
+def iter_expired_batches(cutoff, cursor=None, batch_size=BATCH_SIZE):
+    """Yields `(keys, cursor)` for every batch of `batch_size` keys of
+    sessions that expired before `cutoff`, after `cursor`, where the yielded
+    cursor points to just after the batch
+    """
+    while True:
+        query = Session.all(keys_only=True).filter('expire_date <', cutoff)
+        if cursor:
+            query.with_cursor(cursor)
+        keys = query.fetch(batch_size)
+        if not keys:
+            return
+
+        cursor = query.cursor()
+        yield keys, cursor
+
+        if len(keys) < batch_size:
+            return
+
+
+def _start(restart):
+    "Get the checkpoint to carry on from, starting a new sweep if need be"
+    checkpoint = SweepCheckpoint.get_by_key_name(CHECKPOINT_NAME)
+    if checkpoint is None or restart:
+        checkpoint = SweepCheckpoint(key_name=CHECKPOINT_NAME,
+            cutoff=get_cutoff())
+        checkpoint.put()
+    return checkpoint
+
+
+def _advance(checkpoint, cursor, deleted):
+    """Move `checkpoint` on to `cursor`, if it's still where it was when it was
+    read. Returns the updated checkpoint, or None if another sweep has moved
+    or finished it since.
+    """
+    def txn():
+        current = SweepCheckpoint.get_by_key_name(CHECKPOINT_NAME)
+        if current is None or (current.cutoff, current.cursor) != \
+                (checkpoint.cutoff, checkpoint.cursor):
+            return None
+        current.cursor = cursor
+        current.deleted += deleted
+        current.put()
+        return current
+    return db.run_in_transaction(txn)
+
+
+def _finish(checkpoint):
+    "Delete `checkpoint`, unless another sweep has moved it since"
+    def txn():
+        current = SweepCheckpoint.get_by_key_name(CHECKPOINT_NAME)
+        if current is not None and (current.cutoff, current.cursor) == \
+                (checkpoint.cutoff, checkpoint.cursor):
+            current.delete()
+    db.run_in_transaction(txn)
+
+
+def sweep_expired_sessions(batch_size=BATCH_SIZE, time_limit=None,
+        restart=False):
+    """Delete every session that's expired from the datastore, resuming from
+    the last checkpoint unless `restart` is `True`. If `time_limit` is given no
+    new batch is started once that many seconds have passed.
+
+    Returns a dict of `deleted` (this run), `total` (since the sweep
+    started), `done`, `overtaken` (if another sweep has carried on from here
+    instead) and `sessions_per_sec`.
+    """
+    checkpoint = _start(restart)
+    started = time.time()
+    deleted = 0
+    done = True
+    overtaken = False
+
+    for keys, cursor in iter_expired_batches(
+            checkpoint.cutoff, checkpoint.cursor, batch_size):
+        db.delete(keys)
+        deleted += len(keys)
+
+        advanced = _advance(checkpoint, cursor, len(keys))
+        if advanced is None:
+            logging.info('Another sweep has overtaken this one, stopping')
+            done = False
+            overtaken = True
+            break
+        checkpoint = advanced
+
+        elapsed = time.time() - started
+        logging.info('Deleted %d expired sessions (%d in total), '
+            '%.1f sessions/sec', deleted, checkpoint.deleted,
+            deleted / max(elapsed, 0.001))
+
+        if time_limit is not None and elapsed > time_limit:
+            done = False
+            break
+
+    if done:
+        _finish(checkpoint)
+
+    elapsed = time.time() - started
+    return {
+        'deleted': deleted,
+        'total': checkpoint.deleted,
+        'done': done,
+        'overtaken': overtaken,
+        'sessions_per_sec': deleted / max(elapsed, 0.001),
+    }
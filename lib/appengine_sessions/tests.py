@@ -1,15 +1,27 @@
 import base64
+import os
 from datetime import datetime, timedelta
 import pickle
+import time
 import unittest
+from StringIO import StringIO
 
 from google.appengine.ext import testbed
 
 from appengine_sessions.backends.db import SessionStore as DatabaseSession
 from appengine_sessions.backends.cached_db import SessionStore as CacheDBSession
-from appengine_sessions.models import Session
+from appengine_sessions.backends.cached_db import (NO_SESSION,
+    flush_session, sessions)
+from appengine_sessions.backends.signed_cookies import (CACHED_DB_PREFIX,
+    SessionStore as SignedCookieSession)
+from appengine_sessions.models import Session, SweepCheckpoint
+from appengine_sessions import benchmark, sweeper
+from appengine_sessions.sweeper import (CHECKPOINT_NAME,
+    sweep_expired_sessions)
 from appengine_sessions.middleware import SessionMiddleware
 from django.conf import settings
+from django.core.cache import cache
+from django.contrib.sessions.backends.base import CreateError
 from django.http import HttpResponse
 from django.utils.hashcompat import md5_constructor
 
@@ -26,6 +38,8 @@ class SessionTestsMixin(object):
         self.testbed.activate()
         self.testbed.init_datastore_v3_stub()
         self.testbed.init_memcache_stub()
+        self.testbed.init_taskqueue_stub()
+        cache.clear_local()
         self.session = self.backend()
         for s in Session.all():
             s.delete()
@@ -294,11 +308,254 @@ class DatabaseSessionTests(SessionTestsMixin, unittest.TestCase):
 
         s = Session.get_by_key_name('session-%s' % self.session.session_key)
 
+    def test_must_create(self):
+        self.session['x'] = 1
+        self.session.save()
+        session = self.backend(self.session.session_key)
+        session['x'] = 2
+        self.assertRaises(CreateError, session.save, must_create=True)
+        self.assertEqual(self.backend(self.session.session_key)['x'], 1)
+
 
 class CacheDBSessionTests(SessionTestsMixin, unittest.TestCase):
 
     backend = CacheDBSession
 
+    def test_invalidated_sessions_reload(self):
+        self.session['x'] = 1
+        self.session.save()
+        sessions.invalidate()
+        self.assertEqual(sessions.get(self.session.session_key), None)
+        session = self.backend(self.session.session_key)
+        self.assertEqual(session['x'], 1)
+
+    def test_hits_skip_the_datastore(self):
+        self.session['x'] = 1
+        self.session.save()
+        Session.get_by_key_name('session-%s' % self.session.session_key
+            ).delete()
+        session = self.backend(self.session.session_key)
+        self.assertEqual(session['x'], 1)
+
+    def test_unknown_keys_are_cached(self):
+        session = self.backend('unknown')
+        self.assertEqual(session.get('x'), None)
+        self.assertFalse(session.modified)
+        self.assertEqual(sessions.get('unknown'), NO_SESSION)
+        self.assertFalse(session.exists('unknown'))
+
+        DatabaseSession('unknown')._save_encoded(
+            self.session.encode({'x': 1}), datetime.now() + timedelta(days=1))
+        self.assertEqual(self.backend('unknown').get('x'), None)
+        sessions.delete('unknown')
+
+    def test_unknown_keys_get_a_new_key_when_saved(self):
+        session = self.backend('unknown')
+        session['x'] = 1
+        session.save()
+        self.assertNotEqual(session.session_key, 'unknown')
+        self.assertEqual(self.backend(session.session_key)['x'], 1)
+        session.delete()
+        sessions.delete('unknown')
+
+
+class WriteBackSessionTests(unittest.TestCase):
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub()
+        self.testbed.init_memcache_stub()
+        self.testbed.init_taskqueue_stub()
+        cache.clear_local()
+        self.taskqueue = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+        self.old_settings = (settings.SESSION_WRITE_BACK_INTERVAL,
+            settings.SESSION_EXPIRY_REFRESH_INTERVAL)
+        settings.SESSION_WRITE_BACK_INTERVAL = 60
+        settings.SESSION_EXPIRY_REFRESH_INTERVAL = 60 * 60
+
+        self.session = CacheDBSession()
+        self.session['x'] = 1
+        self.session.save()
+        self.key = self.session.session_key
+
+    def tearDown(self):
+        (settings.SESSION_WRITE_BACK_INTERVAL,
+            settings.SESSION_EXPIRY_REFRESH_INTERVAL) = self.old_settings
+        self.testbed.deactivate()
+
+    def get_stored(self):
+        s = Session.get_by_key_name('session-%s' % self.key)
+        return s.get_decoded(), s.expire_date
+
+    def test_new_sessions_are_written(self):
+        self.assertEqual(self.get_stored()[0], {'x': 1})
+
+    def test_unchanged_sessions_are_not_written(self):
+        stored = self.get_stored()
+        session = CacheDBSession(self.key)
+        session['x'] = 1
+        session.save()
+        self.assertEqual(self.get_stored(), stored)
+        self.assertEqual(self.taskqueue.get_filtered_tasks(), [])
+
+    def test_stale_expiry_dates_are_refreshed(self):
+        settings.SESSION_EXPIRY_REFRESH_INTERVAL = 0
+        stored = self.get_stored()
+        time.sleep(0.01)
+        session = CacheDBSession(self.key)
+        session['x'] = 1
+        session.save()
+        self.assertTrue(self.get_stored()[1] > stored[1])
+
+    def test_changes_are_written_back(self):
+        session = CacheDBSession(self.key)
+        session['x'] = 2
+        session.save()
+        session = CacheDBSession(self.key)
+        session['x'] = 3
+        session.save()
+
+        self.assertEqual(self.get_stored()[0], {'x': 1})
+        self.assertEqual(CacheDBSession(self.key)['x'], 3)
+        self.assertEqual(len(self.taskqueue.get_filtered_tasks()), 1)
+
+        self.assertTrue(flush_session(self.key))
+        self.assertEqual(self.get_stored()[0], {'x': 3})
+        self.assertFalse(flush_session(self.key))
+
+
+class SweeperTests(unittest.TestCase):
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub()
+        self.testbed.init_memcache_stub()
+        now = datetime.now()
+        for i in xrange(5):
+            DatabaseSession('expired%d' % i)._save_encoded(
+                'x', now - timedelta(days=1))
+        DatabaseSession('live')._save_encoded('x', now + timedelta(days=1))
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def get_keys(self):
+        return sorted(s.session_key for s in Session.all())
+
+    def test_sweep(self):
+        stats = sweep_expired_sessions(batch_size=2)
+        self.assertEqual(stats['deleted'], 5)
+        self.assertTrue(stats['done'])
+        self.assertEqual(self.get_keys(), ['session-live'])
+        self.assertEqual(SweepCheckpoint.get_by_key_name(CHECKPOINT_NAME),
+            None)
+
+    def test_resume(self):
+        stats = sweep_expired_sessions(batch_size=2, time_limit=0)
+        self.assertEqual(stats['deleted'], 2)
+        self.assertFalse(stats['done'])
+
+        stats = sweep_expired_sessions(batch_size=2)
+        self.assertEqual((stats['deleted'], stats['total']), (3, 5))
+        self.assertEqual(self.get_keys(), ['session-live'])
+
+    def test_overtaken(self):
+        # Another sweep finishes while this one's deleting its first batch
+        delete = sweeper.db.delete
+        def delete_and_sweep(keys):
+            delete(keys)
+            sweeper.db.delete = delete
+            self.assertTrue(sweep_expired_sessions(batch_size=2)['done'])
+        sweeper.db.delete = delete_and_sweep
+        try:
+            stats = sweep_expired_sessions(batch_size=2)
+        finally:
+            sweeper.db.delete = delete
+        self.assertTrue(stats['overtaken'])
+        self.assertEqual(stats['deleted'], 2)
+        self.assertEqual(self.get_keys(), ['session-live'])
+
+    def test_grace_period(self):
+        old_interval = settings.SESSION_EXPIRY_REFRESH_INTERVAL
+        settings.SESSION_EXPIRY_REFRESH_INTERVAL = 2 * 24 * 60 * 60
+        try:
+            self.assertEqual(sweep_expired_sessions()['deleted'], 0)
+        finally:
+            settings.SESSION_EXPIRY_REFRESH_INTERVAL = old_interval
+
+
+class SignedCookieSessionTests(SessionTestsMixin, unittest.TestCase):
+
+    backend = SignedCookieSession
+
+    def test_save(self):
+        self.session['x'] = 1
+        self.session.save()
+        session = self.backend(self.session.session_key)
+        self.assertEqual(session['x'], 1)
+        self.assertFalse(session.modified)
+
+    def test_flush(self):
+        # A cookie can't be revoked, so it still exists once flushed
+        self.session['foo'] = 'bar'
+        self.session.save()
+        prev_key = self.session.session_key
+        self.session.flush()
+        self.assertNotEqual(self.session.session_key, prev_key)
+        self.assertEqual(self.session.items(), [])
+        self.assertTrue(self.session.modified)
+
+    def test_tampered(self):
+        self.session['x'] = 1
+        self.session.save()
+        session = self.backend(self.session.session_key.replace(':', ':1', 1))
+        self.assertEqual(session.get('x'), None)
+        self.assertTrue(session.modified)
+
+    def test_expired(self):
+        self.session['x'] = 1
+        self.session.save()
+        old_age = settings.SESSION_COOKIE_AGE
+        settings.SESSION_COOKIE_AGE = -1
+        try:
+            session = self.backend(self.session.session_key)
+            self.assertEqual(session.get('x'), None)
+        finally:
+            settings.SESSION_COOKIE_AGE = old_age
+
+    def test_compressed(self):
+        self.session['x'] = 'x' * 1000
+        self.session.save()
+        self.assertTrue(len(self.session.session_key) < 200)
+
+    def test_too_big_for_a_cookie(self):
+        self.session['x'] = base64.b64encode(os.urandom(4000))
+        self.session.save()
+        key = self.session.session_key
+        self.assertTrue(key.startswith(CACHED_DB_PREFIX))
+
+        session = self.backend(key)
+        self.assertEqual(session['x'], self.session['x'])
+        session['x'] = 'small'
+        session.save()
+        self.assertFalse(session.session_key.startswith(CACHED_DB_PREFIX))
+        self.assertFalse(session.exists(key))
+
+
+class BenchmarkTests(unittest.TestCase):
+
+    def test_benchmark(self):
+        out = StringIO()
+        results = benchmark.run(requests=4, threads=2, latency=0, out=out)
+        self.assertEqual(len(out.getvalue().splitlines()),
+            len(benchmark.BACKENDS) * len(benchmark.SCENARIOS))
+        # Reading a cached session never touches the datastore
+        rpcs = results[('cached_db', 'read-only')]['rpcs']
+        self.assertEqual([name for name in rpcs if name.startswith('db.')],
+            [])
+
 
 class FakeRequest(object):
     def __init__(self):
@@ -310,6 +567,7 @@ class SessionMiddlewareTests(unittest.TestCase):
         self.testbed.activate()
         self.testbed.init_datastore_v3_stub()
         self.testbed.init_memcache_stub()
+        cache.clear_local()
         self.old_SESSION_COOKIE_SECURE = settings.SESSION_COOKIE_SECURE
 
     def tearDown(self):
@@ -0,0 +1,7 @@
+from django.conf.urls.defaults import patterns, url
+
+urlpatterns = patterns(
+    'appengine_sessions',
+    url(r'^_flush/$', 'views.flush', {}, name='flush'),
+    url(r'^_sweep/$', 'views.sweep', {}, name='sweep'),
+)
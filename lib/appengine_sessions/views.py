@@ -0,0 +1,45 @@
+from google.appengine.api import taskqueue
+
+from django.core.urlresolvers import reverse
+from django.http import (HttpResponse, HttpResponseBadRequest,
+    HttpResponseForbidden)
+from django.views.decorators.csrf import csrf_exempt
+
+from appengine_sessions.backends.cached_db import flush_session
+from appengine_sessions.sweeper import sweep_expired_sessions
+
+
+# Seconds a single `sweep` request spends deleting sessions before handing over
+# to a task, comfortably inside the request deadline
+SWEEP_TIME_LIMIT = 30
+
+
+@csrf_exempt
+def flush(request):
+    "Task handler for writing back sessions queued by the `cached_db` backend"
+    if 'HTTP_X_APPENGINE_QUEUENAME' not in request.META:
+        return HttpResponseForbidden()
+
+    session_key = request.POST.get('session_key')
+    if not session_key:
+        return HttpResponseBadRequest()
+
+    return HttpResponse('Flushed' if flush_session(session_key) else 'Clean')
+
+
+def sweep(request):
+    """Cron and task handler for deleting expired sessions. Runs for at most
+    `SWEEP_TIME_LIMIT` seconds and then queues a task to carry on from the
+    checkpoint if there are sessions left.
+    """
+    if not ('HTTP_X_APPENGINE_CRON' in request.META or
+            'HTTP_X_APPENGINE_QUEUENAME' in request.META):
+        return HttpResponseForbidden()
+
+    stats = sweep_expired_sessions(time_limit=SWEEP_TIME_LIMIT)
+    if not (stats['done'] or stats['overtaken']):
+        taskqueue.add(url=reverse('appengine_sessions:sweep'), method='GET')
+
+    return HttpResponse(
+        'Deleted %(deleted)d (%(total)d in total) at %(sessions_per_sec).1f '
+        'sessions/sec, done: %(done)s' % stats)
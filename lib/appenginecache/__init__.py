@@ -0,0 +1,3 @@
+# Custom cache backend uses AppEngine's memcached, see `backend`
+
+from appenginecache.backend import CacheClass
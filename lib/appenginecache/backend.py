@@ -0,0 +1,590 @@
+# Custom cache backend uses AppEngine's memcached, with a small in-process
+# tier in front of it for hot keys
+
+# Counters use memcache's atomic incr/decr and optimistic updates use its
+# compare and set, see:
+# http://code.google.com/appengine/docs/python/memcache/overview.html
+# `appenginecache.loadtest` hammers them with concurrent clients.
+
+# Big values are compressed, and ones still too big for a single memcache item
+# are split over several keys, see `CacheClass._pack`.
+
+import math
+import random
+import threading
+import time
+import uuid
+import zlib
+from collections import namedtuple
+
+from django.core.cache.backends.base import BaseCache, InvalidCacheBackendError
+from django.utils.encoding import smart_str
+from google.appengine.api import memcache
+
+from appenginecache import serializers
+from appenginecache.local import LocalMemoryCache
+from appenginecache.metrics import LOCAL_GET, InstrumentedMemcache, Metrics
+from appenginecache.namespaces import Namespace
+
+
+# What's stored locally to remember that memcache doesn't have a key.
+# Serialized values always start with their serializer's tag, so this can't be
+# mistaken for one.
+MISSING = ''
+
+STATS = ('local_hits', 'local_misses', 'memcache_hits', 'memcache_misses',
+    'cas_conflicts', 'lease_waits', 'early_refreshes', 'compressed_sets',
+    'chunked_sets', 'chunk_misses', 'raw_bytes', 'stored_bytes',
+    'large_sets', 'large_set_seconds', 'large_gets', 'large_get_seconds')
+
+# Memcache won't store items over 1MB, key and overhead included
+MAX_CHUNK_SIZE = 1000 * 1000
+
+CHUNK_KEY_TEMPLATE = '%s:chunk:%s:%d'
+
+# Suffix of the key that whoever's filling a missing key in `get_or_set`
+# holds, so that everyone else waits for them instead of filling it too
+LEASE_SUFFIX = ':lease'
+
+# What `get_or_set` stores: the value, how many seconds it took to compute and
+# when it expires (or `None` if it doesn't)
+Computed = namedtuple('Computed', 'value delta expires')
+
+# Everything but integers is stored in memcache as a string, so that memcache
+# never pickles it again, starting with a header byte of these flags: its
+# tagged serialization if `SERIALIZED` (or else the string itself), zlib
+# compressed if `COMPRESSED`. If `CHUNKED` the rest is `token:count` instead,
+# for a value split into `count` chunks, which are stored under keys made with
+# `CHUNK_KEY_TEMPLATE` and a `token` unique to each write, so that the chunks
+# of different writes can never be mixed up
+SERIALIZED = 1
+COMPRESSED = 2
+CHUNKED = 4
+
+
+class CacheClass(BaseCache):
+    """Values are looked up in a local, in-process LRU before memcache, which
+    saves an RPC for keys that are read over and over. Writes through this
+    instance update both tiers, but a value changed by another instance can be
+    served stale from here for up to `LOCAL_TIMEOUT` seconds.
+
+    Configured with the cache's `OPTIONS`:
+
+        LOCAL_MAX_ENTRIES: how many values are kept locally, 0 turns the local
+            tier off
+        LOCAL_MAX_BYTES: the most (serialized) bytes that are kept locally
+        LOCAL_TIMEOUT: the most seconds a value is kept locally for
+        NEGATIVE_TIMEOUT: how many seconds memcache misses are remembered
+            locally for, 0 to not remember them
+        SERIALIZER: what values are serialized with, one of `pickle`,
+            `marshal` or `compact`, or the dotted path of a serializer class,
+            see `appenginecache.serializers`
+        COMPRESS_THRESHOLD: values that serialize to at least this many bytes
+            are compressed, 0 to never compress
+        CHUNK_SIZE: values bigger than this many bytes once compressed are
+            split into chunks of this size
+        METRICS: whether to record latencies, hit ratios and sizes for each
+            key prefix, see `appenginecache.metrics`
+    """
+
+    def __init__(self, server, params):
+        super(CacheClass, self).__init__(params)
+        options = params.get('OPTIONS', {})
+
+        self.local_timeout = options.get('LOCAL_TIMEOUT', 3)
+        self.negative_timeout = options.get('NEGATIVE_TIMEOUT', 0)
+        max_entries = options.get('LOCAL_MAX_ENTRIES', 1000)
+        max_bytes = options.get('LOCAL_MAX_BYTES', 4 * 1024 * 1024)
+        self.serializer = serializers.get_serializer(
+            options.get('SERIALIZER', 'pickle'))
+        self.compress_threshold = options.get('COMPRESS_THRESHOLD', 10 * 1024)
+        self.chunk_size = min(options.get('CHUNK_SIZE', 950 * 1000),
+            MAX_CHUNK_SIZE)
+
+        self._local = None
+        if max_entries and self.local_timeout:
+            self._local = LocalMemoryCache(max_entries, max_bytes)
+
+        self._stats = dict.fromkeys(STATS, 0)
+        self._stats_lock = threading.Lock()
+
+        # Compare and set ids are kept by the client that did the `gets`, so
+        # each thread needs its own
+        self._clients = threading.local()
+
+        self.metrics = None
+        self._memcache = memcache
+        if options.get('METRICS'):
+            self.metrics = Metrics()
+            self._memcache = InstrumentedMemcache(memcache, self.metrics)
+
+
+    def add(self, key, value, timeout=0):
+        key = smart_str(key)
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        started = time.time()
+        stored, chunks = self._pack(key, value)
+        if chunks:
+            self._memcache.set_multi(mapping=chunks, time=timeout)
+        added = self._memcache.add(key=key, value=stored, time=timeout)
+        self._time_large([stored], 'set', started)
+        if added:
+            self._set_local(key, value, timeout)
+        else:
+            self._delete_local(key)
+        return added
+
+
+
+    def get(self, key, default=None):
+        val = self._get(smart_str(key))
+        if val is None:
+            return default
+        return self._unwrap(val)
+
+
+    def set(self, key, value, timeout=0):
+        key = smart_str(key)
+        started = time.time()
+        stored, chunks = self._pack(key, value)
+        if chunks:
+            chunks[key] = stored
+            self._memcache.set_multi(mapping=chunks, time=timeout)
+        else:
+            self._memcache.set(key=key, value=stored, time=timeout)
+        self._time_large([stored], 'set', started)
+        self._set_local(key, value, timeout)
+
+
+
+    def delete(self, key):
+        key = smart_str(key)
+        self._memcache.delete(key=key)
+        self._delete_local(key)
+
+
+    def get_many(self, keys):
+        results = {}
+        remote_keys = []
+        for key in map(smart_str, keys):
+            found, val = self._get_local(key)
+            if not found:
+                remote_keys.append(key)
+            elif val is not None:
+                results[key] = val
+
+        if remote_keys:
+            started = time.time()
+            stored = self._memcache.get_multi(keys=remote_keys)
+            remote = self._unpack_many(stored)
+            self._time_large(stored.values(), 'get', started)
+            for key in remote_keys:
+                if key in remote:
+                    self._count('memcache_hits')
+                    self._set_local(key, remote[key])
+                else:
+                    self._count('memcache_misses')
+                    self._set_local_missing(key)
+            results.update(remote)
+        return dict((key, self._unwrap(val)) for key, val in results.items())
+
+
+
+    def set_many(self, data, timeout=0):
+        started = time.time()
+        safe_data = {}
+        mapping = {}
+        chunk_keys = {}
+        for key, value in data.items():
+            key = smart_str(key)
+            if isinstance(value, unicode):
+                value = value.encode('utf-8')
+            safe_data[key] = value
+            mapping[key], chunks = self._pack(key, value)
+            mapping.update(chunks)
+            chunk_keys[key] = chunks.keys()
+        failed = set(self._memcache.set_multi(mapping=mapping, time=timeout))
+        self._time_large([mapping[key] for key in safe_data], 'set', started)
+
+        for key, value in safe_data.items():
+            if key in failed or failed.intersection(chunk_keys[key]):
+                self._delete_local(key)
+            else:
+                self._set_local(key, value, timeout)
+
+
+    def delete_many(self, keys):
+        keys = map(smart_str, keys)
+        self._memcache.delete_multi(keys=keys)
+        for key in keys:
+            self._delete_local(key)
+
+
+    def clear(self):
+        "Flush every key from memcache, not just those in one `namespace`"
+        self._memcache.flush_all()
+        self.clear_local()
+
+
+    def clear_local(self):
+        """Forget everything in this process's local tier, leaving memcache as
+        it is. For tests, which get a fresh memcache stub each time.
+        """
+        if self._local is not None:
+            self._local.clear()
+
+
+    def incr(self, key, delta=1):
+        "Atomically add `delta` to the integer at `key`, which has to exist"
+        key = smart_str(key)
+        val = self._memcache.incr(key, delta)
+        if val is None:
+            raise ValueError("Key '%s' not found" % key)
+        self._delete_local(key)
+        return val
+
+
+    def decr(self, key, delta=1):
+        """Atomically take `delta` from the integer at `key`, which has to
+        exist. Like memcache, this never goes below zero.
+        """
+        key = smart_str(key)
+        val = self._memcache.decr(key, delta)
+        if val is None:
+            raise ValueError("Key '%s' not found" % key)
+        self._delete_local(key)
+        return val
+
+
+    def gets(self, key, default=None):
+        """Get a value straight from memcache, ready for a `cas` of the same
+        key by the same thread
+        """
+        key = smart_str(key)
+        started = time.time()
+        stored = self._client().gets(key)
+        val = self._unpack_many({key: stored}).get(key)
+        self._time_large([stored], 'get', started)
+        if val is None:
+            return default
+        return self._unwrap(val)
+
+
+    def cas(self, key, value, timeout=0):
+        """Set `key` to `value` only if it hasn't changed since this thread's
+        last `gets` of it. Returns whether it was set.
+        """
+        key = smart_str(key)
+        started = time.time()
+        packed, chunks = self._pack(key, value)
+        if chunks:
+            self._memcache.set_multi(mapping=chunks, time=timeout)
+        stored = self._client().cas(key, packed, time=timeout)
+        self._time_large([packed], 'set', started)
+        if stored:
+            self._set_local(key, value, timeout)
+        else:
+            self._count('cas_conflicts')
+            self._delete_local(key)
+        return stored
+
+
+    def cas_reset(self):
+        """Forget the compare and set ids of everything this thread has
+        `gets`, which its memcache client would otherwise keep for good
+        """
+        client = getattr(self._clients, 'client', None)
+        if client is not None:
+            client.cas_reset()
+
+
+    def update(self, key, func, default=None, timeout=0, retries=10):
+        """Optimistically set `key` to `func(current value)`, where the value is
+        `default` if there isn't one, retrying if someone else changes it in
+        the meantime. Returns the new value, or raises `ValueError` if it
+        couldn't be set after `retries` attempts. Calls `cas_reset` when it's
+        done.
+        """
+        try:
+            for _ in xrange(retries):
+                val = self.gets(key)
+                if val is None:
+                    new = func(default)
+                    if self.add(key, new, timeout):
+                        return new
+                else:
+                    new = func(val)
+                    if self.cas(key, new, timeout):
+                        return new
+            raise ValueError("Couldn't update key '%s'" % key)
+        finally:
+            self.cas_reset()
+
+
+    def get_or_set(self, key, func, timeout=0, lease_timeout=10, poll=0.05,
+            beta=1.0):
+        """Get the value at `key`, or if there isn't one, set it to `func()`,
+        without a stampede of callers all computing it at once.
+
+        Only the caller holding a short lease on the key computes a missing
+        value. The others wait for up to `lease_timeout` seconds for it to
+        turn up before giving up and computing it themselves. Values stored
+        here are also refreshed a little before they expire: the longer a
+        value took to compute and the closer it is to expiring, the likelier
+        a caller is to recompute it early (scaled by `beta`), while everyone
+        else carries on getting the current value.
+
+        If `func` returns `None` nothing is stored. Values set some other way
+        are returned as they are, and never refreshed early.
+        """
+        key = smart_str(key)
+        lease_key = key + LEASE_SUFFIX
+
+        val = self._get(key)
+        if isinstance(val, Computed):
+            if self._should_refresh(val, beta) and self._lease(
+                    lease_key, lease_timeout):
+                self._count('early_refreshes')
+                return self._compute(key, lease_key, func, timeout)
+            return val.value
+        if val is not None:
+            return val
+
+        if not self._lease(lease_key, lease_timeout):
+            self._count('lease_waits')
+            val = self._wait_for(key, lease_key, lease_timeout, poll)
+            if val is not None:
+                return val.value if isinstance(val, Computed) else val
+        return self._compute(key, lease_key, func, timeout)
+
+
+    def namespace(self, name):
+        """Get the namespace of keys called `name`, which can be invalidated
+        all at once without flushing anyone else's keys
+        """
+        return Namespace(self, name)
+
+
+    def get_stats(self):
+        """Hit and miss counts for each tier, how well big values compress and
+        how long they take to set and get, for this instance
+        """
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats['compression_ratio'] = (float(stats['raw_bytes'])
+            / stats['stored_bytes'] if stats['stored_bytes'] else None)
+        return stats
+
+
+    def _client(self):
+        client = getattr(self._clients, 'client', None)
+        if client is None:
+            client = self._clients.client = self._memcache.Client()
+        return client
+
+    def _unwrap(self, val):
+        "The value in what `get_or_set` stored, or else `val` itself"
+        return val.value if isinstance(val, Computed) else val
+
+    def _lease(self, lease_key, lease_timeout):
+        return self._memcache.add(lease_key, 1, time=lease_timeout)
+
+    def _compute(self, key, lease_key, func, timeout):
+        "Compute and store a value for `key`, then give up the lease on it"
+        try:
+            started = time.time()
+            val = func()
+            if val is not None:
+                expires = started + timeout if timeout else None
+                computed = Computed(val, time.time() - started, expires)
+                self.set(key, computed, timeout)
+        finally:
+            self._memcache.delete(lease_key)
+        return val
+
+    def _should_refresh(self, computed, beta):
+        """Whether to refresh a value early, as in the XFetch algorithm from
+        "Optimal Probabilistic Cache Stampede Prevention" (Vattani et al.)
+        """
+        if computed.expires is None:
+            return False
+        gap = -computed.delta * beta * math.log(1 - random.random())
+        return time.time() + gap >= computed.expires
+
+    def _get(self, key):
+        "Get what's stored at `key`, which can be a `Computed`"
+        found, val = self._get_local(key)
+        if not found:
+            val = self._get_remote(key)
+            if val is None:
+                self._count('memcache_misses')
+                self._set_local_missing(key)
+            else:
+                self._count('memcache_hits')
+                self._set_local(key, val)
+        return val
+
+    def _get_remote(self, key):
+        started = time.time()
+        stored = self._memcache.get(key=key)
+        val = self._unpack_many({key: stored}).get(key)
+        self._time_large([stored], 'get', started)
+        return val
+
+    def _wait_for(self, key, lease_key, lease_timeout, poll):
+        """Poll memcache for `key` until it turns up, the lease on it is given
+        up or `lease_timeout` seconds have passed
+        """
+        deadline = time.time() + lease_timeout
+        while time.time() < deadline:
+            time.sleep(poll)
+            val = self._get_remote(key)
+            if val is not None:
+                self._set_local(key, val)
+                return val
+            if self._memcache.get(lease_key) is None:
+                return None
+        return None
+
+
+    # Packing values for memcache
+
+    def _pack(self, key, value):
+        """Returns what to store at `key` for `value`, and a dict of any chunks
+        to store along with it.
+
+        Integers are stored as they are so that they can be incremented, and
+        so are small strings. Anything else is serialized here rather than
+        pickled by memcache so that its size is known, and compressed if it's
+        big. If it's still too big for one memcache item it's split into
+        chunks, with the header saying where to find them stored at the key.
+        """
+        if value is None or isinstance(value, (int, long)):
+            return value, {}
+
+        flags = 0
+        data = value
+        if not isinstance(value, str):
+            flags |= SERIALIZED
+            data = serializers.dumps(value, self.serializer)
+
+        if self.compress_threshold and len(data) >= self.compress_threshold:
+            compressed = zlib.compress(data)
+            if len(compressed) < len(data):
+                self._count('compressed_sets')
+                self._count('raw_bytes', len(data))
+                self._count('stored_bytes', len(compressed))
+                flags |= COMPRESSED
+                data = compressed
+
+        if len(data) <= self.chunk_size:
+            return chr(flags) + data, {}
+
+        token = uuid.uuid4().hex
+        chunks = {}
+        for i, start in enumerate(xrange(0, len(data), self.chunk_size)):
+            chunks[CHUNK_KEY_TEMPLATE % (key, token, i)] = (
+                data[start:start + self.chunk_size])
+        self._count('chunked_sets')
+        return chr(flags | CHUNKED) + '%s:%d' % (token, len(chunks)), chunks
+
+    def _get_flags(self, stored):
+        "The header flags of a stored value, or `None` if it's an integer"
+        if isinstance(stored, str) and stored:
+            return ord(stored[0])
+        return None
+
+    def _unpack(self, flags, data):
+        if flags & COMPRESSED:
+            data = zlib.decompress(data)
+        return serializers.loads(data) if flags & SERIALIZED else data
+
+    def _unpack_many(self, stored):
+        """Unpack a dict of values as they were stored in memcache, fetching
+        the chunks of any that were split up with one more RPC. Values that
+        are missing any of their chunks, or were written by a serializer that
+        isn't known here, are left out.
+        """
+        chunk_keys = {}
+        for key, val in stored.items():
+            flags = self._get_flags(val)
+            if flags is not None and flags & CHUNKED:
+                token, count = val[1:].split(':')
+                chunk_keys[key] = [CHUNK_KEY_TEMPLATE % (key, token, i)
+                    for i in xrange(int(count))]
+        chunks = {}
+        if chunk_keys:
+            chunks = self._memcache.get_multi(keys=sum(chunk_keys.values(), []))
+
+        results = {}
+        for key, val in stored.items():
+            flags = self._get_flags(val)
+            if flags is None:
+                if val is not None:
+                    results[key] = val
+                continue
+            if key in chunk_keys:
+                if not all(k in chunks for k in chunk_keys[key]):
+                    self._count('chunk_misses')
+                    continue
+                data = ''.join(chunks[k] for k in chunk_keys[key])
+            else:
+                data = val[1:]
+            try:
+                results[key] = self._unpack(flags, data)
+            except ValueError:
+                continue
+        return results
+
+    def _time_large(self, stored, name, started):
+        """Count how many of the `stored` values were compressed or chunked,
+        and the seconds since `started` as the time it took to `name` them
+        """
+        large = sum(1 for val in stored
+            if (self._get_flags(val) or 0) & (COMPRESSED | CHUNKED))
+        if large:
+            self._count('large_%ss' % name, large)
+            self._count('large_%s_seconds' % name, time.time() - started)
+
+
+    # The local tier
+
+    def _count(self, name, amount=1):
+        with self._stats_lock:
+            self._stats[name] += amount
+
+    def _get_local(self, key):
+        """Returns `(found, value)`. `found` is `True` with a value of `None`
+        if memcache is known not to have the key.
+        """
+        if self._local is None:
+            return False, None
+
+        started = time.time()
+        found, val = self._local.get(key)
+        self._count('local_hits' if found else 'local_misses')
+        if self.metrics is not None:
+            self.metrics.record(LOCAL_GET, key, time.time() - started,
+                found, not found)
+        if not found or val == MISSING:
+            return found, None
+        return True, serializers.loads(val)
+
+    def _set_local(self, key, value, timeout=0):
+        if self._local is None:
+            return
+        # Memcache treats 0 as never expire, but locally nothing lives longer
+        # than `local_timeout`
+        if not timeout or timeout > self.local_timeout:
+            timeout = self.local_timeout
+        value = serializers.dumps(value, self.serializer)
+        self._local.set(key, value, timeout)
+
+    def _set_local_missing(self, key):
+        if self._local is not None and self.negative_timeout:
+            self._local.set(key, MISSING, self.negative_timeout)
+
+    def _delete_local(self, key):
+        if self._local is not None:
+            self._local.delete(key)
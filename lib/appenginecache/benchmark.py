@@ -0,0 +1,120 @@
+"""
+Benchmark of the cache backend's serializers on our two biggest cache
+payloads, as they're actually cached: sessions, which `cached_db` stores as
+`CachedSession`s wrapped in `get_or_set`'s `Computed`, and the parsed
+`POFile`s that rosetta caches. For each it reports how long storing and
+loading take, all the way from the value to what goes over the wire to
+memcache and back, how big that is, and which format was actually used, since
+values a serializer can't handle fall back to pickle. The first line for each
+payload is memcache pickling it itself, for comparison.
+
+Run it with the same environment as the tests, e.g.:
+
+    PYTHONPATH=.:/usr/local/google_appengine:./lib \\
+        DJANGO_SETTINGS_MODULE=settings python -m appenginecache.benchmark
+"""
+import cPickle as pickle
+import datetime
+import os
+import sys
+import time
+from optparse import OptionParser
+
+from rosetta import polib
+
+from appengine_sessions.backends.cached_db import CachedSession
+from appenginecache import serializers
+from appenginecache.backend import CacheClass, Computed
+
+
+PO_FILE = os.path.join(os.path.dirname(polib.__file__),
+    'locale', 'de', 'LC_MESSAGES', 'django.po')
+
+
+def session_dict():
+    "What a logged in user's session dict looks like"
+    return {
+        '_snippets_user': (4521, u'someone@example.com'),
+        'rosetta_cache_storage_key_prefix': 'b7e1a0c4a1f3e9a2d8c0f1e2d3c4b5a6',
+        'rosetta_i18n_lang_code': 'de',
+        'rosetta_i18n_fn': '/base/data/home/apps/ppb/locale/de/django.po',
+        'django_language': 'de',
+        'last_visit': datetime.datetime(2012, 3, 4, 5, 6, 7, 890),
+        'recent_snippets': [4521, 4519, 4480, 4410, 4399],
+    }
+
+
+def session_payload():
+    "What `cached_db` caches for a session it's loaded from the datastore"
+    expire_date = datetime.datetime(2012, 3, 18, 5, 6, 7, 890)
+    cached = CachedSession(session_dict(), expire_date,
+        'd41d8cd98f00b204e9800998ecf8427e', expire_date, 1331010367.89)
+    return Computed(cached, 0.012, 1331010367.89 + 1209600)
+
+
+def po_file_payload():
+    "A whole parsed catalogue, like rosetta caches under `rosetta_i18n_pofile`"
+    return polib.pofile(PO_FILE)
+
+
+PAYLOADS = (
+    ('session', session_payload),
+    ('POFile', po_file_payload),
+)
+
+
+def to_memcache(value):
+    "What memcache sends for a value: strings as they are, anything else pickled"
+    if isinstance(value, str):
+        return value
+    return pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+
+def time_calls(func, rounds):
+    "Returns the microseconds each of `rounds` calls of `func()` takes"
+    started = time.time()
+    for _ in xrange(rounds):
+        func()
+    return (time.time() - started) / rounds * 10 ** 6
+
+
+def write(out, payload_name, name, store, load, data, how):
+    out.write('%-8s %-8s %9.1fus store %9.1fus load %8d bytes  %s\n' % (
+        payload_name, name, store, load, len(data), how))
+
+
+def run(rounds=1000, out=sys.stdout):
+    """Benchmark memcache's own pickling and every serializer on every
+    payload, writing a line for each
+    """
+    for payload_name, payload in PAYLOADS:
+        value = payload()
+
+        data = to_memcache(value)
+        write(out, payload_name, 'memcache',
+            time_calls(lambda: to_memcache(value), rounds),
+            time_calls(lambda: pickle.loads(data), rounds),
+            data, 'pickled by memcache')
+
+        for name, serializer in sorted(serializers.SERIALIZERS.items()):
+            cache = CacheClass(None, {'OPTIONS': {'SERIALIZER': name}})
+            data, _ = cache._pack('key', value)
+            flags = ord(data[0])
+            used = serializers.BY_TAG[serializers.dumps(value, serializer)[0]]
+            store = time_calls(
+                lambda: to_memcache(cache._pack('key', value)[0]), rounds)
+            load = time_calls(lambda: cache._unpack(flags, data[1:]), rounds)
+            write(out, payload_name, name, store, load, data,
+                'as ' + name if used is serializer else 'fell back to pickle')
+
+
+def main(argv=None):
+    parser = OptionParser()
+    parser.add_option('-r', '--rounds', type='int', default=1000,
+        help="How many times to encode and decode each payload")
+    opts, _ = parser.parse_args(argv)
+    run(opts.rounds)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,174 @@
+# A local stand-in for AppEngine's memcache, for load testing the cache backend
+
+import cPickle as pickle
+import itertools
+import threading
+import time
+from collections import Counter
+
+
+# Like memcache, times over 30 days are absolute timestamps
+MAX_RELATIVE_TIME = 60 * 60 * 24 * 30
+
+
+class FakeMemcache(object):
+    """A thread-safe, in-process stand-in for `google.appengine.api.memcache`
+    with the same call signatures. Every call is counted in `calls`, and can be
+    made to take `latency` seconds to act like an RPC. Values are pickled on
+    the way in, so callers get copies back just like with real memcache.
+    """
+
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.calls = Counter()
+        self._data = {}
+        self._lock = threading.RLock()
+        self._cas_ids = itertools.count(1)
+
+    def Client(self):
+        return FakeClient(self)
+
+    # Storage
+
+    def _call(self, name):
+        self.calls[name] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _expires(self, timeout):
+        if not timeout:
+            return None
+        if timeout > MAX_RELATIVE_TIME:
+            return timeout
+        return time.time() + timeout
+
+    def _get(self, key):
+        "Returns `(value, cas_id)`, with a value of `None` if it's missing"
+        entry = self._data.get(key)
+        if entry is None:
+            return None, None
+        stored, expires, cas_id = entry
+        if expires is not None and expires < time.time():
+            del self._data[key]
+            return None, None
+        if isinstance(stored, (int, long)):
+            return stored, cas_id
+        return pickle.loads(stored), cas_id
+
+    def _set(self, key, value, timeout):
+        # Integers are kept as they are so that they can be incremented
+        if not isinstance(value, (int, long)) or isinstance(value, bool):
+            value = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        self._data[key] = (value, self._expires(timeout), self._cas_ids.next())
+
+    # The memcache API
+
+    def get(self, key, namespace=None):
+        self._call('get')
+        with self._lock:
+            return self._get(key)[0]
+
+    def get_multi(self, keys, key_prefix='', namespace=None, for_cas=False):
+        self._call('get_multi')
+        results = {}
+        with self._lock:
+            for key in keys:
+                value = self._get(key_prefix + key)[0]
+                if value is not None:
+                    results[key] = value
+        return results
+
+    def set(self, key, value, time=0, namespace=None):
+        self._call('set')
+        with self._lock:
+            self._set(key, value, time)
+        return True
+
+    def set_multi(self, mapping, time=0, key_prefix='', namespace=None):
+        self._call('set_multi')
+        with self._lock:
+            for key, value in mapping.items():
+                self._set(key_prefix + key, value, time)
+        return []
+
+    def add(self, key, value, time=0, namespace=None):
+        self._call('add')
+        with self._lock:
+            if self._get(key)[0] is not None:
+                return False
+            self._set(key, value, time)
+            return True
+
+    def delete(self, key, seconds=0, namespace=None):
+        self._call('delete')
+        with self._lock:
+            found = self._data.pop(key, None) is not None
+        return 2 if found else 1
+
+    def delete_multi(self, keys, seconds=0, key_prefix='', namespace=None):
+        self._call('delete_multi')
+        with self._lock:
+            for key in keys:
+                self._data.pop(key_prefix + key, None)
+        return True
+
+    def incr(self, key, delta=1, namespace=None, initial_value=None):
+        self._call('incr')
+        return self._offset(key, delta, initial_value)
+
+    def decr(self, key, delta=1, namespace=None, initial_value=None):
+        self._call('decr')
+        return self._offset(key, -delta, initial_value)
+
+    def _offset(self, key, delta, initial_value):
+        with self._lock:
+            value = self._get(key)[0]
+            if value is None:
+                if initial_value is None:
+                    return None
+                value = initial_value
+                expires = None
+            else:
+                expires = self._data[key][1]
+            value = max(0, value + delta)
+            self._data[key] = (value, expires, self._cas_ids.next())
+            return value
+
+    def flush_all(self):
+        self._call('flush_all')
+        with self._lock:
+            self._data.clear()
+        return True
+
+
+class FakeClient(object):
+    """Stands in for `memcache.Client`, remembering the cas ids of what it
+    `gets` for its `cas`es
+    """
+
+    def __init__(self, memcache):
+        self._memcache = memcache
+        self._cas_ids = {}
+
+    def __getattr__(self, name):
+        return getattr(self._memcache, name)
+
+    def gets(self, key, namespace=None):
+        self._memcache._call('gets')
+        with self._memcache._lock:
+            value, cas_id = self._memcache._get(key)
+        if value is not None:
+            self._cas_ids[key] = cas_id
+        return value
+
+    def cas(self, key, value, time=0, namespace=None):
+        self._memcache._call('cas')
+        cas_id = self._cas_ids.pop(key, None)
+        with self._memcache._lock:
+            if cas_id is None or self._memcache._get(key)[1] != cas_id:
+                return False
+            self._memcache._set(key, value, time)
+            return True
+
+    def cas_reset(self):
+        self._cas_ids.clear()
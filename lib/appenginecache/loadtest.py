@@ -0,0 +1,126 @@
+"""
+Load test for the cache backend's counters, compare and set updates and
+`get_or_set`, with lots of concurrent clients sharing one `FakeMemcache`.
+The naive read-modify-write counter is there to show what they're for.
+
+Run it with the same environment as the tests, e.g.:
+
+    PYTHONPATH=.:/usr/local/google_appengine:./lib \\
+        DJANGO_SETTINGS_MODULE=settings python -m appenginecache.loadtest
+"""
+import sys
+import threading
+import time
+from optparse import OptionParser
+
+from appenginecache import backend
+from appenginecache.fakes import FakeMemcache
+
+
+def run_clients(threads, func):
+    """Call `func()` on `threads` threads, all started at once, and return how
+    many seconds it took for them all to finish
+    """
+    start = threading.Event()
+
+    def client():
+        start.wait()
+        func()
+
+    workers = [threading.Thread(target=client) for _ in xrange(threads)]
+    for worker in workers:
+        worker.start()
+    started = time.time()
+    start.set()
+    for worker in workers:
+        worker.join()
+    return time.time() - started
+
+
+def naive_counter(cache, threads, ops):
+    "Read-modify-write with `get` and `set`, which loses updates"
+    cache.set('naive', 0)
+
+    def client():
+        for _ in xrange(ops):
+            cache.set('naive', cache.get('naive') + 1)
+
+    return run_clients(threads, client), cache.gets('naive'), threads * ops
+
+
+def incr_counter(cache, threads, ops):
+    cache.set('incr', 0)
+
+    def client():
+        for _ in xrange(ops):
+            cache.incr('incr')
+
+    return run_clients(threads, client), cache.gets('incr'), threads * ops
+
+
+def cas_counter(cache, threads, ops):
+    cache.set('cas', 0)
+
+    def client():
+        for _ in xrange(ops):
+            cache.update('cas', lambda value: value + 1, retries=1000)
+
+    return run_clients(threads, client), cache.gets('cas'), threads * ops
+
+
+def get_or_set_stampede(cache, threads, ops):
+    "Every client asks for the same missing keys, which are slow to compute"
+    computed = []
+
+    def compute():
+        computed.append(1)
+        time.sleep(0.05)
+        return 'value'
+
+    def client():
+        for i in xrange(ops):
+            cache.get_or_set('expensive-%d' % i, compute, poll=0.01)
+
+    return run_clients(threads, client), len(computed), ops
+
+
+SCENARIOS = (
+    ('naive get/set counter', naive_counter),
+    ('incr counter', incr_counter),
+    ('cas counter', cas_counter),
+    ('get_or_set stampede', get_or_set_stampede),
+)
+
+
+def run(threads=20, ops=50, latency=0.001, out=sys.stdout):
+    """Run every scenario against a fresh `FakeMemcache`, writing a line of
+    results for each
+    """
+    original = backend.memcache
+    try:
+        for name, scenario in SCENARIOS:
+            fake = backend.memcache = FakeMemcache(latency=latency)
+            cache = backend.CacheClass(None, {})
+
+            seconds, result, expected = scenario(cache, threads, ops)
+            calls = sum(fake.calls.values())
+            out.write('%-24s %6.2fs %8.1f rpcs/sec  result %d (expected %d)  '
+                '%s\n' % (name, seconds, calls / seconds, result, expected,
+                dict(fake.calls)))
+    finally:
+        backend.memcache = original
+
+
+def main(argv=None):
+    parser = OptionParser()
+    parser.add_option('-t', '--threads', type='int', default=20)
+    parser.add_option('-o', '--ops', type='int', default=50,
+        help="Operations per thread")
+    parser.add_option('-l', '--latency', type='float', default=0.001,
+        help="Seconds every fake memcache call takes")
+    opts, _ = parser.parse_args(argv)
+    run(opts.threads, opts.ops, opts.latency)
+
+
+if __name__ == '__main__':
+    main()
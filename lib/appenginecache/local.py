@@ -0,0 +1,69 @@
+# An in-process LRU cache, used as the first tier in front of memcache
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class LocalMemoryCache(object):
+    """A thread-safe least recently used cache of already serialized values,
+    bounded by both the number of entries and their total size. Every entry
+    expires after its own timeout, which is what bounds how stale a value can
+    get here while it's changed in memcache by another instance.
+    """
+
+    def __init__(self, max_entries=1000, max_bytes=4 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        "Returns `(found, value)`, where `found` is False if missing or expired"
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return False, None
+
+            value, expires = entry
+            if expires < time.time():
+                self._bytes -= len(value)
+                return False, None
+
+            # Move it to the most recently used end
+            self._entries[key] = entry
+            return True, value
+
+    def set(self, key, value, timeout):
+        """Store `value`, a string, for `timeout` seconds. Values bigger than
+        a tenth of `max_bytes` aren't stored at all.
+        """
+        with self._lock:
+            self._delete(key)
+            if len(value) > self.max_bytes / 10:
+                return
+
+            self._entries[key] = (value, time.time() + timeout)
+            self._bytes += len(value)
+            while (len(self._entries) > self.max_entries
+                    or self._bytes > self.max_bytes):
+                _, (evicted, _) = self._entries.popitem(last=False)
+                self._bytes -= len(evicted)
+
+    def delete(self, key):
+        with self._lock:
+            self._delete(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def _delete(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= len(entry[0])
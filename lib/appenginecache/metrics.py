@@ -0,0 +1,254 @@
+# Metrics for what the cache backend does, grouped by key prefix
+
+# With the `METRICS` cache option on, every memcache RPC the backend makes goes
+# through `InstrumentedMemcache`, which records how long it took, whether it
+# found what it was after and how many bytes went over the wire. Lookups in
+# the local tier are recorded too. With it off nothing is recorded and nothing
+# is wrapped, so it costs nothing.
+
+import bisect
+import threading
+import time
+
+
+# Upper bounds, in milliseconds, of the latency histograms' buckets. There's
+# one more bucket for anything slower.
+BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+BUCKET_NAMES = ['<=%dms' % bound for bound in BUCKETS] + [
+    '>%dms' % BUCKETS[-1]]
+
+# What lookups in the local tier are recorded as
+LOCAL_GET = 'local_get'
+
+
+def get_prefix(key):
+    """The group `key` is counted in: the name of the namespace it's in, or
+    else its leading words, e.g. `snippet-validators` for
+    `snippet-validators-42`. Chunks are counted with the key they belong to.
+    """
+    words = []
+    for word in key.split(':', 1)[0].split('-'):
+        if not word.isalpha():
+            break
+        words.append(word)
+    return '-'.join(words) or 'other'
+
+
+def value_size(value):
+    "Roughly how many bytes `value` takes up in memcache"
+    return len(value) if isinstance(value, str) else 0
+
+
+class Counts(object):
+    "Counts, times, sizes and a latency histogram for one kind of operation"
+
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.0
+        self.hits = 0
+        self.misses = 0
+        self.bytes = 0
+        self.max_bytes = 0
+        self.buckets = [0] * len(BUCKET_NAMES)
+
+    def add(self, seconds, hits, misses, size):
+        self.calls += 1
+        self.seconds += seconds
+        self.hits += hits
+        self.misses += misses
+        self.bytes += size
+        self.max_bytes = max(self.max_bytes, size)
+        self.buckets[bisect.bisect_left(BUCKETS, seconds * 1000)] += 1
+
+    def as_dict(self):
+        lookups = self.hits + self.misses
+        return {
+            'calls': self.calls,
+            'mean_ms': self.seconds * 1000 / self.calls if self.calls else 0,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': float(self.hits) / lookups if lookups else None,
+            'bytes': self.bytes,
+            'max_bytes': self.max_bytes,
+            'histogram': dict(zip(BUCKET_NAMES, self.buckets)),
+        }
+
+
+class Metrics(object):
+    """Thread-safe `Counts` for each key prefix and operation since the last
+    `reset`, and totals for each key prefix for the request being handled by
+    the current thread
+    """
+
+    def __init__(self):
+        self._counts = {}
+        self._lock = threading.Lock()
+        self._requests = threading.local()
+
+    def record(self, operation, key, seconds, hits=0, misses=0, size=0):
+        prefix = get_prefix(key)
+        with self._lock:
+            counts = self._counts.get((prefix, operation))
+            if counts is None:
+                counts = self._counts[(prefix, operation)] = Counts()
+            counts.add(seconds, hits, misses, size)
+
+        request = getattr(self._requests, 'totals', None)
+        if request is not None:
+            totals = request.setdefault(prefix, [0, 0.0, 0, 0, 0, 0])
+            if operation == LOCAL_GET:
+                totals[5] += hits
+            else:
+                for i, amount in enumerate((1, seconds, hits, misses, size)):
+                    totals[i] += amount
+
+    def get_metrics(self):
+        "Everything recorded so far, as `{prefix: {operation: counts}}`"
+        metrics = {}
+        with self._lock:
+            for (prefix, operation), counts in self._counts.items():
+                metrics.setdefault(prefix, {})[operation] = counts.as_dict()
+        return metrics
+
+    def reset(self):
+        with self._lock:
+            self._counts.clear()
+
+    def start_request(self):
+        "Start keeping totals for a request handled by this thread"
+        self._requests.totals = {}
+
+    def end_request(self):
+        """Stop keeping totals for this thread's request and return them, as
+        `{prefix: {calls, ms, hits, misses, bytes, local_hits}}`, where all
+        but `local_hits` are for memcache calls
+        """
+        request = getattr(self._requests, 'totals', None)
+        self._requests.totals = None
+        if request is None:
+            return None
+        return dict((prefix, {
+            'calls': calls,
+            'ms': round(seconds * 1000, 2),
+            'hits': hits,
+            'misses': misses,
+            'bytes': size,
+            'local_hits': local_hits,
+        }) for prefix, (calls, seconds, hits, misses, size, local_hits)
+            in request.items())
+
+
+class InstrumentedMemcache(object):
+    """Stands in for `google.appengine.api.memcache`, recording every call to
+    `metrics` on its way to `memcache`. Calls that affect several keys are
+    recorded once for each key prefix they touch.
+    """
+
+    def __init__(self, memcache, metrics):
+        self._memcache = memcache
+        self._metrics = metrics
+
+    def __getattr__(self, name):
+        return getattr(self._memcache, name)
+
+    def Client(self):
+        return InstrumentedClient(self._memcache.Client(), self._metrics)
+
+    def _record_one(self, operation, key, started, found=None, size=0):
+        self._metrics.record(operation, key, time.time() - started,
+            found is True, found is False, size)
+
+    def _record_many(self, operation, keys, started, found=None, sizes=None):
+        "Record a call for `keys`, which `found` the keys it has"
+        seconds = time.time() - started
+        by_prefix = {}
+        for key in keys:
+            totals = by_prefix.setdefault(get_prefix(key), [key, 0, 0, 0])
+            if found is not None:
+                totals[1 if key in found else 2] += 1
+            if sizes is not None:
+                totals[3] += value_size(sizes.get(key))
+        for key, hits, misses, size in by_prefix.values():
+            self._metrics.record(operation, key, seconds, hits, misses, size)
+
+    def get(self, key, *args, **kwargs):
+        started = time.time()
+        value = self._memcache.get(key, *args, **kwargs)
+        self._record_one('get', key, started, value is not None,
+            value_size(value))
+        return value
+
+    def get_multi(self, keys, *args, **kwargs):
+        started = time.time()
+        values = self._memcache.get_multi(keys, *args, **kwargs)
+        self._record_many('get_multi', keys, started, values, values)
+        return values
+
+    def set(self, key, value, *args, **kwargs):
+        started = time.time()
+        stored = self._memcache.set(key, value, *args, **kwargs)
+        self._record_one('set', key, started, size=value_size(value))
+        return stored
+
+    def set_multi(self, mapping, *args, **kwargs):
+        started = time.time()
+        failed = self._memcache.set_multi(mapping, *args, **kwargs)
+        self._record_many('set_multi', mapping.keys(), started,
+            sizes=mapping)
+        return failed
+
+    def add(self, key, value, *args, **kwargs):
+        started = time.time()
+        added = self._memcache.add(key, value, *args, **kwargs)
+        self._record_one('add', key, started, size=value_size(value))
+        return added
+
+    def delete(self, key, *args, **kwargs):
+        started = time.time()
+        result = self._memcache.delete(key, *args, **kwargs)
+        self._record_one('delete', key, started)
+        return result
+
+    def delete_multi(self, keys, *args, **kwargs):
+        started = time.time()
+        result = self._memcache.delete_multi(keys, *args, **kwargs)
+        self._record_many('delete_multi', keys, started)
+        return result
+
+    def incr(self, key, *args, **kwargs):
+        started = time.time()
+        value = self._memcache.incr(key, *args, **kwargs)
+        self._record_one('incr', key, started, value is not None)
+        return value
+
+    def decr(self, key, *args, **kwargs):
+        started = time.time()
+        value = self._memcache.decr(key, *args, **kwargs)
+        self._record_one('decr', key, started, value is not None)
+        return value
+
+
+class InstrumentedClient(object):
+    "Stands in for a `memcache.Client`, recording its `gets` and `cas`"
+
+    def __init__(self, client, metrics):
+        self._client = client
+        self._metrics = metrics
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+    def gets(self, key, *args, **kwargs):
+        started = time.time()
+        value = self._client.gets(key, *args, **kwargs)
+        self._metrics.record('gets', key, time.time() - started,
+            value is not None, value is None, value_size(value))
+        return value
+
+    def cas(self, key, value, *args, **kwargs):
+        started = time.time()
+        stored = self._client.cas(key, value, *args, **kwargs)
+        self._metrics.record('cas', key, time.time() - started,
+            size=value_size(value))
+        return stored
@@ -0,0 +1,30 @@
+import json
+import logging
+
+from django.core.cache import cache
+from django.core.exceptions import MiddlewareNotUsed
+
+
+class CacheMetricsMiddleware(object):
+    """Logs a line of JSON for every request with how many cache calls it made
+    for each key prefix, how long they took, how many hit and how many bytes
+    they moved. Only used if the cache has the `METRICS` option on.
+    """
+
+    def __init__(self):
+        self.metrics = getattr(cache, 'metrics', None)
+        if self.metrics is None:
+            raise MiddlewareNotUsed
+
+    def process_request(self, request):
+        self.metrics.start_request()
+
+    def process_response(self, request, response):
+        totals = self.metrics.end_request()
+        if totals is not None:
+            logging.info('cache_metrics %s', json.dumps({
+                'path': request.path,
+                'status': response.status_code,
+                'prefixes': totals,
+            }, sort_keys=True))
+        return response
@@ -0,0 +1,115 @@
+# Namespaces of keys in the cache that can each be invalidated at once
+
+# A namespace's keys are prefixed with its name and current generation, a
+# counter kept in memcache. Invalidating the namespace increments it, so every
+# key cached under the old generation is never looked up again and just
+# expires, without touching any other namespace's keys. That's one RPC rather
+# than a `memcache.flush_all()`.
+
+import time
+
+from django.utils.encoding import smart_str
+
+
+GENERATION_KEY_TEMPLATE = 'namespace-generation-%s'
+
+KEY_TEMPLATE = '%s:%s:%s'
+
+
+def _new_generation():
+    # Generations start from the time rather than 0 so that an evicted
+    # generation can't restart at a number that old entries were cached under.
+    # Microseconds, since it can be evicted and restarted within a millisecond.
+    return int(time.time() * 1000000)
+
+
+class Namespace(object):
+    """A view of `cache` that puts every key in the namespace called `name`.
+    It has the same methods as the cache, plus `invalidate`.
+
+    Like any value, the generation can be served from the cache's local tier,
+    so other instances can carry on using the old one for up to the cache's
+    `LOCAL_TIMEOUT` after an invalidation.
+    """
+
+    def __init__(self, cache, name):
+        self.cache = cache
+        self.name = name
+        self.generation_key = GENERATION_KEY_TEMPLATE % name
+
+    def get_generation(self):
+        generation = self.cache.get(self.generation_key)
+        if generation is None:
+            self.cache.add(self.generation_key, _new_generation())
+            generation = self.cache.get(self.generation_key)
+        return generation
+
+    def invalidate(self):
+        "Invalidate every key in the namespace"
+        try:
+            self.cache.incr(self.generation_key)
+        except ValueError:
+            self.cache.set(self.generation_key, _new_generation())
+
+    clear = invalidate
+
+    def make_key(self, key, generation=None):
+        if generation is None:
+            generation = self.get_generation()
+        return KEY_TEMPLATE % (self.name, generation, smart_str(key))
+
+    def add(self, key, value, timeout=0):
+        return self.cache.add(self.make_key(key), value, timeout)
+
+    def get(self, key, default=None):
+        return self.cache.get(self.make_key(key), default)
+
+    def set(self, key, value, timeout=0):
+        self.cache.set(self.make_key(key), value, timeout)
+
+    def delete(self, key):
+        self.cache.delete(self.make_key(key))
+
+    def has_key(self, key):
+        return self.get(key) is not None
+
+    __contains__ = has_key
+
+    def get_many(self, keys):
+        generation = self.get_generation()
+        keys = dict((self.make_key(key, generation), key) for key in keys)
+        return dict((keys[key], value)
+            for key, value in self.cache.get_many(keys.keys()).items())
+
+    def set_many(self, data, timeout=0):
+        generation = self.get_generation()
+        self.cache.set_many(dict((self.make_key(key, generation), value)
+            for key, value in data.items()), timeout)
+
+    def delete_many(self, keys):
+        generation = self.get_generation()
+        self.cache.delete_many(
+            [self.make_key(key, generation) for key in keys])
+
+    def incr(self, key, delta=1):
+        return self.cache.incr(self.make_key(key), delta)
+
+    def decr(self, key, delta=1):
+        return self.cache.decr(self.make_key(key), delta)
+
+    def gets(self, key, default=None):
+        return self.cache.gets(self.make_key(key), default)
+
+    def cas(self, key, value, timeout=0):
+        return self.cache.cas(self.make_key(key), value, timeout)
+
+    def cas_reset(self):
+        self.cache.cas_reset()
+
+    def update(self, key, func, default=None, timeout=0, retries=10):
+        return self.cache.update(
+            self.make_key(key), func, default, timeout, retries)
+
+    def get_or_set(self, key, func, timeout=0, **kwargs):
+        return self.cache.get_or_set(self.make_key(key), func, timeout,
+            **kwargs)
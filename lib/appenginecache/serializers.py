@@ -0,0 +1,259 @@
+# Serializers for the values the cache backend stores in memcache
+
+# Every serialized value starts with its serializer's one byte tag, so values
+# written in one format can still be read after switching to another. Values a
+# serializer can't handle fall back to pickle.
+# `appenginecache.benchmark` compares them on our biggest payloads.
+
+import cPickle as pickle
+import datetime
+import marshal
+import struct
+
+from django.utils import importlib
+
+
+class PickleSerializer(object):
+    "Handles anything picklable, using the highest protocol"
+
+    tag = 'p'
+
+    def dumps(self, value):
+        return pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+    def loads(self, data):
+        return pickle.loads(data)
+
+
+class MarshalSerializer(object):
+    """Fast, but only for the builtin types: `None`, bools, numbers, strings,
+    tuples, lists, sets and dicts, and not their subclasses
+    """
+
+    tag = 'm'
+
+    def dumps(self, value):
+        return marshal.dumps(value, 2)
+
+    def loads(self, data):
+        return marshal.loads(data)
+
+
+class CompactSerializer(object):
+    """A compact binary format after msgpack, for `None`, bools, integers up to
+    64 bits, floats, strings, tuples, lists, dicts and naive datetimes, but not
+    their subclasses. Small values take a byte or two: a short string or list
+    only needs one byte on top of its contents.
+    """
+
+    tag = 'c'
+
+    # Extension types, for what msgpack itself doesn't have
+    TUPLE = 1
+    DATETIME = 2
+
+    EPOCH = datetime.datetime(1970, 1, 1)
+
+    def dumps(self, value):
+        out = []
+        self._dump(value, out)
+        return ''.join(out)
+
+    def loads(self, data):
+        value, end = self._load(data, 0)
+        if end != len(data):
+            raise ValueError("Extra data after value")
+        return value
+
+    def _dump(self, value, out):
+        if value is None:
+            out.append('\xc0')
+        elif value is False:
+            out.append('\xc2')
+        elif value is True:
+            out.append('\xc3')
+        elif type(value) in (int, long):
+            self._dump_int(value, out)
+        elif type(value) is float:
+            out.append(struct.pack('>Bd', 0xcb, value))
+        elif type(value) is str:
+            self._dump_header(len(value), out, None, 0xc4, 0xc5, 0xc6)
+            out.append(value)
+        elif type(value) is unicode:
+            value = value.encode('utf-8')
+            self._dump_header(len(value), out, (0xa0, 32), 0xd9, 0xda, 0xdb)
+            out.append(value)
+        elif type(value) is list:
+            self._dump_header(len(value), out, (0x90, 16), None, 0xdc, 0xdd)
+            for item in value:
+                self._dump(item, out)
+        elif type(value) is dict:
+            self._dump_header(len(value), out, (0x80, 16), None, 0xde, 0xdf)
+            for key, item in value.iteritems():
+                self._dump(key, out)
+                self._dump(item, out)
+        elif type(value) is tuple:
+            self._dump_ext(self.TUPLE, self.dumps(list(value)), out)
+        elif type(value) is datetime.datetime and value.tzinfo is None:
+            delta = value - self.EPOCH
+            micros = (delta.days * 86400 + delta.seconds) * 10 ** 6 + (
+                delta.microseconds)
+            self._dump_ext(self.DATETIME, struct.pack('>q', micros), out)
+        else:
+            raise TypeError("Can't serialize %r" % type(value))
+
+    def _dump_int(self, value, out):
+        if 0 <= value < 0x80:
+            out.append(chr(value))
+        elif -32 <= value < 0:
+            out.append(chr(value & 0xff))
+        elif -2 ** 63 <= value < 2 ** 63:
+            for code, fmt, bits in ((0xd0, '>Bb', 8), (0xd1, '>Bh', 16),
+                    (0xd2, '>Bi', 32), (0xd3, '>Bq', 64)):
+                if -2 ** (bits - 1) <= value < 2 ** (bits - 1):
+                    out.append(struct.pack(fmt, code, value))
+                    return
+        elif 0 <= value < 2 ** 64:
+            out.append(struct.pack('>BQ', 0xcf, value))
+        else:
+            raise TypeError("Integer too big to serialize")
+
+    def _dump_header(self, length, out, fixed, code8, code16, code32):
+        """Write the header for something of `length`. `fixed` is the first
+        code and limit for lengths that fit in the code, if there are any.
+        """
+        if fixed is not None and length < fixed[1]:
+            out.append(chr(fixed[0] + length))
+        elif code8 is not None and length < 2 ** 8:
+            out.append(struct.pack('>BB', code8, length))
+        elif length < 2 ** 16:
+            out.append(struct.pack('>BH', code16, length))
+        else:
+            out.append(struct.pack('>BI', code32, length))
+
+    def _dump_ext(self, ext_type, data, out):
+        self._dump_header(len(data), out, None, 0xc7, 0xc8, 0xc9)
+        out.append(chr(ext_type))
+        out.append(data)
+
+    def _load(self, data, pos):
+        "Returns the value starting at `pos` and the position after it"
+        code = ord(data[pos])
+        pos += 1
+
+        if code < 0x80:
+            return code, pos
+        if code >= 0xe0:
+            return code - 0x100, pos
+        if 0x80 <= code < 0x90:
+            return self._load_dict(data, pos, code - 0x80)
+        if 0x90 <= code < 0xa0:
+            return self._load_list(data, pos, code - 0x90)
+        if 0xa0 <= code < 0xc0:
+            return self._load_unicode(data, pos, code - 0xa0)
+        if code == 0xc0:
+            return None, pos
+        if code == 0xc2:
+            return False, pos
+        if code == 0xc3:
+            return True, pos
+        if code in self.NUMBERS:
+            fmt = self.NUMBERS[code]
+            value = struct.unpack_from(fmt, data, pos)[0]
+            return value, pos + struct.calcsize(fmt)
+        if code in self.LENGTHS:
+            kind, fmt = self.LENGTHS[code]
+            length = struct.unpack_from(fmt, data, pos)[0]
+            pos += struct.calcsize(fmt)
+            if kind == 'str':
+                return data[pos:pos + length], pos + length
+            return getattr(self, '_load_' + kind)(data, pos, length)
+        raise ValueError("Unknown type code 0x%x" % code)
+
+    NUMBERS = {
+        0xcb: '>d', 0xcf: '>Q',
+        0xd0: '>b', 0xd1: '>h', 0xd2: '>i', 0xd3: '>q',
+    }
+
+    LENGTHS = {
+        0xc4: ('str', '>B'), 0xc5: ('str', '>H'), 0xc6: ('str', '>I'),
+        0xc7: ('ext', '>B'), 0xc8: ('ext', '>H'), 0xc9: ('ext', '>I'),
+        0xd9: ('unicode', '>B'), 0xda: ('unicode', '>H'),
+        0xdb: ('unicode', '>I'),
+        0xdc: ('list', '>H'), 0xdd: ('list', '>I'),
+        0xde: ('dict', '>H'), 0xdf: ('dict', '>I'),
+    }
+
+    def _load_unicode(self, data, pos, length):
+        return data[pos:pos + length].decode('utf-8'), pos + length
+
+    def _load_list(self, data, pos, length):
+        items = []
+        for _ in xrange(length):
+            item, pos = self._load(data, pos)
+            items.append(item)
+        return items, pos
+
+    def _load_dict(self, data, pos, length):
+        items = {}
+        for _ in xrange(length):
+            key, pos = self._load(data, pos)
+            items[key], pos = self._load(data, pos)
+        return items, pos
+
+    def _load_ext(self, data, pos, length):
+        ext_type = ord(data[pos])
+        pos += 1
+        payload = data[pos:pos + length]
+        if ext_type == self.TUPLE:
+            value = tuple(self.loads(payload))
+        elif ext_type == self.DATETIME:
+            micros = struct.unpack('>q', payload)[0]
+            value = self.EPOCH + datetime.timedelta(microseconds=micros)
+        else:
+            raise ValueError("Unknown extension type %d" % ext_type)
+        return value, pos + length
+
+
+SERIALIZERS = {
+    'pickle': PickleSerializer(),
+    'marshal': MarshalSerializer(),
+    'compact': CompactSerializer(),
+}
+
+# Every serializer that values can have been written with, by tag
+BY_TAG = dict((s.tag, s) for s in SERIALIZERS.values())
+
+FALLBACK = SERIALIZERS['pickle']
+
+
+def get_serializer(name):
+    """Get the serializer called `name` in `SERIALIZERS`, or else the
+    serializer class at the dotted path `name`. Classes of your own need a
+    one byte `tag` that's different to everyone else's.
+    """
+    if name in SERIALIZERS:
+        return SERIALIZERS[name]
+    serializer_module, serializer_class = name.rsplit('.', 1)
+    serializer_module = importlib.import_module(serializer_module)
+    serializer = getattr(serializer_module, serializer_class)()
+    BY_TAG.setdefault(serializer.tag, serializer)
+    return serializer
+
+
+def dumps(value, serializer):
+    "Serialize `value` with its tag, falling back to pickle if need be"
+    try:
+        return serializer.tag + serializer.dumps(value)
+    except (TypeError, ValueError):
+        return FALLBACK.tag + FALLBACK.dumps(value)
+
+
+def loads(data):
+    """Deserialize `data` with whichever serializer it was written with. Raises
+    `ValueError` for a tag that's unknown.
+    """
+    serializer = BY_TAG.get(data[:1])
+    if serializer is None:
+        raise ValueError("Unknown serializer tag %r" % data[:1])
+    return serializer.loads(data[1:])
@@ -0,0 +1,428 @@
+import datetime
+import os
+import threading
+import time
+import unittest
+from StringIO import StringIO
+
+from google.appengine.api import memcache
+from google.appengine.ext import testbed
+
+from appenginecache import CacheClass, benchmark, loadtest, serializers
+from appenginecache.backend import (CHUNKED, CHUNK_KEY_TEMPLATE,
+    LEASE_SUFFIX, Computed)
+from appenginecache.local import LocalMemoryCache
+from appenginecache.metrics import InstrumentedMemcache, get_prefix
+
+
+class SerializerTests(unittest.TestCase):
+
+    values = [
+        None, True, False, 0, 127, -32, -33, 200, -2 ** 40, 2 ** 63, 1.5,
+        '', 'bytes\xff', u'', u'unicode \xe9', u'x' * 300, 'y' * 70000,
+        [], range(20), (1, (2, u'3')), {'a': [1, {u'b': None}]},
+        dict((str(i), i) for i in range(20)),
+        datetime.datetime(2012, 3, 4, 5, 6, 7, 890),
+        datetime.datetime(1900, 1, 1),
+    ]
+
+    def test_round_trips(self):
+        for name, serializer in serializers.SERIALIZERS.items():
+            for value in self.values:
+                data = serializers.dumps(value, serializer)
+                loaded = serializers.loads(data)
+                self.assertEqual(loaded, value, (name, value))
+                self.assertEqual(type(loaded), type(value), (name, value))
+
+    def test_compact(self):
+        serializer = serializers.SERIALIZERS['compact']
+        self.assertEqual(serializers.dumps(1, serializer), 'c\x01')
+        self.assertEqual(serializers.dumps([u'a'], serializer), 'c\x91\xa1a')
+
+    def test_falls_back_to_pickle(self):
+        value = {'when': datetime.date(2012, 3, 4)}
+        for name in ('marshal', 'compact'):
+            data = serializers.dumps(value, serializers.SERIALIZERS[name])
+            self.assertEqual(data[0], 'p')
+            self.assertEqual(serializers.loads(data), value)
+
+    def test_unknown_tag(self):
+        self.assertRaises(ValueError, serializers.loads, 'zdata')
+
+    def test_dotted_path(self):
+        self.assertTrue(isinstance(
+            serializers.get_serializer(
+                'appenginecache.serializers.MarshalSerializer'),
+            serializers.MarshalSerializer))
+
+
+class LocalMemoryCacheTests(unittest.TestCase):
+
+    def test_lru_eviction(self):
+        local = LocalMemoryCache(max_entries=2)
+        local.set('a', '1', 10)
+        local.set('b', '2', 10)
+        local.get('a')
+        local.set('c', '3', 10)
+        self.assertEqual(local.get('a'), (True, '1'))
+        self.assertEqual(local.get('b'), (False, None))
+        self.assertEqual(len(local), 2)
+
+    def test_byte_limit(self):
+        local = LocalMemoryCache(max_bytes=100)
+        local.set('big', 'x' * 11, 10)
+        self.assertEqual(local.get('big'), (False, None))
+        for i in range(20):
+            local.set(str(i), 'x' * 10, 10)
+        self.assertEqual(len(local), 10)
+
+    def test_expiry(self):
+        local = LocalMemoryCache()
+        local.set('a', '1', -1)
+        self.assertEqual(local.get('a'), (False, None))
+        self.assertEqual(len(local), 0)
+
+
+class CacheTestsMixin(object):
+
+    options = {}
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_memcache_stub()
+        self.cache = CacheClass(None, {'OPTIONS': self.options})
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def test_set_get(self):
+        self.cache.set('a', {'b': 1})
+        self.assertEqual(self.cache.get('a'), {'b': 1})
+        self.assertEqual(self.cache.get('missing', 'default'), 'default')
+
+    def test_add(self):
+        self.assertTrue(self.cache.add('a', 1))
+        self.assertFalse(self.cache.add('a', 2))
+        self.assertEqual(self.cache.get('a'), 1)
+
+    def test_delete(self):
+        self.cache.set('a', 1)
+        self.cache.delete('a')
+        self.assertEqual(self.cache.get('a'), None)
+
+    def test_incr_decr(self):
+        self.assertRaises(ValueError, self.cache.incr, 'a')
+        self.cache.set('a', 1)
+        self.assertEqual(self.cache.incr('a'), 2)
+        self.assertEqual(self.cache.get('a'), 2)
+        self.assertEqual(self.cache.decr('a', 5), 0)
+
+    def test_cas(self):
+        self.cache.set('a', 1)
+        self.assertEqual(self.cache.gets('a'), 1)
+        self.cache.set('a', 2)
+        self.assertFalse(self.cache.cas('a', 3))
+        self.assertEqual(self.cache.gets('a'), 2)
+        self.assertTrue(self.cache.cas('a', 3))
+        self.assertEqual(self.cache.get('a'), 3)
+
+    def test_update(self):
+        self.assertEqual(self.cache.update('a', lambda v: v + [1], []), [1])
+        self.assertEqual(self.cache.update('a', lambda v: v + [2], []), [1, 2])
+
+    def test_cas_reset(self):
+        self.cache.set('a', 1)
+        self.cache.gets('a')
+        self.cache.cas_reset()
+        self.assertFalse(self.cache.cas('a', 2))
+
+        # As does update, when it's done
+        self.cache.gets('a')
+        self.cache.update('b', lambda v: v + 1, 0)
+        self.assertFalse(self.cache.cas('a', 2))
+
+    def test_get_or_set(self):
+        calls = []
+        def compute():
+            calls.append(1)
+            return 'value'
+        self.assertEqual(self.cache.get_or_set('a', compute), 'value')
+        self.assertEqual(self.cache.get_or_set('a', compute), 'value')
+        self.assertEqual(len(calls), 1)
+
+    def test_get_or_set_none_is_not_stored(self):
+        self.assertEqual(self.cache.get_or_set('a', lambda: None), None)
+        self.assertEqual(self.cache.get_or_set('a', lambda: 1), 1)
+
+    def test_get_or_set_plain_value(self):
+        self.cache.set('a', 'plain')
+        self.assertEqual(self.cache.get_or_set('a', lambda: 'new'), 'plain')
+
+    def test_get_or_set_refreshes_early(self):
+        # Took ages to compute and is about to expire, so it's refreshed
+        self.cache.set('a', Computed('old', 1000, time.time() + 1), 10)
+        self.assertEqual(self.cache.get_or_set('a', lambda: 'new', 10), 'new')
+        self.assertEqual(self.cache.get_or_set('a', lambda: 'newer', 10), 'new')
+
+    def test_get_or_set_early_refresh_is_single_flight(self):
+        self.cache.set('a', Computed('old', 1000, time.time() + 1), 10)
+        memcache.add('a' + LEASE_SUFFIX, 1)
+        self.assertEqual(self.cache.get_or_set('a', lambda: 'new', 10), 'old')
+
+    def test_get_unwraps_computed(self):
+        self.cache.get_or_set('a', lambda: [1], 10)
+        self.assertEqual(self.cache.get('a'), [1])
+        self.assertEqual(self.cache.get_many(['a']), {'a': [1]})
+        self.assertEqual(self.cache.gets('a'), [1])
+
+    def test_get_or_set_waits_for_lease(self):
+        memcache.add('a' + LEASE_SUFFIX, 1)
+        # Someone else holds the lease, so wait for their value
+        threading.Timer(0.05, memcache.set, ('a', '\x00theirs')).start()
+        value = self.cache.get_or_set('a', lambda: 'mine', poll=0.01)
+        self.assertEqual(value, 'theirs')
+
+    def test_many(self):
+        self.cache.set_many({'a': 1, 'b': u'\xe9'})
+        self.assertEqual(
+            self.cache.get_many(['a', 'b', 'c']),
+            {'a': 1, 'b': u'\xe9'.encode('utf-8')})
+        self.cache.delete_many(['a', 'b'])
+        self.assertEqual(self.cache.get_many(['a', 'b']), {})
+
+
+class CacheTests(CacheTestsMixin, unittest.TestCase):
+    pass
+
+
+class NoLocalTierCacheTests(CacheTestsMixin, unittest.TestCase):
+
+    options = {'LOCAL_MAX_ENTRIES': 0}
+
+
+class CompactCacheTests(CacheTestsMixin, unittest.TestCase):
+
+    options = {'SERIALIZER': 'compact', 'COMPRESS_THRESHOLD': 100}
+
+
+class NamespaceTests(unittest.TestCase):
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_memcache_stub()
+        self.cache = CacheClass(None, {'OPTIONS': {'LOCAL_MAX_ENTRIES': 0}})
+        self.a = self.cache.namespace('a')
+        self.b = self.cache.namespace('b')
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def test_separate(self):
+        self.a.set('x', 1)
+        self.b.set('x', 2)
+        self.assertEqual(self.a.get('x'), 1)
+        self.assertEqual(self.b.get('x'), 2)
+        self.assertEqual(self.cache.get('x'), None)
+
+    def test_invalidate(self):
+        self.a.set_many({'x': 1, 'y': 2})
+        self.b.set('x', 2)
+        self.a.invalidate()
+        self.assertEqual(self.a.get_many(['x', 'y']), {})
+        self.assertEqual(self.b.get('x'), 2)
+        self.a.set('x', 3)
+        self.assertEqual(self.a.get_many(['x', 'y']), {'x': 3})
+
+    def test_evicted_generation(self):
+        self.a.set('x', 1)
+        memcache.delete(self.a.generation_key)
+        self.assertEqual(self.a.get('x'), None)
+        self.a.invalidate()
+        self.assertTrue(self.a.get_generation())
+
+    def test_counters(self):
+        self.a.set('n', 1)
+        self.assertEqual(self.a.incr('n'), 2)
+        self.assertEqual(self.a.update('n', lambda n: n * 10), 20)
+        self.assertEqual(self.a.get_or_set('m', lambda: 5), 5)
+        self.assertTrue('m' in self.a)
+
+
+class MetricsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_memcache_stub()
+        self.cache = CacheClass(None, {'OPTIONS': {'METRICS': True,
+            'LOCAL_MAX_ENTRIES': 0, 'COMPRESS_THRESHOLD': 0}})
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def test_get_prefix(self):
+        self.assertEqual(get_prefix('snippet-validators-42'),
+            'snippet-validators')
+        self.assertEqual(get_prefix('sessions:1234:abcdef'), 'sessions')
+        self.assertEqual(get_prefix('latest-snippets:chunk:ab12:0'),
+            'latest-snippets')
+        self.assertEqual(get_prefix('42'), 'other')
+
+    def test_disabled(self):
+        cache = CacheClass(None, {})
+        self.assertEqual(cache.metrics, None)
+        self.assertFalse(isinstance(cache._memcache, InstrumentedMemcache))
+
+    def test_recorded_by_prefix(self):
+        self.cache.set('snippet-html-1', 'x' * 100)
+        self.cache.get('snippet-html-1')
+        self.cache.get('snippet-html-2')
+        self.cache.get_many(['snippet-html-3', 'latest-snippets'])
+
+        metrics = self.cache.metrics.get_metrics()
+        html = metrics['snippet-html']
+        # With the header byte
+        self.assertEqual(html['set']['bytes'], 101)
+        self.assertEqual(html['get']['calls'], 2)
+        self.assertEqual(html['get']['hit_ratio'], 0.5)
+        self.assertEqual(sum(html['get']['histogram'].values()), 2)
+        self.assertEqual(html['get_multi']['misses'], 1)
+        self.assertEqual(metrics['latest-snippets']['get_multi']['calls'], 1)
+
+    def test_request_totals(self):
+        metrics = self.cache.metrics
+        metrics.start_request()
+        self.cache.set('a-1', 'x')
+        self.cache.get('b-1')
+        metrics.record('local_get', 'a-1', 0, hits=1)
+        totals = metrics.end_request()
+        self.assertEqual(sorted(totals), ['a', 'b'])
+        self.assertEqual(totals['a']['calls'], 1)
+        self.assertEqual(totals['a']['local_hits'], 1)
+        self.assertEqual(totals['b']['misses'], 1)
+        self.assertEqual(metrics.end_request(), None)
+
+
+class LocalTierTests(unittest.TestCase):
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_memcache_stub()
+        self.cache = CacheClass(None, {'OPTIONS': {'NEGATIVE_TIMEOUT': 10}})
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def test_served_locally(self):
+        self.cache.set('a', [1])
+        memcache.delete('a')
+        self.assertEqual(self.cache.get('a'), [1])
+        self.assertEqual(self.cache.get_stats()['local_hits'], 1)
+
+    def test_local_values_are_copies(self):
+        self.cache.set('a', [1])
+        self.cache.get('a').append(2)
+        self.assertEqual(self.cache.get('a'), [1])
+
+    def test_negative_cache(self):
+        self.assertEqual(self.cache.get('a'), None)
+        memcache.set('a', 1)
+        self.assertEqual(self.cache.get('a'), None)
+        self.assertEqual(self.cache.get_stats()['memcache_misses'], 1)
+
+    def test_local_timeout(self):
+        self.cache.local_timeout = 0.01
+        self.cache.set('a', 1)
+        memcache.set('a', 2)
+        time.sleep(0.02)
+        self.assertEqual(self.cache.get('a'), 2)
+
+    def test_clear_local(self):
+        self.cache.set('a', 1)
+        memcache.set('a', 2)
+        self.cache.clear_local()
+        self.assertEqual(self.cache.get('a'), 2)
+
+
+class LargeValueTests(unittest.TestCase):
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_memcache_stub()
+        self.cache = CacheClass(None, {'OPTIONS': {'LOCAL_MAX_ENTRIES': 0,
+            'COMPRESS_THRESHOLD': 100, 'CHUNK_SIZE': 1000}})
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def test_stored_as_strings(self):
+        # So that memcache doesn't pickle them again
+        self.cache.set('a', 'small')
+        self.assertEqual(memcache.get('a'), '\x00small')
+        self.cache.set('b', {'a': [1]})
+        self.assertTrue(isinstance(memcache.get('b'), str))
+        self.assertEqual(self.cache.get_many(['a', 'b']),
+            {'a': 'small', 'b': {'a': [1]}})
+        self.cache.set('n', 1)
+        self.assertEqual(self.cache.incr('n'), 2)
+
+    def test_compressed(self):
+        value = {'code': 'print "hello"\n' * 50}
+        self.cache.set('a', value)
+        self.assertEqual(self.cache.get('a'), value)
+
+        stats = self.cache.get_stats()
+        self.assertEqual(stats['compressed_sets'], 1)
+        self.assertEqual(stats['large_gets'], 1)
+        self.assertTrue(stats['compression_ratio'] > 10)
+
+    def test_chunked(self):
+        value = os.urandom(3500)
+        self.cache.set('a', value)
+        self.assertTrue(ord(memcache.get('a')[0]) & CHUNKED)
+        self.assertEqual(self.cache.get('a'), value)
+        self.assertEqual(self.cache.get_stats()['chunked_sets'], 1)
+
+    def test_missing_chunk_is_a_miss(self):
+        self.cache.set('a', os.urandom(3500))
+        token = memcache.get('a')[1:].split(':')[0]
+        memcache.delete(CHUNK_KEY_TEMPLATE % ('a', token, 2))
+        self.assertEqual(self.cache.get('a'), None)
+        self.assertEqual(self.cache.get_stats()['chunk_misses'], 1)
+
+    def test_many(self):
+        values = {'a': os.urandom(2500), 'b': 'x' * 500, 'c': 'small'}
+        self.cache.set_many(values)
+        self.assertEqual(self.cache.get_many(['a', 'b', 'c', 'd']), values)
+
+    def test_update(self):
+        self.cache.set('a', ['x' * 500])
+        self.cache.update('a', lambda value: value + [os.urandom(2000)])
+        self.assertEqual(len(self.cache.get('a')), 2)
+
+
+class BenchmarkTests(unittest.TestCase):
+
+    def test_benchmark(self):
+        out = StringIO()
+        benchmark.run(rounds=1, out=out)
+        self.assertEqual(len(out.getvalue().splitlines()),
+            len(benchmark.PAYLOADS) * (len(serializers.SERIALIZERS) + 1))
+
+
+class LoadTestTests(unittest.TestCase):
+
+    def test_loadtest(self):
+        out = StringIO()
+        loadtest.run(threads=5, ops=5, latency=0, out=out)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(len(lines), len(loadtest.SCENARIOS))
+        # Everything but the naive counter gets the right answer
+        for line in lines[1:]:
+            result = line.split('result ')[1].split(' (')[0]
+            expected = line.split('expected ')[1].split(')')[0]
+            self.assertEqual(result, expected)
@@ -2,7 +2,7 @@ import os
 import django
 from django.conf import settings
 from rosetta.conf import settings as rosetta_settings
-from django.core.cache import cache
+from rosetta.storage import get_rosetta_cache
 
 try:
     set
@@ -28,14 +28,22 @@ def find_pos(lang, project_apps=True, django_apps=False, third_party_apps=False)
 
     # django/locale
     if django_apps:
-        django_paths = cache.get('rosetta_django_paths')
-        if django_paths is None:
+        def find_django_paths():
             django_paths = []
             for root, dirnames, filename in os.walk(os.path.abspath(os.path.dirname(django.__file__))):
                 if 'locale' in dirnames:
                     django_paths.append(os.path.join(root, 'locale'))
                     continue
-            cache.set('rosetta_django_paths', django_paths, 60 * 60)
+            return django_paths
+        rosetta_cache = get_rosetta_cache()
+        if hasattr(rosetta_cache, 'get_or_set'):
+            django_paths = rosetta_cache.get_or_set(
+                'django_paths', find_django_paths, 60 * 60)
+        else:
+            django_paths = rosetta_cache.get('django_paths')
+            if django_paths is None:
+                django_paths = find_django_paths()
+                rosetta_cache.set('django_paths', django_paths, 60 * 60)
         paths = paths + django_paths
     # settings
     for localepath in settings.LOCALE_PATHS:
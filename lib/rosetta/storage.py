@@ -4,6 +4,16 @@ import hashlib
 import time
 
 
+def get_rosetta_cache():
+    """Where all of rosetta's state is cached: the cache's `rosetta`
+    namespace, which can be invalidated at once with `invalidate()`, if the
+    cache backend has namespaces, or else the cache itself
+    """
+    if hasattr(cache, 'namespace'):
+        return cache.namespace('rosetta')
+    return cache
+
+
 class BaseRosettaStorage(object):
     def __init__(self, request):
         self.request = request
@@ -64,19 +74,19 @@ class CacheRosettaStorage(BaseRosettaStorage):
 
     def get(self, key, default=None):
         #print ('get', self._key_prefix + key)
-        return cache.get(self._key_prefix + key, default)
+        return get_rosetta_cache().get(self._key_prefix + key, default)
 
     def set(self, key, val):
         #print ('set', self._key_prefix + key)
-        cache.set(self._key_prefix + key, val)
+        get_rosetta_cache().set(self._key_prefix + key, val)
 
     def has(self, key):
         #print ('has', self._key_prefix + key)
-        return (self._key_prefix + key) in cache
+        return (self._key_prefix + key) in get_rosetta_cache()
 
     def delete(self, key):
         #print ('del', self._key_prefix + key)
-        cache.delete(self._key_prefix + key)
+        get_rosetta_cache().delete(self._key_prefix + key)
 
 
 def get_storage(request):
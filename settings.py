@@ -24,10 +24,22 @@ ADMINS = (
 
 MANAGERS = ADMINS
 
-# A custom cache backend using AppEngine's memcached
+# A custom cache backend using AppEngine's memcached, with a small in-process
+# cache in front of it. Values changed by other instances can be served stale
+# from the local cache for up to `LOCAL_TIMEOUT` seconds.
 CACHES = {
     'default': {
         'BACKEND': 'appenginecache.CacheClass',
+        'OPTIONS': {
+            'LOCAL_MAX_ENTRIES': 1000,
+            'LOCAL_MAX_BYTES': 4 * 1024 * 1024,
+            'LOCAL_TIMEOUT': 3,
+            'NEGATIVE_TIMEOUT': 0,
+            'SERIALIZER': 'pickle',
+            'COMPRESS_THRESHOLD': 10 * 1024,
+            'CHUNK_SIZE': 950 * 1000,
+            'METRICS': False,
+            },
         }
 }
 
@@ -40,6 +52,17 @@ django.contrib.sessions.backends.cache?
 
 SESSION_ENGINE = "appengine_sessions.backends.cached_db"
 
+# Changed sessions are written to the datastore at most once every this many
+# seconds, and unchanged ones only once their expiry date there is this many
+# seconds out of date. See appengine_sessions.backends.cached_db.
+SESSION_WRITE_BACK_INTERVAL = 60
+SESSION_EXPIRY_REFRESH_INTERVAL = 60 * 60
+
+# For appengine_sessions.backends.signed_cookies: sessions whose cookies would
+# be bigger than this are kept with cached_db instead
+SESSION_COOKIE_MAX_SIZE = 4000
+SESSION_COOKIE_COMPRESS = True
+
 # Uncomment these DB definitions to use Cloud SQL.
 # See: https://developers.google.com/cloud-sql/docs/django#development-settings
 
@@ -160,14 +183,23 @@ TEMPLATE_CONTEXT_PROCESSORS = (
 )
 
 MIDDLEWARE_CLASSES = (
+    'appenginecache.middleware.CacheMetricsMiddleware',
     'django.middleware.common.CommonMiddleware',
-    'django.contrib.sessions.middleware.SessionMiddleware',
+    'snippets.middleware.AnonymousFastPathMiddleware',
+    'appengine_sessions.middleware.SessionMiddleware',
     'django.middleware.locale.LocaleMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
 )
 
+# Views whose cached pages anonymous visitors are served before the session and
+# auth middleware run, see snippets.middleware.AnonymousFastPathMiddleware.
+# Empty to turn it off. Requests with a session cookie or one of the login
+# cookies aren't anonymous.
+ANONYMOUS_FAST_PATH_VIEWS = ('snippets:home', 'snippets:snippet-detail')
+ANONYMOUS_FAST_PATH_AUTH_COOKIES = ('ACSID', 'SACSID', 'dev_appserver_login')
+
 ROOT_URLCONF = 'urls'
 
 TEMPLATE_DIRS = (
@@ -186,6 +218,7 @@ INSTALLED_APPS = (
     'django.contrib.staticfiles',
     'snippets',
     'ae18n',
+    'appengine_sessions',
     # Uncomment the next line to enable the admin:
     # 'django.contrib.admin',
     # Uncomment the next line to enable admin documentation:
@@ -233,3 +266,11 @@ REVERSE_PROGRAMMING_LANGUAGE_CHOICES = dict(
         PROGRAMMING_LANGUAGE_CHOICES.keys()
     )
 )
+
+# How many snippets the home page's latest snippets feed shows
+LATEST_SNIPPETS_COUNT = 5
+
+# Where indexing jobs for saved snippets go. Swap in
+# 'snippets.indexing.ThreadPoolIndexQueue' to index in-process without the
+# task queue.
+SNIPPET_INDEX_QUEUE = 'snippets.indexing.TaskQueueIndexQueue'
@@ -0,0 +1,51 @@
+"""
+Cursor based pagination of the comments on a code snippet.
+
+A page of comments is found by an opaque, URL-safe token made from a datastore
+cursor and how many comments come before the page. Knowing that position, and
+the snippet's `CommentCount`, is enough to tell whether there's a page after
+it, so a page never needs a count query and a page deep into a long thread
+costs the same as the first one.
+"""
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+
+from google.appengine.ext import db
+
+from snippets.models import Comment, prefetch_references
+
+
+def encode_token(position, cursor):
+    return urlsafe_b64encode('%d:%s' % (position, cursor))
+
+
+def decode_token(token):
+    "Get `(position, cursor)` from a token, raising `ValueError` if it's bad"
+    try:
+        position, cursor = urlsafe_b64decode(str(token)).split(':', 1)
+        return int(position), cursor
+    except (TypeError, ValueError, UnicodeEncodeError):
+        raise ValueError('Bad comments page token %r' % token)
+
+
+def get_comments_page(snippet, comment_count, token=None, per_page=5):
+    """Get `(comments, next_token)` for the page of the snippet's comments,
+    oldest first, starting at `token` (or the first page if it's `None`).
+    `next_token` is `None` if this is the last page. Raises `ValueError` if
+    `token` is bad, including if its cursor is.
+    """
+    position, cursor = decode_token(token) if token else (0, None)
+
+    query = Comment.all().filter('code_snippet =', snippet).order('created')
+    try:
+        if cursor:
+            query.with_cursor(cursor)
+        comments = query.fetch(per_page)
+    except (db.BadValueError, db.BadArgumentError, db.BadRequestError):
+        raise ValueError('Bad comments page token %r' % token)
+    comments = prefetch_references(comments, 'creator')
+
+    next_token = None
+    position += len(comments)
+    if comments and position < comment_count:
+        next_token = encode_token(position, query.cursor())
+    return comments, next_token
@@ -1,13 +1,49 @@
 from google.appengine.api import users
 
 from django.core.urlresolvers import reverse
+from django.utils.functional import lazy
 
 from models import User
 
 
+# Making a login or logout URL is a users API call, so they're memoized by
+# scheme, host and path, and only made at all if a template uses them. Thrown
+# away once there are this many, rather than growing with every snippet's path.
+MAX_MEMOIZED_URLS = 1000
+
+_login_urls = {}
+_logout_urls = {}
+
+
+def _memoize(urls, key, make_url):
+    url = urls.get(key)
+    if url is None:
+        if len(urls) >= MAX_MEMOIZED_URLS:
+            urls.clear()
+        url = urls[key] = make_url()
+    return url
+
+
+def get_login_url(secure, host, path):
+    "The login URL that comes back to `path` on `host`, over HTTPS if `secure`"
+    return _memoize(_login_urls, (secure, host, path),
+        lambda: users.create_login_url(path))
+
+
+def get_logout_url(secure, host):
+    """The logout URL that goes back to the home page on `host`, over HTTPS if
+    `secure`
+    """
+    return _memoize(_logout_urls, (secure, host),
+        lambda: users.create_logout_url(reverse('snippets:home')))
+
+
 def put_user_in_context(request):
+    secure = request.is_secure()
+    host = request.get_host()
     ctx = {}
-    ctx['user'] = User.get_current()
-    ctx['login_url'] = users.create_login_url(request.path_info)
-    ctx['logout_url'] = users.create_logout_url(reverse('snippets:home'))
+    ctx['user'] = User.get_current(request)
+    ctx['login_url'] = lazy(get_login_url, str)(secure, host,
+        request.path_info)
+    ctx['logout_url'] = lazy(get_logout_url, str)(secure, host)
     return ctx
@@ -17,6 +17,19 @@ class CodeSnippetDocument(DocumentModel):
     created = DateField()
     modified = DateField()
 
+    @classmethod
+    def from_snippet(cls, snippet):
+        "Build the search document for the given `CodeSnippet`"
+        return cls(
+            doc_id=snippet.key().id(),
+            title=snippet.title,
+            code=snippet.code,
+            language_id=snippet.language,
+            language_readable=snippet.get_language(),
+            creator_email=snippet.creator.email,
+            created=snippet.created.date(),
+            modified=snippet.modified.date(),
+        )
 
     def get_absolute_url(self):
         """Bit of redundancy here since this is also on
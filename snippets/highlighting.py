@@ -0,0 +1,124 @@
+"""
+Syntax highlighting for code snippets.
+
+Highlighting is done once, when a snippet is saved, and the HTML is stored
+against the snippet's id and `modified` time in memcache and the datastore.
+Reads only ever serve that stored HTML. If there isn't any for the snippet's
+current version the code is served escaped but unhighlighted, rather than
+highlighting it during the request.
+"""
+import re
+
+from django.core.cache import cache
+from django.utils.html import escape
+from django.utils.safestring import mark_safe
+
+from snippets.models import HighlightedCode
+
+
+CACHE_KEY_TEMPLATE = 'snippet-html-%s-%s'
+CACHE_TIMEOUT = 60 * 60 * 24
+
+# An unclosed comment runs to the end of the code, or every `/*` without a
+# `*/` after it would be rescanned to the end
+_C_STYLE_COMMENT = r'//[^\n]*|/\*(?:[^*]|\*(?!/))*(?:\*/|\Z)'
+_QUOTED_STRING = r'"(?:\\.|[^"\\\n])*"|\'(?:\\.|[^\'\\\n])*\''
+_NUMBER = r'\b\d+(?:\.\d+)?\b'
+
+# Keywords for each of `settings.PROGRAMMING_LANGUAGE_CHOICES`
+KEYWORDS = {
+    'python': """and as assert break class continue def del elif else except
+        exec finally for from global if import in is lambda not or pass print
+        raise return try while with yield None True False self""",
+    'js': """break case catch continue debugger default delete do else
+        finally for function if in instanceof new return switch this throw
+        try typeof var void while with null true false undefined""",
+    'java': """abstract assert boolean break byte case catch char class
+        const continue default do double else enum extends final finally
+        float for goto if implements import instanceof int interface long
+        native new package private protected public return short static
+        strictfp super switch synchronized this throw throws transient try
+        void volatile while null true false""",
+}
+
+COMMENTS = {
+    'python': r'#[^\n]*',
+    'js': _C_STYLE_COMMENT,
+    'java': _C_STYLE_COMMENT,
+}
+
+STRINGS = {
+    # A backslash can only be matched as an escape, or an unterminated triple
+    # quoted string followed by a run of them backtracks exponentially
+    'python': r'"""(?:\\.|[^\\])*?"""|\'\'\'(?:\\.|[^\\])*?\'\'\'|' +
+        _QUOTED_STRING,
+    'js': _QUOTED_STRING,
+    'java': _QUOTED_STRING,
+}
+
+
+def _make_lexer(language):
+    keywords = r'\b(?:%s)\b' % '|'.join(KEYWORDS[language].split())
+    tokens = (
+        ('comment', COMMENTS[language]),
+        ('string', STRINGS[language]),
+        ('keyword', keywords),
+        ('number', _NUMBER),
+    )
+    return re.compile(
+        '|'.join('(?P<%s>%s)' % token for token in tokens), re.DOTALL)
+
+LEXERS = dict((language, _make_lexer(language)) for language in KEYWORDS)
+
+
+def highlight(code, language):
+    """Return `code` as escaped HTML, with comments, strings, keywords and
+    numbers wrapped in `<span>`s classed with their token type if `language`
+    is one that can be highlighted.
+    """
+    code = code or u''
+    lexer = LEXERS.get(language)
+    if lexer is None:
+        return escape(code)
+
+    html = []
+    position = 0
+    for match in lexer.finditer(code):
+        html.append(escape(code[position:match.start()]))
+        html.append(u'<span class="%s">%s</span>' % (
+            match.lastgroup, escape(match.group())))
+        position = match.end()
+    html.append(escape(code[position:]))
+    return u''.join(html)
+
+
+def get_cache_key(snippet):
+    return CACHE_KEY_TEMPLATE % (
+        snippet.key().id(), snippet.modified.isoformat())
+
+
+def store_highlighted(snippet):
+    "Highlight a just saved snippet and store the HTML for reads to serve"
+    html = highlight(snippet.code, snippet.get_language())
+    HighlightedCode(
+        key_name=str(snippet.key().id()),
+        html=html,
+        snippet_modified=snippet.modified,
+    ).put()
+    cache.set(get_cache_key(snippet), html, CACHE_TIMEOUT)
+
+
+def get_highlighted(snippet):
+    """Get the stored HTML for the current version of a snippet, falling back
+    to its escaped but unhighlighted code if there isn't any
+    """
+    key = get_cache_key(snippet)
+    html = cache.get(key)
+    if html is None:
+        stored = HighlightedCode.get_by_key_name(str(snippet.key().id()))
+        if stored is not None and stored.snippet_modified == snippet.modified:
+            html = stored.html
+            cache.set(key, html, CACHE_TIMEOUT)
+        else:
+            html = escape(snippet.code or u'')
+    return mark_safe(html)
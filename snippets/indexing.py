@@ -0,0 +1,231 @@
+"""
+Indexing of code snippets with search.
+
+Saving a snippet queues an indexing job for it rather than indexing it there
+and then. A job is just the snippet's id and version (its `modified` time), and
+a job whose version is out of date by the time it runs is dropped, so a burst
+of edits to one snippet only ends up being indexed once.
+
+For bulk reindexing, the `CodeSnippet` kind is walked with query cursors in
+fixed size batches and each batch is turned into documents and added to the
+index as it's fetched, so nothing bigger than a batch is ever held in memory.
+The cursor is checkpointed in the datastore after every batch, so a run that
+dies or runs out of time carries on from where it stopped the next time it's
+started.
+"""
+import logging
+import threading
+import time
+from Queue import Queue
+
+from google.appengine.api import search as search_api
+from google.appengine.api import taskqueue
+
+from django.conf import settings
+from django.core.urlresolvers import reverse
+from django.utils import importlib
+
+from search.indexes import Index
+
+from snippets import search_cache
+from snippets.documents import CodeSnippetDocument
+from snippets.models import CodeSnippet, ReindexCheckpoint, prefetch_references
+
+
+INDEX_NAME = 'snippets'
+
+# Snippets fetched from the datastore, and so documents added to the index, per
+# batch. The search API won't take more than 200 documents in one call.
+BATCH_SIZE = 100
+
+# How many times adding a batch of documents is tried before giving up, and
+# how long to wait before the first retry (doubled for every one after it)
+MAX_ATTEMPTS = 5
+RETRY_DELAY = 0.5
+
+
+def add_with_retry(index, docs, attempts=MAX_ATTEMPTS, delay=RETRY_DELAY):
+    "Add `docs` to `index`, backing off and retrying if the search API errors"
+    for attempt in xrange(1, attempts + 1):
+        try:
+            index.add(docs)
+            return
+        except search_api.Error:
+            if attempt == attempts:
+                raise
+            logging.warning('Adding %d documents to the index failed '
+                '(attempt %d of %d), retrying in %.1fs', len(docs), attempt,
+                attempts, delay, exc_info=True)
+            time.sleep(delay)
+            delay *= 2
+
+
+def get_snippet_version(snippet):
+    "The version of a saved snippet that an indexing job is for"
+    return snippet.modified.isoformat()
+
+
+def process_index_job(snippet_id, version, index_name=INDEX_NAME):
+    """Index version `version` of the snippet with id `snippet_id`, unless it's
+    been deleted or edited since, in which case there'll be a job for the newer
+    version. Returns whether the snippet was indexed.
+    """
+    snippet = CodeSnippet.get_by_id(int(snippet_id))
+    if snippet is None or get_snippet_version(snippet) != version:
+        return False
+
+    add_with_retry(
+        Index(name=index_name),
+        [CodeSnippetDocument.from_snippet(snippet)]
+    )
+    search_cache.bump_generation(index_name)
+    return True
+
+
+class BaseIndexQueue(object):
+    "Somewhere to put indexing jobs for a worker to process"
+
+    def enqueue(self, snippet_id, version):
+        raise NotImplementedError
+
+    def enqueue_snippet(self, snippet):
+        "Queue an indexing job for the current version of a saved snippet"
+        self.enqueue(snippet.key().id(), get_snippet_version(snippet))
+
+
+class TaskQueueIndexQueue(BaseIndexQueue):
+    """Queues jobs as App Engine tasks for the `snippets:index-snippet` view.
+    Tasks are held back for `countdown` seconds so that a run of edits has
+    finished, and every job but the last one is stale, by the time they run.
+    """
+    queue_name = 'default'
+    countdown = 5
+
+    def enqueue(self, snippet_id, version):
+        taskqueue.add(
+            queue_name=self.queue_name,
+            url=reverse('snippets:index-snippet'),
+            params={'snippet_id': snippet_id, 'version': version},
+            countdown=self.countdown,
+        )
+
+
+class ThreadPoolIndexQueue(BaseIndexQueue):
+    """An in-process stand-in for the task queue, processing jobs on a pool of
+    worker threads. Jobs for a snippet that already has one waiting are folded
+    into the waiting job, which then indexes the newest version.
+    """
+    workers = 2
+
+    def __init__(self, workers=None):
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._queue = Queue()
+        for _ in xrange(workers or self.workers):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+
+    def enqueue(self, snippet_id, version):
+        with self._lock:
+            waiting = snippet_id in self._pending
+            self._pending[snippet_id] = version
+        if not waiting:
+            self._queue.put(snippet_id)
+
+    def join(self):
+        "Block until every queued job has been processed"
+        self._queue.join()
+
+    def _work(self):
+        while True:
+            snippet_id = self._queue.get()
+            try:
+                with self._lock:
+                    version = self._pending.pop(snippet_id)
+                process_index_job(snippet_id, version)
+            except Exception:
+                logging.exception('Indexing snippet %s failed', snippet_id)
+            finally:
+                self._queue.task_done()
+
+
+_index_queue = None
+
+def get_index_queue():
+    "Get the indexing queue configured by `settings.SNIPPET_INDEX_QUEUE`"
+    global _index_queue
+    if _index_queue is None:
+        queue_module, queue_class = settings.SNIPPET_INDEX_QUEUE.rsplit('.', 1)
+        queue_module = importlib.import_module(queue_module)
+        _index_queue = getattr(queue_module, queue_class)()
+    return _index_queue
+
+
+def iter_snippet_batches(cursor=None, batch_size=BATCH_SIZE):
+    """Yields `(snippets, cursor)` for every batch of `batch_size` snippets
+    after `cursor`, where the yielded cursor points to just after the batch.
+    Each batch's creators are prefetched for building documents.
+    """
+    while True:
+        query = CodeSnippet.all()
+        if cursor:
+            query.with_cursor(cursor)
+        snippets = query.fetch(batch_size)
+        if not snippets:
+            return
+
+        cursor = query.cursor()
+        yield prefetch_references(snippets, 'creator'), cursor
+
+        if len(snippets) < batch_size:
+            return
+
+
+def reindex_snippets(index_name=INDEX_NAME, batch_size=BATCH_SIZE,
+        time_limit=None, restart=False):
+    """Add every code snippet to the search index `index_name`, resuming from
+    the last checkpoint unless `restart` is `True`. If `time_limit` is given no
+    new batch is started once that many seconds have passed.
+
+    Returns a dict of `indexed` (this run), `total` (since the reindex
+    started), `done` and `docs_per_sec`.
+    """
+    checkpoint = ReindexCheckpoint.get_by_key_name(index_name)
+    if checkpoint is None or restart:
+        checkpoint = ReindexCheckpoint(key_name=index_name)
+
+    index = Index(name=index_name)
+    started = time.time()
+    indexed = 0
+    done = True
+
+    for snippets, cursor in iter_snippet_batches(checkpoint.cursor, batch_size):
+        docs = [CodeSnippetDocument.from_snippet(s) for s in snippets]
+        add_with_retry(index, docs)
+        search_cache.bump_generation(index_name)
+
+        indexed += len(docs)
+        checkpoint.cursor = cursor
+        checkpoint.indexed += len(docs)
+        checkpoint.put()
+
+        elapsed = time.time() - started
+        logging.info('Reindexed %d snippets into %s (%d in total), '
+            '%.1f docs/sec', indexed, index_name, checkpoint.indexed,
+            indexed / max(elapsed, 0.001))
+
+        if time_limit is not None and elapsed > time_limit:
+            done = False
+            break
+
+    if done and checkpoint.is_saved():
+        checkpoint.delete()
+
+    elapsed = time.time() - started
+    return {
+        'indexed': indexed,
+        'total': checkpoint.indexed,
+        'done': done,
+        'docs_per_sec': indexed / max(elapsed, 0.001),
+    }
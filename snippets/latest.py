@@ -0,0 +1,132 @@
+"""
+The feed of latest snippets shown on the home page.
+
+The feed is kept up to date as snippets are saved rather than queried for on
+every page view. It's spread over a few datastore shards, each of which holds
+the newest `settings.LATEST_SNIPPETS_COUNT` entries for the snippets whose ids
+fall in it, so that saves don't all contend on one entity. Reads merge the
+shards, fetched with one batch get, and cache the result in memcache.
+
+The cached feed is in a namespace of its own, which saves invalidate once
+they've updated the shards, so a read that merged the shards before the save
+can only cache what it got under the old generation, where it's never read.
+The shards are rebuilt if `LATEST_SNIPPETS_COUNT` is raised, since they only
+hold as many entries as it was when they were filled.
+"""
+from django.conf import settings
+from django.core.cache import cache
+from django.core.urlresolvers import reverse
+
+from google.appengine.ext import db
+
+from snippets.models import CodeSnippet, LatestSnippetsShard, prefetch_references
+
+
+SHARDS = 5
+
+CACHE_KEY = 'feed'
+CACHE_TIMEOUT = 60 * 10
+
+latest_snippets = cache.namespace('latest-snippets')
+
+
+class LatestSnippet(object):
+    "A compact entry for a snippet in the feed"
+
+    def __init__(self, id, title, language, creator_email, created, modified):
+        self.id = id
+        self.title = title
+        self.language = language
+        self.creator_email = creator_email
+        self.created = created
+        self.modified = modified
+
+    def get_language(self):
+        return settings.PROGRAMMING_LANGUAGE_CHOICES.get(self.language)
+
+    def get_absolute_url(self):
+        return reverse('snippets:snippet-detail',
+            kwargs={'snippet_id': self.id})
+
+
+def make_entry(snippet):
+    creator = snippet.creator
+    return (
+        snippet.key().id(),
+        snippet.title,
+        snippet.language,
+        creator.email if creator else None,
+        snippet.created,
+        snippet.modified,
+    )
+
+
+def _newest(entries, count):
+    "The newest `count` of `entries`, newest first"
+    return sorted(entries, key=lambda e: e[5], reverse=True)[:count]
+
+
+def _shard_name(snippet_id):
+    return 'shard-%d' % (snippet_id % SHARDS)
+
+
+def add_to_latest_snippets(snippet):
+    "Put a just saved snippet at the top of the feed"
+    entry = make_entry(snippet)
+    count = settings.LATEST_SNIPPETS_COUNT
+
+    def txn():
+        name = _shard_name(entry[0])
+        shard = LatestSnippetsShard.get_by_key_name(name)
+        if shard is None:
+            shard = LatestSnippetsShard(key_name=name)
+        entries = [e for e in shard.entries if e[0] != entry[0]]
+        shard.entries = _newest(entries + [entry], count)
+        shard.put()
+
+    db.run_in_transaction(txn)
+    latest_snippets.invalidate()
+
+
+def _rebuild_shards():
+    count = settings.LATEST_SNIPPETS_COUNT
+    snippets = prefetch_references(
+        CodeSnippet.all().order('-modified').fetch(count), 'creator')
+
+    shards = dict((name, []) for name in map(_shard_name, xrange(SHARDS)))
+    for snippet in snippets:
+        shards[_shard_name(snippet.key().id())].append(make_entry(snippet))
+
+    to_put = []
+    for name, entries in shards.items():
+        shard = LatestSnippetsShard(key_name=name, count=count)
+        shard.entries = entries
+        to_put.append(shard)
+    db.put(to_put)
+    return _newest(sum(shards.values(), []), count)
+
+
+def rebuild_latest_snippets():
+    "Rebuild the feed's shards from a query for the latest snippets"
+    entries = _rebuild_shards()
+    latest_snippets.invalidate()
+    return entries
+
+
+def get_latest_snippets():
+    "Get the feed of the latest snippets, newest first"
+    def merge_shards():
+        count = settings.LATEST_SNIPPETS_COUNT
+        keys = [db.Key.from_path(LatestSnippetsShard.kind(), _shard_name(i))
+            for i in xrange(SHARDS)]
+        shards = db.get(keys)
+
+        if any(shard is None or (shard.count or 0) < count
+                for shard in shards):
+            return _rebuild_shards()
+        entries = sum((shard.entries for shard in shards), [])
+        return _newest(entries, count)
+
+    entries = latest_snippets.get_or_set(CACHE_KEY, merge_shards,
+        CACHE_TIMEOUT)
+    return [LatestSnippet(*entry) for entry in entries]
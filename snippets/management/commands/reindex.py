@@ -0,0 +1,27 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from snippets.indexing import BATCH_SIZE, INDEX_NAME, reindex_snippets
+
+
+class Command(BaseCommand):
+    help = "Add every code snippet to the search index, resuming from the " \
+        "last checkpoint"
+
+    option_list = BaseCommand.option_list + (
+        make_option('-i', '--index', dest='index', default=INDEX_NAME),
+        make_option('-b', '--batch-size', dest='batch_size', type='int',
+            default=BATCH_SIZE),
+        make_option('-r', '--restart', dest='restart', action='store_true',
+            default=False, help="Ignore any checkpoint and start again"),
+    )
+
+    def handle(self, *args, **opts):
+        stats = reindex_snippets(
+            index_name=opts['index'],
+            batch_size=opts['batch_size'],
+            restart=opts['restart'],
+        )
+        return 'Indexed %(indexed)d snippets (%(total)d in total) at ' \
+            '%(docs_per_sec).1f docs/sec\n' % stats
@@ -0,0 +1,83 @@
+from google.appengine.api import users
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured, MiddlewareNotUsed
+from django.core.urlresolvers import resolve
+from django.http import Http404
+from django.middleware.csrf import CsrfViewMiddleware
+from django.middleware.locale import LocaleMiddleware
+from django.views.decorators.http import condition
+
+from snippets.page_cache import get_anonymous_page
+from snippets.views import ANONYMOUS_PAGE_KEYS, ANONYMOUS_PAGE_VALIDATORS
+
+
+class AnonymousFastPathMiddleware(object):
+    """Serves the pages of the views named in
+    `settings.ANONYMOUS_FAST_PATH_VIEWS` straight from the anonymous page
+    cache to GETs without a session or login cookie, before the session and
+    auth middleware, the views or the context processors do anything. Pages
+    that aren't cached yet go the normal way, which caches them. Pages of views
+    with validators get their ETag and Last-Modified headers, and conditional
+    GETs for them are answered with a 304, as the views themselves would.
+
+    It has to come before the session middleware, and needs the locale and
+    CSRF middleware to be after it too, since it does their work itself for
+    the requests it serves. Not used if there are no views to serve.
+    """
+
+    def __init__(self):
+        view_names = getattr(settings, 'ANONYMOUS_FAST_PATH_VIEWS', ())
+        if not view_names:
+            raise MiddlewareNotUsed
+
+        self.page_keys = {}
+        self.conditions = {}
+        for name in view_names:
+            if name not in ANONYMOUS_PAGE_KEYS:
+                raise ImproperlyConfigured(
+                    "The anonymous fast path can't serve the view %r" % name)
+            self.page_keys[name] = ANONYMOUS_PAGE_KEYS[name]
+            if name in ANONYMOUS_PAGE_VALIDATORS:
+                etag_func, last_modified_func = ANONYMOUS_PAGE_VALIDATORS[name]
+                self.conditions[name] = condition(etag_func=etag_func,
+                    last_modified_func=last_modified_func)
+
+        self.cookie_names = (settings.SESSION_COOKIE_NAME,) + tuple(
+            getattr(settings, 'ANONYMOUS_FAST_PATH_AUTH_COOKIES', ()))
+        self.locale = LocaleMiddleware()
+        self.csrf = CsrfViewMiddleware()
+
+    def process_request(self, request):
+        if request.method != 'GET':
+            return None
+        for name in self.cookie_names:
+            if name in request.COOKIES:
+                return None
+        if users.get_current_user() is not None:
+            return None
+
+        try:
+            match = resolve(request.path_info)
+        except Http404:
+            return None
+        get_page_key = self.page_keys.get(match.view_name)
+        if get_page_key is None:
+            return None
+
+        # The page key has the request's language in it, and a cached page
+        # gets the visitor's CSRF token
+        self.locale.process_request(request)
+        page_key = get_page_key(request, *match.args, **match.kwargs)
+        if page_key is None:
+            return None
+        self.csrf.process_view(request, match.func, match.args, match.kwargs)
+        response = get_anonymous_page(request, page_key)
+        if response is None:
+            return None
+
+        conditional = self.conditions.get(match.view_name)
+        if conditional is not None:
+            response = conditional(lambda request, *args, **kwargs: response)(
+                request, *match.args, **match.kwargs)
+        return response
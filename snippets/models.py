@@ -1,7 +1,10 @@
+import pickle
+
 from google.appengine.ext import db
 from google.appengine.api import users
 
 from django.conf import settings
+from django.core.cache import cache
 from django.core.urlresolvers import reverse
 
 
@@ -12,6 +15,12 @@ class KeyRequiredError(Exception):
 class User(db.Model):
     "A reference to a user from the `google.appengine.api.users`"
 
+    # Where the current user's identity is cached, as `(gaia_id, email)` in
+    # the session and as the email alone in memcache
+    SESSION_KEY = '_snippets_user'
+    CACHE_KEY_TEMPLATE = 'snippets-user-%s'
+    CACHE_TIMEOUT = 60 * 60
+
     gaia_id = db.StringProperty()
     email = db.StringProperty()
 
@@ -33,22 +42,54 @@ class User(db.Model):
         super(User, self).__init__(**kwargs)
 
     @classmethod
-    def get_current(cls):
-        "Get the current user based on the current users API GAIA account"
-        # TODO: extend to use request.session, it'll be much faster
+    def get_current(cls, request=None):
+        """Get the current user based on the current users API GAIA account.
+
+        If `request` is given the user is memoized on it for the rest of the
+        request and cached in `request.session`, so warm page renders don't
+        touch the datastore at all.
+        """
+        if request is not None and hasattr(request, '_snippets_user'):
+            return request._snippets_user
+
         user = users.get_current_user()
-        if not user:
-            return user
+        db_user = None
+        if user:
+            db_user = cls._get_for_account(
+                str(user.user_id()), user.email(), request)
 
-        id = str(user.user_id())
-        email = user.email()
+        if request is not None:
+            request._snippets_user = db_user
+        return db_user
 
-        # If we don't have a user in the database for this person, create
-        # them now
-        db_user = cls.get_by_key_name(id)
-        if db_user is None:
+    @classmethod
+    def _get_for_account(cls, id, email, request=None):
+        """Get the user with the given GAIA id, checking the session, then
+        memcache, then the datastore. A cached identity is only trusted if its
+        email still matches the account's, otherwise the stored user is
+        refetched and updated.
+        """
+        session = getattr(request, 'session', None)
+        if session is not None and session.get(cls.SESSION_KEY) == (id, email):
+            return cls(key_name=id, email=email)
+
+        cache_key = cls.CACHE_KEY_TEMPLATE % id
+        if cache.get(cache_key) == email:
             db_user = cls(key_name=id, email=email)
-            db_user.put()
+        else:
+            # If we don't have a user in the database for this person, create
+            # them now
+            db_user = cls.get_by_key_name(id)
+            if db_user is None:
+                db_user = cls(key_name=id, email=email)
+                db_user.put()
+            elif db_user.email != email:
+                db_user.email = email
+                db_user.put()
+            cache.set(cache_key, email, cls.CACHE_TIMEOUT)
+
+        if session is not None:
+            session[cls.SESSION_KEY] = (id, email)
         return db_user
 
 
@@ -100,6 +141,48 @@ class CodeSnippet(Base):
             kwargs = {'snippet_id': self.key().id()}
             return reverse('snippets:snippet-detail', kwargs=kwargs)
 
+    @classmethod
+    def get_comment_count_key(cls, snippet_id):
+        return db.Key.from_path(CommentCount.kind(), str(snippet_id))
+
+    def add_comment(self, body, user):
+        """Add a comment by `user` to this snippet, counting it in the
+        snippet's `CommentCount` in the same transaction
+        """
+        comment = Comment(
+            body=body, code_snippet=self, creator=user, modifier=user)
+        counter_key = self.get_comment_count_key(self.key().id())
+        if db.get(counter_key) is None:
+            self.backfill_comment_count()
+
+        def txn():
+            counter = db.get(counter_key) or CommentCount(key=counter_key)
+            counter.count += 1
+            db.put([comment, counter])
+
+        options = db.create_transaction_options(xg=True)
+        db.run_in_transaction_options(options, txn)
+        update_snippet_validators(self, comment.created)
+        return comment
+
+    def backfill_comment_count(self):
+        """Count this snippet's comments into its `CommentCount`, for snippets
+        commented on before there were counters. Returns the counter, which is
+        left as it is if it's been made since.
+        """
+        counter_key = self.get_comment_count_key(self.key().id())
+        count = Comment.all(keys_only=True).filter(
+            'code_snippet =', self).count(limit=None)
+
+        def txn():
+            counter = db.get(counter_key)
+            if counter is None:
+                counter = CommentCount(key=counter_key, count=count)
+                counter.put()
+            return counter
+
+        return db.run_in_transaction(txn)
+
 
 class Comment(Base):
     "A comment on a code snippet"
@@ -119,3 +202,75 @@ class Comment(Base):
         reference_class=User,
         collection_name=MODIFIER_COLLECTION_NAME
     )
+
+
+class CommentCount(db.Model):
+    """The number of comments on a code snippet, keyed on the snippet's id.
+    It's kept apart from the snippet so that commenting doesn't change the
+    snippet's `modified` time.
+    """
+    count = db.IntegerProperty(default=0)
+
+
+class HighlightedCode(db.Model):
+    """The syntax highlighted HTML for a code snippet, keyed on the snippet's
+    id, along with the `modified` time of the version it was made from
+    """
+    html = db.TextProperty()
+    snippet_modified = db.DateTimeProperty()
+
+
+class LatestSnippetsShard(db.Model):
+    """A shard of the latest snippets feed, and the feed length it was last
+    filled for, see `snippets.latest`
+    """
+    data = db.BlobProperty()
+    count = db.IntegerProperty()
+
+    def _get_entries(self):
+        return pickle.loads(self.data) if self.data else []
+
+    def _set_entries(self, entries):
+        self.data = db.Blob(pickle.dumps(entries, pickle.HIGHEST_PROTOCOL))
+
+    entries = property(_get_entries, _set_entries)
+
+
+class ReindexCheckpoint(Base):
+    """How far a bulk reindex of a search index has got, keyed on the name of
+    the index, so that an interrupted reindex can carry on where it stopped
+    """
+    cursor = db.TextProperty()
+    indexed = db.IntegerProperty(default=0)
+
+
+def prefetch_references(entities, *prop_names):
+    """Resolve the `ReferenceProperty`s named by `prop_names` (by default
+    `creator` and `modifier`) on every one of `entities` with a single batched
+    `db.get`, so that dereferencing them afterwards doesn't cost a datastore
+    get per entity. `entities` can be a list or a query, the fetched entities
+    are returned as a list.
+    """
+    entities = list(entities)
+    prop_names = prop_names or ('creator', 'modifier')
+
+    refs = []
+    for entity in entities:
+        for name in prop_names:
+            prop = getattr(entity.__class__, name)
+            key = prop.get_value_for_datastore(entity)
+            if key is not None:
+                refs.append((entity, prop, key))
+
+    keys = list(set(key for _, _, key in refs))
+    referenced = dict(
+        (e.key(), e) for e in db.get(keys) if e is not None) if keys else {}
+
+    for entity, prop, key in refs:
+        if key in referenced:
+            prop.__set__(entity, referenced[key])
+    return entities
+
+
+# At the bottom to win against circular imports
+from snippets.page_cache import update_snippet_validators
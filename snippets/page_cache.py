@@ -0,0 +1,102 @@
+"""
+HTTP validators and full page caching for snippet pages.
+
+A snippet's validators are its `modified` time and the `created` time of its
+latest comment. They're kept in memcache so that working out whether a
+client's copy of a page is still fresh doesn't mean loading the snippet, and
+its code, from the datastore. Anything that changes a snippet or its comments
+needs to call `update_snippet_validators`, which stores the new ones there and
+then, so they're only ever loaded from the datastore if memcache drops them.
+
+Anonymous visitors all get the same page, so whole responses for them are
+cached in memcache too. The CSRF token in a cached page is swapped for a
+marker before it's cached and for the visitor's own token when it's served.
+
+Both are kept in the `pages` cache namespace, so that every cached page can be
+thrown away at once with `pages.invalidate()`, say after a template changes.
+Home pages have their own generation in their keys too, which saving a snippet
+bumps with `invalidate_home_pages`, since every one of them lists it.
+"""
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.middleware.csrf import get_token
+
+
+VALIDATORS_KEY_TEMPLATE = 'snippet-validators-%s'
+VALIDATORS_TIMEOUT = 60 * 60
+
+ANONYMOUS_PAGE_KEY_TEMPLATE = 'anonymous-page-%s'
+ANONYMOUS_PAGE_TIMEOUT = 60 * 10
+
+CSRF_TOKEN_MARKER = '__csrf_token__'
+
+pages = cache.namespace('pages')
+
+# Only used for its generation, see `get_home_pages_generation`
+home_pages = cache.namespace('home-pages')
+
+
+def _get_last_commented(snippet):
+    last_comment = snippet.comments.order('-created').get()
+    return last_comment.created if last_comment else None
+
+
+def get_snippet_validators(snippet_id):
+    """Get `(modified, last_commented)` for the snippet with id `snippet_id`,
+    or `None` if there's no such snippet. `last_commented` is `None` if it has
+    no comments.
+    """
+    key = VALIDATORS_KEY_TEMPLATE % snippet_id
+    validators = pages.get(key)
+    if validators is None:
+        snippet = CodeSnippet.get_by_id(int(snippet_id))
+        if snippet is None:
+            return None
+        validators = (snippet.modified, _get_last_commented(snippet))
+        # Added rather than set, so that these can't replace newer ones that
+        # `update_snippet_validators` has stored since the snippet was loaded
+        pages.add(key, validators, VALIDATORS_TIMEOUT)
+    return validators
+
+
+def update_snippet_validators(snippet, last_commented=None):
+    """Store the validators of a snippet that's just been saved, or commented
+    on at `last_commented`. They're stored rather than deleted so that nobody
+    who loaded the old ones beforehand can cache them again afterwards.
+    """
+    if last_commented is None:
+        last_commented = _get_last_commented(snippet)
+    pages.set(VALIDATORS_KEY_TEMPLATE % snippet.key().id(),
+        (snippet.modified, last_commented), VALIDATORS_TIMEOUT)
+
+
+def get_home_pages_generation():
+    "What goes in the key of every home page to invalidate them all at once"
+    return home_pages.get_generation()
+
+
+def invalidate_home_pages():
+    home_pages.invalidate()
+
+
+def get_anonymous_page(request, page_key):
+    "Get the cached response for the page with key `page_key`, if there is one"
+    content = pages.get(ANONYMOUS_PAGE_KEY_TEMPLATE % page_key)
+    if content is None:
+        return None
+    return HttpResponse(
+        content.replace(CSRF_TOKEN_MARKER, get_token(request) or ''))
+
+
+def set_anonymous_page(request, page_key, response):
+    "Cache a rendered response under the key `page_key`"
+    content = response.content
+    token = get_token(request)
+    if token:
+        content = content.replace(token, CSRF_TOKEN_MARKER)
+    pages.set(ANONYMOUS_PAGE_KEY_TEMPLATE % page_key, content,
+        ANONYMOUS_PAGE_TIMEOUT)
+
+
+# At the bottom to win against circular imports
+from snippets.models import CodeSnippet
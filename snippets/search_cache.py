@@ -0,0 +1,73 @@
+"""
+A cache of search result pages.
+
+Each page is cached along with its total count and next page cursor under a
+key made from the normalized search (index name, keywords, filters, limit and
+page cursor), in a cache namespace of the index's own. Anything that changes an
+index bumps its namespace's generation, so entries cached before the change are
+never looked up again and just expire.
+"""
+import threading
+from hashlib import md5
+
+from django.core.cache import cache
+
+
+NAMESPACE_TEMPLATE = 'search-%s'
+RESULTS_KEY_TEMPLATE = 'search-results-%s'
+
+# Seconds a page of results is cached for
+RESULTS_TIMEOUT = 60 * 10
+
+_stats = {'lookups': 0, 'misses': 0}
+_stats_lock = threading.Lock()
+
+
+def _count(name):
+    with _stats_lock:
+        _stats[name] += 1
+
+
+def get_stats():
+    "Hit and miss counts for this instance, as a dict"
+    with _stats_lock:
+        stats = dict(_stats)
+    stats['hits'] = stats['lookups'] - stats['misses']
+    return stats
+
+
+def get_namespace(index_name):
+    "The cache namespace for results from the search index `index_name`"
+    return cache.namespace(NAMESPACE_TEMPLATE % index_name)
+
+
+def bump_generation(index_name):
+    "Invalidate all of the cached results for the search index `index_name`"
+    get_namespace(index_name).invalidate()
+
+
+def make_key(index_name, keywords, filters, limit, cursor=None):
+    "The key, in the index's namespace, for a page of results for a search"
+    normalized = (
+        index_name,
+        u' '.join(keywords.split()).lower(),
+        sorted(filters.items()),
+        limit,
+        cursor,
+    )
+    return RESULTS_KEY_TEMPLATE % md5(repr(normalized)).hexdigest()
+
+
+def get_results(index_name, keywords, filters, limit, cursor, search):
+    """Get `(results, count, next_cursor)` for the given search from the
+    cache, calling `search()` to run the search and caching what it returns on
+    a miss. Concurrent misses for one search only run it once.
+    """
+    def counted_search():
+        _count('misses')
+        return search()
+
+    key = make_key(index_name, keywords, filters, limit, cursor)
+    _count('lookups')
+    return get_namespace(index_name).get_or_set(
+        key, counted_search, RESULTS_TIMEOUT)
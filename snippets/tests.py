@@ -4,8 +4,36 @@ when you run "manage.py test".
 
 Replace this with more appropriate tests for your application.
 """
+import threading
+import time
+import unittest
+from datetime import date
 
+from google.appengine.api import search as search_api
+from google.appengine.api import users
+from google.appengine.ext import db, testbed
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse
 from django.test import TestCase
+from django.test.client import RequestFactory
+
+from snippets import context_processors, indexing, latest, search_cache
+from snippets.highlighting import (get_highlighted, highlight,
+    store_highlighted)
+from snippets.comments import (decode_token, encode_token,
+    get_comments_page)
+from snippets.latest import add_to_latest_snippets, get_latest_snippets
+from snippets.middleware import AnonymousFastPathMiddleware
+from snippets.page_cache import (get_anonymous_page, get_snippet_validators,
+    invalidate_home_pages, set_anonymous_page, update_snippet_validators)
+from snippets.indexing import (ThreadPoolIndexQueue, get_snippet_version,
+    iter_snippet_batches, process_index_job)
+from snippets.models import CodeSnippet, Comment, User, prefetch_references
+from snippets.documents import CodeSnippetDocument
+from snippets.views import (Home, get_home_page_key,
+    get_snippet_detail_page_key)
 
 
 class SimpleTest(TestCase):
@@ -14,3 +42,580 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+
+class FakeRequest(object):
+    def __init__(self, session=None):
+        self.COOKIES = {}
+        self.GET = {}
+        self.META = {}
+        self.session = {} if session is None else session
+
+
+class SnippetsTestMixin(object):
+    "Sets up the datastore, memcache and users stubs with a logged in user"
+
+    user_id = '1234'
+    user_email = 'potato@example.com'
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub()
+        self.testbed.init_memcache_stub()
+        self.testbed.init_user_stub()
+        cache.clear_local()
+        self.login(self.user_id, self.user_email)
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def login(self, user_id, email):
+        self.testbed.setup_env(
+            USER_ID=user_id, USER_EMAIL=email, overwrite=True)
+
+    def logout(self):
+        self.testbed.setup_env(USER_ID='', USER_EMAIL='', overwrite=True)
+
+
+class UserTests(SnippetsTestMixin, unittest.TestCase):
+
+    def test_logged_out(self):
+        self.logout()
+        self.assertEqual(User.get_current(FakeRequest()), None)
+
+    def test_creates_user(self):
+        user = User.get_current(FakeRequest())
+        self.assertEqual(user.email, self.user_email)
+        self.assertTrue(User.get_by_key_name(self.user_id) is not None)
+
+    def test_memoized_on_request(self):
+        request = FakeRequest()
+        self.assertTrue(User.get_current(request) is User.get_current(request))
+
+    def test_warm_lookup_skips_datastore(self):
+        request = FakeRequest()
+        User.get_current(request)
+        # Remove the stored user, a warm lookup shouldn't notice
+        db.delete(db.Key.from_path('User', self.user_id))
+
+        user = User.get_current(FakeRequest(session=request.session))
+        self.assertEqual(user.key().name(), self.user_id)
+        user = User.get_current(FakeRequest())
+        self.assertEqual(user.email, self.user_email)
+
+    def test_email_change_invalidates(self):
+        request = FakeRequest()
+        User.get_current(request)
+        self.login(self.user_id, 'chips@example.com')
+
+        user = User.get_current(FakeRequest(session=request.session))
+        self.assertEqual(user.email, 'chips@example.com')
+        self.assertEqual(
+            User.get_by_key_name(self.user_id).email, 'chips@example.com')
+        self.assertEqual(
+            cache.get(User.CACHE_KEY_TEMPLATE % self.user_id),
+            'chips@example.com')
+
+
+class PrefetchReferencesTests(SnippetsTestMixin, unittest.TestCase):
+
+    def test_prefetch(self):
+        user = User.get_current(FakeRequest())
+        snippet = CodeSnippet(title='a', code='b', creator=user, modifier=user)
+        snippet.put()
+        Comment(body='c', code_snippet=snippet, creator=user).put()
+
+        snippets = prefetch_references(CodeSnippet.all())
+        comments = prefetch_references(Comment.all(), 'creator')
+        # Everything is resolved up front, so the stored user isn't needed
+        db.delete(user)
+
+        self.assertEqual(snippets[0].creator.email, self.user_email)
+        self.assertEqual(snippets[0].modifier.email, self.user_email)
+        self.assertEqual(comments[0].creator.email, self.user_email)
+
+    def test_missing_references(self):
+        CodeSnippet(title='a', code='b').put()
+        snippets = prefetch_references(CodeSnippet.all())
+        self.assertEqual(snippets[0].creator, None)
+
+
+class ReindexTests(SnippetsTestMixin, unittest.TestCase):
+
+    def test_iter_snippet_batches(self):
+        user = User.get_current(FakeRequest())
+        for i in range(5):
+            CodeSnippet(title=str(i), code='', creator=user).put()
+
+        batches = list(iter_snippet_batches(batch_size=2))
+        self.assertEqual([len(b) for b, _ in batches], [2, 2, 1])
+
+        # Resuming from a checkpointed cursor only sees what's left
+        resumed = list(iter_snippet_batches(batches[0][1], batch_size=2))
+        self.assertEqual([len(b) for b, _ in resumed], [2, 1])
+
+
+class IndexQueueTests(SnippetsTestMixin, unittest.TestCase):
+
+    def setUp(self):
+        super(IndexQueueTests, self).setUp()
+        self.jobs = []
+        self.release = threading.Event()
+        self.old_process_index_job = indexing.process_index_job
+
+        def process_index_job(snippet_id, version):
+            self.release.wait()
+            self.jobs.append((snippet_id, version))
+        indexing.process_index_job = process_index_job
+
+    def tearDown(self):
+        indexing.process_index_job = self.old_process_index_job
+        super(IndexQueueTests, self).tearDown()
+
+    def test_thread_pool_coalesces(self):
+        queue = ThreadPoolIndexQueue(workers=1)
+        # The only worker is stuck on this until released
+        queue.enqueue(1, 'a')
+        queue.enqueue(2, 'a')
+        queue.enqueue(2, 'b')
+        queue.enqueue(2, 'c')
+        self.release.set()
+        queue.join()
+
+        self.assertEqual(self.jobs, [(1, 'a'), (2, 'c')])
+
+    def test_stale_job_is_dropped(self):
+        snippet = CodeSnippet(title='a', code='b')
+        snippet.put()
+        version = get_snippet_version(snippet)
+        snippet.put()
+
+        self.assertNotEqual(get_snippet_version(snippet), version)
+        self.assertFalse(
+            self.old_process_index_job(snippet.key().id(), version))
+
+
+class SearchCacheTests(SnippetsTestMixin, unittest.TestCase):
+
+    def search(self):
+        self.searches += 1
+        return ['result'], 1, None
+
+    def get_results(self, keywords, filters=None, cursor=None):
+        return search_cache.get_results(
+            'snippets', keywords, filters or {}, 5, cursor, self.search)
+
+    def test_cached(self):
+        self.searches = 0
+        before = search_cache.get_stats()
+
+        self.assertEqual(self.get_results('potato'), (['result'], 1, None))
+        # Normalized keywords share an entry
+        self.assertEqual(self.get_results('  Potato '), (['result'], 1, None))
+        self.assertEqual(self.searches, 1)
+
+        after = search_cache.get_stats()
+        self.assertEqual(after['misses'] - before['misses'], 1)
+        self.assertEqual(after['hits'] - before['hits'], 1)
+
+    def test_filters_are_part_of_the_key(self):
+        self.searches = 0
+        self.get_results('potato')
+        self.get_results('potato', {'language_id': '2'})
+        self.assertEqual(self.searches, 2)
+
+    def test_cursor_is_part_of_the_key(self):
+        self.searches = 0
+        self.get_results('potato')
+        self.get_results('potato', cursor='next')
+        self.assertEqual(self.searches, 2)
+
+    def test_bump_generation(self):
+        self.searches = 0
+        self.get_results('potato')
+        search_cache.bump_generation('snippets')
+        self.get_results('potato')
+        self.assertEqual(self.searches, 2)
+
+
+class SearchMixinTests(SnippetsTestMixin, unittest.TestCase):
+
+    def setUp(self):
+        super(SearchMixinTests, self).setUp()
+        self.testbed.init_search_stub()
+        self.view = Home()
+
+    def test_query_string_is_quoted(self):
+        self.assertEqual(
+            self.view.get_query_string('foo\\ "bar"', {'language_id': '3'}),
+            '"foo\\\\" AND "\\"bar\\"" AND language_id = 3')
+
+    def test_bad_searches_find_nothing(self):
+        self.assertEqual(self.view.get_results('foo\\', {}), ([], 0, None))
+        self.assertEqual(self.view.get_results('foo', {}, 'not a cursor'),
+            ([], 0, None))
+
+    def test_document_from_result(self):
+        result = search_api.ScoredDocument(doc_id='12', fields=[
+            search_api.TextField(name='title', value=u'a'),
+            search_api.NumberField(name='language_id', value=3),
+            search_api.DateField(name='created', value=date(2013, 1, 2)),
+        ])
+        document = self.view.document_from_result(result)
+        self.assertTrue(isinstance(document, CodeSnippetDocument))
+        self.assertEqual(document.title, u'a')
+        self.assertEqual(document.language_id, 3)
+        self.assertEqual(document.created, date(2013, 1, 2))
+        self.assertEqual(document.get_absolute_url(), '/snippet/12/')
+
+
+class HighlightingTests(SnippetsTestMixin, unittest.TestCase):
+
+    def test_highlight(self):
+        html = highlight(u'def f(): # <b>\n    return "x"', 'python')
+        self.assertEqual(html,
+            u'<span class="keyword">def</span> f(): '
+            u'<span class="comment"># &lt;b&gt;</span>\n    '
+            u'<span class="keyword">return</span> '
+            u'<span class="string">"x"</span>')
+
+    def test_unterminated_triple_quotes(self):
+        # Used to backtrack exponentially in the number of backslashes
+        for quote in (u'"""', u"'''"):
+            code = quote + u'\\' * 5000 + u'x'
+            started = time.time()
+            html = highlight(code, 'python')
+            self.assertTrue(time.time() - started < 1)
+            self.assertTrue(u'\\' * 5000 + u'x' in html)
+
+    def test_unclosed_comments(self):
+        # Used to take quadratic time in the number of unclosed comments
+        code = u'/* ' * 50000
+        for language in ('js', 'java'):
+            started = time.time()
+            html = highlight(code, language)
+            self.assertTrue(time.time() - started < 1)
+            self.assertEqual(html.count(u'<span class="comment">'), 1)
+
+    def test_unknown_language_is_escaped(self):
+        self.assertEqual(highlight(u'if x < 1', None), u'if x &lt; 1')
+
+    def test_stored_for_current_version_only(self):
+        snippet = CodeSnippet(title='a', code='return 1', language=3)
+        snippet.put()
+        store_highlighted(snippet)
+        self.assertTrue('<span' in get_highlighted(snippet))
+
+        # Edited without being highlighted again, so the old HTML is stale
+        snippet.code = 'return 2'
+        snippet.put()
+        self.assertEqual(get_highlighted(snippet), u'return 2')
+
+
+class PageCacheTests(SnippetsTestMixin, unittest.TestCase):
+
+    def test_validators(self):
+        snippet = CodeSnippet(title='a', code='b')
+        snippet.put()
+        snippet_id = snippet.key().id()
+        self.assertEqual(
+            get_snippet_validators(snippet_id), (snippet.modified, None))
+
+        comment = Comment(body='c', code_snippet=snippet)
+        comment.put()
+        # Still cached until updated
+        self.assertEqual(
+            get_snippet_validators(snippet_id), (snippet.modified, None))
+        update_snippet_validators(snippet)
+        self.assertEqual(
+            get_snippet_validators(snippet_id),
+            (snippet.modified, comment.created))
+
+    def test_updated_on_comment(self):
+        snippet = CodeSnippet(title='a', code='b')
+        snippet.put()
+        get_snippet_validators(snippet.key().id())
+        comment = snippet.add_comment('c', None)
+        self.assertEqual(get_snippet_validators(snippet.key().id()),
+            (snippet.modified, comment.created))
+
+    def test_loaded_validators_dont_replace_updated_ones(self):
+        snippet = CodeSnippet(title='a', code='b')
+        snippet.put()
+        snippet_id = snippet.key().id()
+        get_by_id = CodeSnippet.get_by_id
+        def get_by_id_then_update(snippet_id):
+            # Someone saves the snippet while it's being loaded
+            loaded = get_by_id(snippet_id)
+            snippet.put()
+            update_snippet_validators(snippet)
+            return loaded
+
+        CodeSnippet.get_by_id = staticmethod(get_by_id_then_update)
+        try:
+            get_snippet_validators(snippet_id)
+        finally:
+            del CodeSnippet.get_by_id
+        self.assertEqual(get_snippet_validators(snippet_id),
+            (snippet.modified, None))
+
+    def test_missing_snippet(self):
+        self.assertEqual(get_snippet_validators(1234), None)
+
+    def test_anonymous_page_csrf_token(self):
+        request = FakeRequest()
+        request.META['CSRF_COOKIE'] = 'mytoken'
+        set_anonymous_page(request, 'k', HttpResponse('<p>mytoken</p>'))
+        self.assertEqual(get_anonymous_page(request, 'nope'), None)
+
+        other = FakeRequest()
+        other.META['CSRF_COOKIE'] = 'yourtoken'
+        response = get_anonymous_page(other, 'k')
+        self.assertEqual(response.content, '<p>yourtoken</p>')
+
+
+class AnonymousFastPathTests(SnippetsTestMixin, unittest.TestCase):
+
+    def setUp(self):
+        super(AnonymousFastPathTests, self).setUp()
+        self.logout()
+        self.middleware = AnonymousFastPathMiddleware()
+        self.factory = RequestFactory()
+
+    def cache_home_page(self):
+        request = self.factory.get('/')
+        request.META['CSRF_COOKIE'] = 'mytoken'
+        request.LANGUAGE_CODE = 'en'
+        set_anonymous_page(request, get_home_page_key(request),
+            HttpResponse('<p>mytoken</p>'))
+
+    def test_serves_cached_pages(self):
+        self.cache_home_page()
+        request = self.factory.get('/')
+        request.META['HTTP_ACCEPT_LANGUAGE'] = 'en'
+        response = self.middleware.process_request(request)
+        self.assertEqual(response.content,
+            '<p>%s</p>' % request.META['CSRF_COOKIE'])
+        self.assertFalse(hasattr(request, 'session'))
+
+    def test_misses(self):
+        self.assertEqual(self.middleware.process_request(
+            self.factory.get('/')), None)
+        self.assertEqual(self.middleware.process_request(
+            self.factory.get('/snippet/1234/')), None)
+
+    def test_other_hosts_miss(self):
+        self.cache_home_page()
+        request = self.factory.get('/', HTTP_HOST='example.com',
+            HTTP_ACCEPT_LANGUAGE='en')
+        self.assertEqual(self.middleware.process_request(request), None)
+
+    def test_other_schemes_miss(self):
+        self.cache_home_page()
+        request = self.factory.get('/', HTTP_ACCEPT_LANGUAGE='en',
+            **{'wsgi.url_scheme': 'https'})
+        self.assertEqual(self.middleware.process_request(request), None)
+
+    def test_conditional_gets(self):
+        snippet = CodeSnippet(title='a', code='b')
+        snippet.put()
+        snippet_id = str(snippet.key().id())
+        path = '/snippet/%s/' % snippet_id
+        request = self.factory.get(path)
+        request.LANGUAGE_CODE = 'en'
+        set_anonymous_page(request,
+            get_snippet_detail_page_key(request, snippet_id),
+            HttpResponse('<p>a</p>'))
+
+        response = self.middleware.process_request(
+            self.factory.get(path, HTTP_ACCEPT_LANGUAGE='en'))
+        self.assertEqual(response.content, '<p>a</p>')
+        self.assertTrue(response.has_header('Last-Modified'))
+
+        response = self.middleware.process_request(self.factory.get(path,
+            HTTP_ACCEPT_LANGUAGE='en', HTTP_IF_NONE_MATCH=response['ETag']))
+        self.assertEqual(response.status_code, 304)
+
+    def test_not_anonymous(self):
+        self.cache_home_page()
+        request = self.factory.get('/')
+        request.COOKIES[settings.SESSION_COOKIE_NAME] = 'abc'
+        self.assertEqual(self.middleware.process_request(request), None)
+
+        self.login(self.user_id, self.user_email)
+        self.assertEqual(self.middleware.process_request(
+            self.factory.get('/')), None)
+
+    def test_other_views(self):
+        self.assertEqual(self.middleware.process_request(
+            self.factory.get('/snippet/new/')), None)
+        self.assertEqual(self.middleware.process_request(
+            self.factory.post('/')), None)
+
+    def test_home_pages_invalidated(self):
+        request = self.factory.get('/')
+        request.LANGUAGE_CODE = 'en'
+        key = get_home_page_key(request)
+        invalidate_home_pages()
+        self.assertNotEqual(get_home_page_key(request), key)
+
+
+class ContextProcessorTests(SnippetsTestMixin, unittest.TestCase):
+
+    def test_urls_are_lazy_and_memoized(self):
+        context_processors._login_urls.clear()
+        made = []
+        create_login_url = users.create_login_url
+        def counting_create_login_url(path):
+            made.append(path)
+            return create_login_url(path)
+
+        users.create_login_url = counting_create_login_url
+        try:
+            request = RequestFactory().get('/snippet/1/')
+            ctx = context_processors.put_user_in_context(request)
+            self.assertEqual(made, [])
+            self.assertEqual(str(ctx['login_url']),
+                create_login_url('/snippet/1/'))
+            ctx = context_processors.put_user_in_context(request)
+            str(ctx['login_url'])
+            self.assertEqual(made, ['/snippet/1/'])
+
+            request = RequestFactory().get('/snippet/1/',
+                **{'wsgi.url_scheme': 'https'})
+            str(context_processors.put_user_in_context(request)['login_url'])
+            self.assertEqual(made, ['/snippet/1/', '/snippet/1/'])
+        finally:
+            users.create_login_url = create_login_url
+
+
+class LatestSnippetsTests(SnippetsTestMixin, unittest.TestCase):
+
+    def save(self, title):
+        snippet = CodeSnippet(title=title, code='', creator=self.user)
+        snippet.put()
+        add_to_latest_snippets(snippet)
+        return snippet
+
+    def setUp(self):
+        super(LatestSnippetsTests, self).setUp()
+        self.user = User.get_current(FakeRequest())
+
+    def test_newest_first(self):
+        for title in 'abcdefg':
+            self.save(title)
+        feed = get_latest_snippets()
+        self.assertEqual([s.title for s in feed], list('gfedc'))
+        self.assertEqual(feed[0].creator_email, self.user_email)
+
+    def test_edit_moves_to_top(self):
+        a = self.save('a')
+        self.save('b')
+        a.title = 'a2'
+        a.put()
+        add_to_latest_snippets(a)
+        self.assertEqual([s.title for s in get_latest_snippets()], ['a2', 'b'])
+
+    def test_rebuilt_from_query(self):
+        for title in 'abc':
+            CodeSnippet(title=title, code='').put()
+        self.assertEqual(
+            [s.title for s in get_latest_snippets()], ['c', 'b', 'a'])
+
+    def test_save_during_read(self):
+        self.save('a')
+        get_or_set = latest.latest_snippets.get_or_set
+        def get_or_set_saving(key, func, timeout):
+            def merge_then_save():
+                # Someone saves a snippet after the shards have been merged
+                entries = func()
+                self.save('b')
+                return entries
+            return get_or_set(key, merge_then_save, timeout)
+
+        latest.latest_snippets.get_or_set = get_or_set_saving
+        try:
+            self.assertEqual([s.title for s in get_latest_snippets()], ['a'])
+        finally:
+            del latest.latest_snippets.get_or_set
+        self.assertEqual([s.title for s in get_latest_snippets()], ['b', 'a'])
+
+    def test_count_raised(self):
+        old_count = settings.LATEST_SNIPPETS_COUNT
+        settings.LATEST_SNIPPETS_COUNT = 1
+        try:
+            for title in 'abcdefg':
+                self.save(title)
+            self.assertEqual([s.title for s in get_latest_snippets()], ['g'])
+
+            # The shards only have one entry each, so they're rebuilt
+            settings.LATEST_SNIPPETS_COUNT = 7
+            latest.latest_snippets.invalidate()
+            self.assertEqual(
+                [s.title for s in get_latest_snippets()], list('gfedcba'))
+        finally:
+            settings.LATEST_SNIPPETS_COUNT = old_count
+
+
+class CommentsTests(SnippetsTestMixin, unittest.TestCase):
+
+    def setUp(self):
+        super(CommentsTests, self).setUp()
+        self.user = User.get_current(FakeRequest())
+        self.snippet = CodeSnippet(title='a', code='b', creator=self.user)
+        self.snippet.put()
+
+    def comment_count(self):
+        key = CodeSnippet.get_comment_count_key(self.snippet.key().id())
+        return db.get(key).count
+
+    def test_add_comment_counts(self):
+        modified = self.snippet.modified
+        self.snippet.add_comment('one', self.user)
+        self.snippet.add_comment('two', self.user)
+        self.assertEqual(self.comment_count(), 2)
+        self.assertEqual(
+            CodeSnippet.get_by_id(self.snippet.key().id()).modified, modified)
+
+    def test_backfill(self):
+        # Comments made before there were counters
+        for body in ('one', 'two'):
+            Comment(body=body, code_snippet=self.snippet).put()
+        self.assertEqual(self.snippet.backfill_comment_count().count, 2)
+
+        self.snippet.add_comment('three', self.user)
+        self.assertEqual(self.comment_count(), 3)
+
+    def test_add_comment_backfills(self):
+        Comment(body='one', code_snippet=self.snippet).put()
+        self.snippet.add_comment('two', self.user)
+        self.assertEqual(self.comment_count(), 2)
+
+    def test_pages(self):
+        for i in range(5):
+            self.snippet.add_comment(str(i), self.user)
+        count = self.comment_count()
+
+        bodies = []
+        token = None
+        while True:
+            comments, token = get_comments_page(
+                self.snippet, count, token, per_page=2)
+            bodies.append([c.body for c in comments])
+            if token is None:
+                break
+        self.assertEqual(bodies, [['0', '1'], ['2', '3'], ['4']])
+
+    def test_exact_last_page(self):
+        for i in range(2):
+            self.snippet.add_comment(str(i), self.user)
+        comments, token = get_comments_page(
+            self.snippet, self.comment_count(), per_page=2)
+        self.assertEqual(len(comments), 2)
+        self.assertEqual(token, None)
+
+    def test_bad_token(self):
+        self.assertRaises(ValueError, decode_token, 'not a token')
+        self.assertRaises(ValueError, get_comments_page, self.snippet, 0,
+            encode_token(5, 'not a cursor'))
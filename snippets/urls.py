@@ -11,5 +11,7 @@ urlpatterns = patterns(
 
     url(r'^_purge/$', 'views._purge', {}, name='purge'),
     url(r'^_reindex/$', 'views._reindex', {}, name='reindex'),
+    url(r'^_index/$', 'views._index_snippet', {}, name='index-snippet'),
+    url(r'^_cache/$', 'views._cache_metrics', {}, name='cache-metrics'),
 )
 
@@ -1,21 +1,45 @@
+import json
 import logging
-from datetime import datetime
+from hashlib import md5
 
+from google.appengine.api import search as search_api
+from google.appengine.api import taskqueue
+from google.appengine.api import users
 from google.appengine.ext import db
 
-from django.http import Http404, HttpResponseRedirect, HttpResponse
+from django.conf import settings
+from django.core.cache import cache
+from django.http import (Http404, HttpResponseRedirect, HttpResponse,
+    HttpResponseBadRequest, HttpResponseForbidden)
 from django.template import RequestContext
 from django.views.generic import TemplateView
 from django.shortcuts import render_to_response
 from django.core.urlresolvers import reverse
+from django.utils.http import urlencode
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import condition
 
 from snippets.models import CodeSnippet, User
+from snippets.comments import get_comments_page
+from snippets import search_cache
 from snippets.forms import CodeSnippetForm
+from snippets.highlighting import get_highlighted, store_highlighted
 from snippets.documents import CodeSnippetDocument
+from snippets.latest import add_to_latest_snippets, get_latest_snippets
+from snippets.page_cache import (get_anonymous_page, get_home_pages_generation,
+    get_snippet_validators, invalidate_home_pages,
+    set_anonymous_page, update_snippet_validators)
+from snippets.indexing import (get_index_queue, process_index_job,
+    reindex_snippets)
 
 from search.indexes import Index
 
 
+# Seconds a single `_reindex` request spends indexing before handing over to a
+# task, comfortably inside the request deadline
+REINDEX_TIME_LIMIT = 30
+
+
 # Helpers. TODO: move these to a utils package probably.
 
 def get_snippet_or_404_on_error(snippet_id):
@@ -35,29 +59,49 @@ def get_snippet_or_404(snippet_id):
     return snippet
 
 
+def get_snippet_and_comment_count_or_404(snippet_id):
+    """Get a snippet and how many comments it has with a single batch get,
+    counting them once for snippets that don't have a counter yet
+    """
+    try:
+        snippet_id = int(snippet_id)
+    except (TypeError, ValueError):
+        raise Http404()
+
+    snippet, counter = db.get([
+        db.Key.from_path(CodeSnippet.kind(), snippet_id),
+        CodeSnippet.get_comment_count_key(snippet_id),
+    ])
+    if snippet is None:
+        raise Http404()
+    if counter is None:
+        counter = snippet.backfill_comment_count()
+    return snippet, counter.count
+
+
 def index_snippet_with_search(snippet):
-    snippet_doc = CodeSnippetDocument(
-        doc_id=snippet.key().id(),
-        title=snippet.title,
-        code=snippet.code,
-        language_id=snippet.language,
-        language_readable=snippet.get_language(),
-        creator_email=snippet.creator.email,
-        created=datetime.now().date(),
-        modified=snippet.modified.date(),
-    )
-    index = Index(name='snippets')
-    index.add(snippet_doc)
+    "Queue the saved snippet to be indexed with search in the background"
+    get_index_queue().enqueue_snippet(snippet)
+
 
+def save_snippet(snippet):
+    "Save a snippet and update everything derived from it"
+    snippet.put()
+    store_highlighted(snippet)
+    add_to_latest_snippets(snippet)
+    update_snippet_validators(snippet)
+    invalidate_home_pages()
+    index_snippet_with_search(snippet)
 
-def copy_snippet_from_form(form, snippet=None):
+
+def copy_snippet_from_form(form, snippet=None, request=None):
     if snippet is None:
         snippet = CodeSnippet()
 
     for field_name, clean_val in form.cleaned_data.items():
         setattr(snippet, field_name, clean_val)
 
-    current_user = User.get_current()
+    current_user = User.get_current(request)
     if not snippet.is_saved():
         snippet.creator = current_user
     snippet.modifier = current_user
@@ -65,26 +109,58 @@ def copy_snippet_from_form(form, snippet=None):
     return snippet
 
 
+def serve_with_anonymous_page_cache(request, view, get_page_key, **kwargs):
+    """Serve `view`, caching the whole page for anonymous users under the key
+    `get_page_key(request, **kwargs)` gives, unless that's `None`
+    """
+    page_key = None
+    if request.method == 'GET' and users.get_current_user() is None:
+        page_key = get_page_key(request, **kwargs)
+
+    if page_key is not None:
+        response = get_anonymous_page(request, page_key)
+        if response is not None:
+            return response
+
+    response = view(request, **kwargs)
+    if page_key is not None:
+        response.render()
+        set_anonymous_page(request, page_key, response)
+    return response
+
+
 def _reindex(request):
-    "Debug view for reindexing all code snippets with search"
+    """Debug view and task handler for reindexing all code snippets with
+    search. Runs for at most `REINDEX_TIME_LIMIT` seconds and then queues a
+    task to carry on from the checkpoint if there are snippets left. Pass
+    `restart` to start again from the beginning.
+    """
     # TODO: remove
-    i = Index(name='snippets')
+    stats = reindex_snippets(
+        time_limit=REINDEX_TIME_LIMIT,
+        restart=bool(request.GET.get('restart')),
+    )
+    if not stats['done']:
+        taskqueue.add(url=reverse('snippets:reindex'), method='GET')
 
-    docs = []
-    for s in CodeSnippet.all():
-        docs.append(CodeSnippetDocument(
-            doc_id=s.key().id(),
-            title=s.title,
-            code=s.code,
-            language_id=s.language,
-            language_readable=s.get_language(),
-            creator_email=s.creator.email,
-            created=s.created.date(),
-            modified=datetime.now().date(),
-        ))
-    i.add(docs)
+    return HttpResponse(
+        'Indexed %(indexed)d (%(total)d in total) at %(docs_per_sec).1f '
+        'docs/sec, done: %(done)s' % stats)
 
-    return HttpResponse('Done')
+
+@csrf_exempt
+def _index_snippet(request):
+    "Task handler for indexing jobs queued by `TaskQueueIndexQueue`"
+    if 'HTTP_X_APPENGINE_QUEUENAME' not in request.META:
+        return HttpResponseForbidden()
+
+    snippet_id = request.POST.get('snippet_id')
+    version = request.POST.get('version')
+    if not (snippet_id and version):
+        return HttpResponseBadRequest()
+
+    indexed = process_index_job(snippet_id, version)
+    return HttpResponse('Indexed' if indexed else 'Stale')
 
 
 def _purge(request):
@@ -93,9 +169,26 @@ def _purge(request):
 
     i = Index(name='snippets')
     i.purge()
+    search_cache.bump_generation('snippets')
     return HttpResponse('Done')
 
 
+def _cache_metrics(request):
+    """Debug view for this instance's cache stats and, if the cache has the
+    `METRICS` option on, its metrics. Pass `reset` to start them again.
+    """
+    if not users.is_current_user_admin():
+        return HttpResponseForbidden()
+
+    metrics = cache.metrics
+    if metrics is not None and request.GET.get('reset'):
+        metrics.reset()
+    return HttpResponse(json.dumps({
+        'stats': cache.get_stats(),
+        'metrics': metrics.get_metrics() if metrics is not None else None,
+    }, indent=2, sort_keys=True), content_type='application/json')
+
+
 class SearchMixin(object):
     """Will add search results of the given parameters to the view that
     inherits it from it.
@@ -114,10 +207,18 @@ class SearchMixin(object):
     query_param_name = 'q'
     # Allowed filter URL param names
     allowed_filters = {}
+    # URL param name for the cursor token of the page of results to show
+    cursor_param_name = 'cursor'
+    # How many matches the search API counts accurately, beyond which the
+    # results count is an estimate
+    count_accuracy = 1000
 
     # Context names for the list of results and the applied filters
     results_context_name = 'results'
     filters_context_name = 'filters'
+    # Context name for the query string of the next page of results, which is
+    # only set if there is a next page
+    next_page_context_name = 'next_page_query'
 
     def get_filters(self):
         """Returns a dict of filters to apply to the search"""
@@ -131,27 +232,79 @@ class SearchMixin(object):
         """Gets the keywords for the search"""
         return self.request.GET.get(self.query_param_name, '')
 
+    def get_cursor(self):
+        "Gets the cursor token for the page of results to show, if any"
+        return self.request.GET.get(self.cursor_param_name) or None
+
+    def quote(self, value):
+        "Quotes `value` as a search API phrase, so it's taken literally"
+        return '"%s"' % value.replace('\\', '\\\\').replace('"', '\\"')
+
+    def get_query_string(self, keywords, filters):
+        """Builds the search API query string for the keywords and filters.
+        Every keyword has to match, and is quoted so it's taken literally.
+        """
+        parts = [self.quote(k) for k in keywords.split()]
+        for name, value in sorted(filters.items()):
+            if not value.isdigit():
+                value = self.quote(value)
+            parts.append('%s = %s' % (name, value))
+        return ' AND '.join(parts)
+
+    def document_from_result(self, result):
+        "Turns a search API result into an instance of `document_class`"
+        fields = dict((f.name, f.value) for f in result.fields)
+        return self.document_class(doc_id=result.doc_id, **fields)
+
+    def get_results(self, keywords, filters, cursor=None):
+        """Runs the search, returning `(results, count, next_cursor)` from a
+        single execution. `cursor` is the token for the page of results to
+        get and `next_cursor` the token for the page after it, or `None` if
+        there isn't one. A query or cursor the search API won't take, which
+        can only have come from the URL, finds nothing.
+        """
+        try:
+            options = search_api.QueryOptions(
+                limit=self.results_limit,
+                number_found_accuracy=self.count_accuracy,
+                cursor=search_api.Cursor(web_safe_string=cursor),
+            )
+            query = search_api.Query(
+                self.get_query_string(keywords, filters), options=options)
+            found = search_api.Index(name=self.index_name).search(query)
+        except (search_api.QueryError, search_api.InvalidRequest,
+                ValueError):
+            logging.info('Bad search for %r with filters %r and cursor %r',
+                keywords, filters, cursor)
+            return [], 0, None
+
+        results = [self.document_from_result(r) for r in found.results]
+        next_cursor = found.cursor.web_safe_string if found.cursor else None
+        return results, found.number_found, next_cursor
+
     def get_context_data(self, **kwargs):
         ctx = super(SearchMixin, self).get_context_data(**kwargs)
 
-        query = None
         results_count_context_name = self.results_context_name+'_count'
 
         filters = self.get_filters()
         q = self.get_keywords()
+        cursor = self.get_cursor()
 
         # The API wrapper should possibly handle the need for the following ifs
         if q or filters:
-            query = Index(name=self.index_name).search(self.document_class)
-
-        if query:
-            if q:
-                query = query.keywords(q)
-            if filters:
-                query = query.filter(**filters)
-
-            ctx[self.results_context_name] = query[:self.results_limit]
-            ctx[results_count_context_name] = query.count()
+            results, count, next_cursor = search_cache.get_results(
+                self.index_name, q, filters, self.results_limit, cursor,
+                lambda: self.get_results(q, filters, cursor)
+            )
+            ctx[self.results_context_name] = results
+            ctx[results_count_context_name] = count
+
+            if next_cursor:
+                params = dict(filters)
+                params[self.query_param_name] = q
+                params[self.cursor_param_name] = next_cursor
+                ctx[self.next_page_context_name] = urlencode(params)
 
         ctx[self.query_param_name] = q
         ctx[self.filters_context_name] = filters
@@ -162,7 +315,7 @@ class SearchMixin(object):
 
 
 class Home(SearchMixin, TemplateView):
-    """Shows the 5 latest snippets along with the 5 latest search results for
+    """Shows the latest snippets along with the 5 latest search results for
     any search if one has been performed.
     """
     template_name = 'snippets/index.html'
@@ -172,26 +325,133 @@ class Home(SearchMixin, TemplateView):
 
     def get_context_data(self, **kwargs):
         ctx = super(Home, self).get_context_data(**kwargs)
-        ctx['latest_snippets'] = CodeSnippet.all().order('modified').fetch(5)
+        ctx['latest_snippets'] = get_latest_snippets()
 
         return ctx
 
-home = Home.as_view()
+
+def get_home_page_key(request):
+    """A key for the content of the home page on the request's scheme and
+    host, in its language and with its query string
+    """
+    return 'home-%s-%s-%s-%s-%s-%s' % (
+        get_home_pages_generation(),
+        search_cache.get_namespace(Home.index_name).get_generation(),
+        'https' if request.is_secure() else 'http',
+        request.get_host(),
+        getattr(request, 'LANGUAGE_CODE', ''),
+        md5(request.GET.urlencode()).hexdigest(),
+    )
+
+
+def home(request):
+    "Serves `Home`, caching the whole page for anonymous users"
+    return serve_with_anonymous_page_cache(request, Home.as_view(),
+        get_home_page_key)
 
 
 class SnippetDetail(TemplateView):
-    "Detail view for a single snippet along with its last 5 comments"
+    "Detail view for a single snippet along with a page of its comments"
     template_name = 'snippets/detail.html'
 
+    comments_per_page = 5
+    # URL param name for the token of the page of comments to show
+    comments_param_name = 'comments'
+
     def get_context_data(self, **kwargs):
-        code_snippet = get_snippet_or_404(self.kwargs.get('snippet_id'))
+        code_snippet, comment_count = get_snippet_and_comment_count_or_404(
+            self.kwargs.get('snippet_id'))
+
+        try:
+            comments, next_token = get_comments_page(
+                code_snippet,
+                comment_count,
+                self.request.GET.get(self.comments_param_name),
+                per_page=self.comments_per_page,
+            )
+        except ValueError:
+            raise Http404()
 
         ctx = super(SnippetDetail, self).get_context_data(**kwargs)
         ctx['snippet'] = code_snippet
-        ctx['comments'] = code_snippet.comments.fetch(5)
+        ctx['code_html'] = get_highlighted(code_snippet)
+        ctx['comments'] = comments
+        ctx['comment_count'] = comment_count
+        if next_token:
+            ctx['next_comments_query'] = urlencode(
+                {self.comments_param_name: next_token})
         return ctx
 
-snippet_detail = SnippetDetail.as_view()
+
+def _get_snippet_validators(request, snippet_id):
+    "Get the snippet's validators, memoized on the request"
+    if not hasattr(request, '_snippet_validators'):
+        request._snippet_validators = get_snippet_validators(snippet_id)
+    return request._snippet_validators
+
+
+def get_snippet_detail_page_key(request, snippet_id):
+    """A key for the content of a snippet's detail page on the request's
+    scheme and host, in its language and with its query string, or `None` if
+    there's no such snippet
+    """
+    validators = _get_snippet_validators(request, snippet_id)
+    if validators is None:
+        return None
+    modified, last_commented = validators
+    return '%s-%s-%s-%s-%s-%s-%s' % (
+        snippet_id,
+        modified.isoformat(),
+        last_commented.isoformat() if last_commented else '',
+        'https' if request.is_secure() else 'http',
+        request.get_host(),
+        getattr(request, 'LANGUAGE_CODE', ''),
+        md5(request.GET.urlencode()).hexdigest(),
+    )
+
+
+def snippet_detail_etag(request, snippet_id=None):
+    "The detail page varies with the user and their CSRF token too"
+    page_key = get_snippet_detail_page_key(request, snippet_id)
+    if page_key is None:
+        return None
+    user = users.get_current_user()
+    return md5('|'.join((
+        page_key,
+        str(user.user_id()) if user else '',
+        request.COOKIES.get(settings.CSRF_COOKIE_NAME, ''),
+    ))).hexdigest()
+
+
+def snippet_detail_last_modified(request, snippet_id=None):
+    validators = _get_snippet_validators(request, snippet_id)
+    if validators is None:
+        return None
+    return max(v for v in validators if v is not None)
+
+
+@condition(etag_func=snippet_detail_etag,
+    last_modified_func=snippet_detail_last_modified)
+def snippet_detail(request, snippet_id=None):
+    """Serves `SnippetDetail`, answering conditional GETs from the snippet's
+    validators and caching the whole page for anonymous users
+    """
+    return serve_with_anonymous_page_cache(request, SnippetDetail.as_view(),
+        get_snippet_detail_page_key, snippet_id=snippet_id)
+
+
+# The page keys of the views `AnonymousFastPathMiddleware` can serve, by name
+ANONYMOUS_PAGE_KEYS = {
+    'snippets:home': get_home_page_key,
+    'snippets:snippet-detail': get_snippet_detail_page_key,
+}
+
+# The `(etag_func, last_modified_func)` of those of them that answer
+# conditional GETs, so that the pages it serves do as well
+ANONYMOUS_PAGE_VALIDATORS = {
+    'snippets:snippet-detail': (snippet_detail_etag,
+        snippet_detail_last_modified),
+}
 
 
 def new_snippet(request):
@@ -202,9 +462,8 @@ def new_snippet(request):
         form = CodeSnippetForm(request.POST)
         if form.is_valid():
             snippet = CodeSnippet()
-            snippet = copy_snippet_from_form(form, snippet)
-            snippet.put()
-            index_snippet_with_search(snippet)
+            snippet = copy_snippet_from_form(form, snippet, request)
+            save_snippet(snippet)
             
             return HttpResponseRedirect(reverse(
                 'snippets:snippet-detail',
@@ -235,9 +494,9 @@ def edit_snippet(request, snippet_id=None):
         form = CodeSnippetForm(request.POST)
         if form.is_valid():
             snippet = get_snippet_or_404(snippet_id)
-            snippet = copy_snippet_from_form(form, snippet=snippet)
-            snippet.put()
-            index_snippet_with_search(snippet)
+            snippet = copy_snippet_from_form(form, snippet=snippet,
+                request=request)
+            save_snippet(snippet)
 
             return HttpResponseRedirect(reverse(
                 'snippets:snippet-detail',
@@ -3,5 +3,7 @@ from django.conf.urls.defaults import patterns, url, include
 urlpatterns = patterns(
     '',
     (r'', include('snippets.urls', namespace='snippets'),),
+    (r'^_sessions/', include('appengine_sessions.urls',
+        namespace='appengine_sessions'),),
     (r'^i18n/', include('django.conf.urls.i18n'),),
 )